@@ -0,0 +1,190 @@
+import atexit
+import random
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import bindparam, func
+
+from models import db, Activity, File
+
+# Actions that only read a file; these can be sampled and are always counted
+READ_ACTIONS = {'download': 'download_count', 'preview': 'preview_count'}
+
+
+class ActivityLog:
+    """Write-behind buffer for the activity log
+
+    Events are collected in memory and written with one bulk INSERT when the
+    buffer reaches ACTIVITY_BUFFER_SIZE or ACTIVITY_FLUSH_INTERVAL seconds
+    have passed, instead of one commit per event. Read events additionally
+    increment per-file counters, and only a ACTIVITY_READ_SAMPLE_RATE share
+    of them is kept as individual rows. Buffered events are flushed when the
+    process exits.
+
+    Writes go through their own connection, so flushing never commits the
+    caller's session.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.thread = None
+        self._events = []
+        self._counters = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('ACTIVITY_BUFFER_SIZE', 100)
+        app.config.setdefault('ACTIVITY_FLUSH_INTERVAL', 5.0)
+        app.config.setdefault('ACTIVITY_READ_SAMPLE_RATE', 1.0)
+        app.config.setdefault('ACTIVITY_MAX_BUFFERED', 10000)
+        atexit.register(self.stop)
+
+    def record(self, user_id, action, file_id=None, folder_id=None):
+        """Buffer an activity event
+
+        Args:
+            user_id: ID of the acting user
+            action: Action name, e.g. 'upload' or 'download'
+            file_id: Optional ID of the file acted on
+            folder_id: Optional ID of the folder acted on
+        """
+        now = datetime.utcnow()
+        with self._lock:
+            self._add(user_id, action, file_id, folder_id, now)
+            due = self._due()
+
+        if due:
+            self._flush_due()
+
+    def record_many(self, user_id, action, file_ids):
+        """Buffer the same action on many files as one batch
+
+        Bulk operations use this instead of calling record() per file, so the
+        buffer is checked and flushed once for the whole batch.
+        """
+        now = datetime.utcnow()
+        with self._lock:
+            for file_id in file_ids:
+                self._add(user_id, action, file_id, None, now)
+            due = self._due()
+
+        if due:
+            self._flush_due()
+
+    def _add(self, user_id, action, file_id, folder_id, now):
+        counter = READ_ACTIONS.get(action)
+        if counter is not None and file_id is not None:
+            counts = self._counters.setdefault(
+                file_id, {'download_count': 0, 'preview_count': 0})
+            counts[counter] += 1
+            counts['accessed'] = now
+            keep = random.random() < self.app.config['ACTIVITY_READ_SAMPLE_RATE']
+        else:
+            keep = True
+
+        if keep:
+            self._events.append({
+                'user_id': user_id,
+                'action': action,
+                'file_id': file_id,
+                'folder_id': folder_id,
+                'timestamp': now
+            })
+
+    def _due(self):
+        config = self.app.config
+        return (len(self._events) + len(self._counters) >= config['ACTIVITY_BUFFER_SIZE'] or
+                time.monotonic() - self._last_flush >= config['ACTIVITY_FLUSH_INTERVAL'])
+
+    def _flush_due(self):
+        if self.thread is not None:
+            self._wakeup.set()
+        else:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered events and counters to the database
+
+        Returns:
+            Number of activity rows written
+        """
+        with self._flush_lock:
+            with self._lock:
+                events, self._events = self._events, []
+                counters, self._counters = self._counters, {}
+                self._last_flush = time.monotonic()
+            if not events and not counters:
+                return 0
+
+            try:
+                with db.get_engine(self.app).begin() as connection:
+                    if events:
+                        connection.execute(Activity.__table__.insert(), events)
+                    if counters:
+                        self._apply_counters(connection, counters)
+            except Exception as e:
+                print(f"Activity flush error: {e}")
+                self._requeue(events, counters)
+                return 0
+
+            return len(events)
+
+    def _apply_counters(self, connection, counters):
+        table = File.__table__
+        statement = table.update().where(table.c.id == bindparam('file')).values(
+            # Rows created before the counters existed hold NULL
+            download_count=func.coalesce(table.c.download_count, 0) + bindparam('downloads'),
+            preview_count=func.coalesce(table.c.preview_count, 0) + bindparam('previews'),
+            last_accessed_at=bindparam('accessed')
+        )
+        connection.execute(statement, [{
+            'file': file_id,
+            'downloads': counts['download_count'],
+            'previews': counts['preview_count'],
+            'accessed': counts['accessed']
+        } for file_id, counts in counters.items()])
+
+    def _requeue(self, events, counters):
+        """Put events from a failed flush back, dropping the oldest beyond the cap"""
+        with self._lock:
+            self._events = (events + self._events)[-self.app.config['ACTIVITY_MAX_BUFFERED']:]
+            for file_id, counts in counters.items():
+                current = self._counters.setdefault(
+                    file_id, {'download_count': 0, 'preview_count': 0, 'accessed': counts['accessed']})
+                current['download_count'] += counts['download_count']
+                current['preview_count'] += counts['preview_count']
+
+    def start(self):
+        """Start a thread that flushes the buffer in the background"""
+        with self._lock:
+            if self.thread is not None:
+                return
+            self._stopping.clear()
+            self.thread = threading.Thread(target=self._work, name='activity-flusher', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Stop the background thread and flush what is left"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def _work(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.app.config['ACTIVITY_FLUSH_INTERVAL'])
+            self._wakeup.clear()
+            self.flush()
+
+
+activity_log = ActivityLog()
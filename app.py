@@ -1,15 +1,52 @@
+import io
 import os
+import re
+import json
+import base64
+import shutil
 import secrets
-from datetime import datetime
+import hashlib
+import itertools
+import mimetypes
+import unicodedata
+from datetime import datetime, timedelta
 from cryptography.fernet import Fernet
-from flask import Flask, render_template, url_for, flash, redirect, request, abort, send_file, current_app
+from flask import (Flask, Request, Response, render_template, url_for, flash, redirect, request,
+                   abort, send_file, jsonify, stream_with_context, current_app)
 from flask_login import LoginManager, login_user, current_user, logout_user, login_required
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import is_resource_modified
+from werkzeug.urls import url_quote
 from werkzeug.utils import secure_filename
-from sqlalchemy import and_
+from sqlalchemy import and_, or_, case, func, literal, select
 import tempfile
+import click
+from collections import defaultdict
 
 from config import Config
-from models import db, User, File, Folder, Activity, shares
+from models import (db, User, File, Folder, Blob, UploadSession, Activity, ContentPosting, shares,
+                    folder_shares)
+from blobstore import (store_blob, acquire_blob, collect_garbage, delete_files, migrate_layout,
+                       tier_blobs)
+from storage import storage, LOCAL
+from archive import ArchiveMember, stream_zip
+from derivatives import derivative_cache, can_render, render_derivatives, SourceReadError
+from text_preview import LineIndex, build_line_index, skip_lines, read_page
+from plaintext_cache import plaintext_cache
+from compression import (ZLIB, FrameCompressor, codec_available, is_compressible, decompress_chunks,
+                         decompress_range)
+from encryption import (MAGIC, SEGMENTED_AES_GCM, master_key_bytes, is_segmented, read_header,
+                        plaintext_size, StreamEncryptor, encrypt_chunks, decrypt_chunks, decrypt_range)
+from jobs import job_queue
+from activity import activity_log
+from user_cache import user_cache
+from permissions import (has_file_permission, get_share_permission, forget_file_permissions,
+                         list_file_shares, get_folder_permission, get_shared_root_id,
+                         forget_folder_permissions, list_folder_shares, OWNER)
+from search_index import (index_file, index_files, index_folder, unindex_items, search as search_index,
+                          rebuild_search_index, create_fts_table)
+from content_index import (tokenize, store_postings, copy_postings, remove_postings, search_content,
+                           SNIPPET_BEFORE, SNIPPET_AFTER)
 from forms import (LoginForm, RegistrationForm, UploadFileForm, CreateFolderForm,
                   ShareFileForm, UpdateProfileForm, RenameFileForm)
 
@@ -20,6 +57,12 @@ Config.init_app(app)
 
 # Initialize extensions
 db.init_app(app)
+job_queue.init_app(app)
+activity_log.init_app(app)
+user_cache.init_app(app)
+storage.init_app(app)
+derivative_cache.init_app(app)
+plaintext_cache.init_app(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message_category = 'info'
@@ -29,140 +72,1151 @@ login_manager.login_message_category = 'info'
 def inject_shared_count():
     """Make shared file count available to all templates"""
     if current_user.is_authenticated:
-        shared_count = File.query.join(shares).filter(
-            shares.c.user_id == current_user.id,
-            File.is_trashed == False
-        ).count()
-        return {'shared_count': shared_count}
+        return {'shared_count': current_user.shared_count or 0}
     return {'shared_count': 0}
 
+@app.context_processor
+def inject_thumbnail_check():
+    """Let templates ask whether a thumbnail can be shown for a file"""
+    return {'has_thumbnail': lambda file: can_render(get_preview_type(file.original_filename))}
+
+@app.before_first_request
+def start_job_workers():
+    """Start the in-process background workers with the first request"""
+    if app.config['JOB_WORKERS'] > 0:
+        job_queue.start()
+    activity_log.start()
+    plaintext_cache.start()
+    remove_render_leftovers()
+
+def remove_render_leftovers():
+    """Remove plaintext temp files that older versions wrote while rendering derivatives"""
+    try:
+        entries = os.scandir(app.config['UPLOAD_FOLDER'])
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            if not entry.name.startswith('.render-'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.load(int(user_id))
 
 # Helper functions
 def get_encryption_key():
     """Get Fernet encryption key from config"""
     return Fernet(app.config['ENCRYPTION_KEY'].encode())
 
-def encrypt_file(input_file_path):
-    """Encrypt a file using Fernet symmetric encryption
+def get_master_key():
+    """Get the raw key material used by the segmented stream format"""
+    return master_key_bytes(app.config['ENCRYPTION_KEY'])
+
+def decrypt_stream(f, chunk_size=64 * 1024):
+    """Yield the plaintext of an open encrypted file chunk by chunk
+    
+    Files in the segmented format are decrypted one chunk at a time, so
+    memory use stays constant. Legacy Fernet files are recognised by their
+    missing header and decrypted in one piece.
+    
+    Args:
+        f: Encrypted file opened for binary reading
+        chunk_size: Size of the chunks yielded for legacy files
+    """
+    if is_segmented(f.read(len(MAGIC))):
+        f.seek(0)
+        yield from decrypt_chunks(get_master_key(), f)
+        return
+    
+    f.seek(0)
+    decrypted_data = get_encryption_key().decrypt(f.read())
+    for offset in range(0, len(decrypted_data), chunk_size):
+        yield decrypted_data[offset:offset + chunk_size]
+
+def file_storage(file):
+    """Get the storage backend holding a file's content"""
+    return storage.get(file.storage)
+
+def iter_stored_content(file, chunk_size=64 * 1024):
+    """Yield a stored file's content as it was before encryption, still compressed if it was"""
+    backend = file_storage(file)
+    if not file.is_encrypted:
+        yield from backend.iter_range(file.file_path, chunk_size=chunk_size)
+        return
+    with backend.open(file.file_path) as f:
+        yield from decrypt_stream(f, chunk_size)
+
+def iter_plaintext(file, chunk_size=64 * 1024):
+    """Yield the plaintext of a stored file, decrypting and decompressing it if needed"""
+    chunks = iter_stored_content(file, chunk_size)
+    if file.codec:
+        chunks = decompress_chunks(file.codec, chunks)
+    yield from chunks
+
+def iter_decrypted_range(file, ciphertext_size, start, stop):
+    """Yield the plaintext bytes [start, stop) of a stored segmented encrypted file"""
+    with file_storage(file).open(file.file_path) as f:
+        yield from decrypt_range(get_master_key(), f, ciphertext_size, start, stop)
+
+def iter_compressed_range(file, start, stop):
+    """Yield the plaintext bytes [start, stop) of a stored compressed file
+    
+    Only the compressed frames overlapping the range are read, decrypted
+    and decompressed.
+    """
+    if file.encryption_version == SEGMENTED_AES_GCM:
+        ciphertext_size, stored_size = segmented_sizes(file)
+        def read_stored(start, stop):
+            return b''.join(iter_decrypted_range(file, ciphertext_size, start, stop))
+    else:
+        backend = file_storage(file)
+        stored_size = backend.size(file.file_path)
+        def read_stored(start, stop):
+            return b''.join(backend.iter_range(file.file_path, start, stop))
+    
+    yield from decompress_range(file.codec, read_stored, stored_size, start,
+                                min(stop, file.file_size))
+
+def segmented_sizes(file):
+    """Get the ciphertext and plaintext sizes of a stored segmented encrypted file"""
+    backend = file_storage(file)
+    ciphertext_size = backend.size(file.file_path)
+    with backend.open(file.file_path) as f:
+        _, chunk_size, _, _ = read_header(f)
+    return ciphertext_size, plaintext_size(ciphertext_size, chunk_size)
+
+def read_plaintext_range(file, start, stop):
+    """Read the plaintext bytes [start, stop) of a stored file
+    
+    Only the overlapping chunks of segmented files are decrypted; legacy
+    Fernet files have to be decrypted in full; of compressed files only the
+    overlapping frames are decompressed.
+    """
+    if file.codec:
+        return b''.join(iter_compressed_range(file, start, stop))
+    
+    if file.encryption_version == SEGMENTED_AES_GCM:
+        ciphertext_size, length = segmented_sizes(file)
+        stop = min(stop, length)
+        if start >= stop:
+            return b''
+        return b''.join(iter_decrypted_range(file, ciphertext_size, start, stop))
+    
+    if not file.is_encrypted:
+        return b''.join(file_storage(file).iter_range(file.file_path, start, max(stop, start)))
+    
+    return b''.join(iter_plaintext(file))[start:stop]
+
+def content_disposition(disposition, filename):
+    """Build a Content-Disposition header value, encoding non-ASCII names"""
+    simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+    simple = simple.replace('\\', '\\\\').replace('"', '\\"')
+    value = f'{disposition}; filename="{simple}"'
+    if simple != filename:
+        value += f"; filename*=UTF-8''{url_quote(filename, safe='')}"
+    return value
+
+def file_etag(file):
+    """Get the strong ETag of a file's content
+    
+    Stored content never changes once uploaded, so the content hash
+    identifies it; files from before hashing fall back to id and
+    modification time.
+    """
+    if file.content_hash:
+        return file.content_hash
+    return f"{file.id}-{file.updated_at.strftime('%Y%m%d%H%M%S%f')}"
+
+def set_cache_headers(response, file):
+    """Add validators and the cache policy for a file's type to a response
+    
+    Content is only cached privately by the browser, for FILE_CACHE_MAX_AGE
+    seconds by preview type; other types are revalidated on every request,
+    which costs a 304 rather than a full transfer.
+    """
+    response.set_etag(file_etag(file))
+    response.last_modified = file.updated_at
+    response.cache_control.private = True
+    max_age = app.config['FILE_CACHE_MAX_AGE'].get(get_preview_type(file.original_filename))
+    if max_age:
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+def not_modified_response(file):
+    """Answer a conditional request for a file's content without reading it
+    
+    Returns:
+        304 response if the client's copy (If-None-Match or
+        If-Modified-Since) is current, otherwise None
+    """
+    if not (request.if_none_match or request.if_modified_since):
+        return None
+    if is_resource_modified(request.environ, etag=file_etag(file), last_modified=file.updated_at):
+        return None
+    return set_cache_headers(Response(status=304), file)
+
+def get_range_request(file, length):
+    """Work out which single byte range of a file the client asked for
+    
+    Args:
+        file: File record being served
+        length: Plaintext length of the file
+        
+    Returns:
+        Tuple of (start, stop), None to send the whole file, or False if
+        the range cannot be satisfied
+    """
+    byte_range = request.range
+    if byte_range is None or byte_range.units != 'bytes' or len(byte_range.ranges) != 1:
+        return None
+    
+    # If-Range only applies the range when the file is unchanged
+    if_range = request.if_range
+    if if_range.etag:
+        if if_range.etag != file_etag(file):
+            return None
+    elif if_range.date:
+        if file.updated_at.replace(microsecond=0) > if_range.date.replace(tzinfo=None):
+            return None
+    
+    return byte_range.range_for_length(length) or False
+
+def cached_plaintext(file):
+    """Get the decrypted content of a small encrypted file from the plaintext cache
+    
+    On a miss the whole file is decrypted into memory and cached, if the
+    cache is enabled and the file is small enough for it.
+    
+    Returns:
+        The plaintext, or None if the file is not cached
+    """
+    if not (file.is_encrypted or file.codec) or not plaintext_cache.accepts(file.file_size or 0):
+        return None
+    
+    data = plaintext_cache.get(file.id, file.updated_at)
+    if data is None:
+        data = b''.join(iter_plaintext(file))
+        plaintext_cache.put(file.id, file.updated_at, data)
+    return data
+
+def iter_bytes(data, chunk_size=64 * 1024):
+    """Yield a byte string in chunks, copying only one chunk at a time"""
+    view = memoryview(data)
+    for offset in range(0, len(view), chunk_size):
+        yield bytes(view[offset:offset + chunk_size])
+
+def stream_decrypted_file(file, as_attachment):
+    """Stream the plaintext of an encrypted or remotely stored file as a response
+    
+    Files in the segmented format support single byte-range requests: only
+    the encrypted chunks overlapping the range are read and decrypted.
+    Unencrypted files in a remote backend are read from the range's offset.
+    Compressed files decompress only the frames overlapping the range.
+    Small encrypted files are served from the plaintext cache when enabled.
     
     Args:
-        input_file_path: Path to the file to encrypt
+        file: File record to stream
+        as_attachment: Whether to send the file as a download
         
     Returns:
-        Success status
+        Response streaming the plaintext, or None if decryption failed
     """
+    mimetype = (mimetypes.guess_type(file.original_filename)[0] or file.file_type
+                or 'application/octet-stream')
+    status = 200
+    length = byte_range = None
+    
     try:
-        # Read the file
-        with open(input_file_path, 'rb') as f:
-            data = f.read()
+        plaintext = cached_plaintext(file)
+        if plaintext is not None:
+            length = len(plaintext)
+            byte_range = get_range_request(file, length)
+        elif file.codec:
+            length = file.file_size
+            byte_range = get_range_request(file, length)
+        elif not file.is_encrypted:
+            length = file_storage(file).size(file.file_path)
+            byte_range = get_range_request(file, length)
+        elif file.encryption_version == SEGMENTED_AES_GCM:
+            ciphertext_size, length = segmented_sizes(file)
+            byte_range = get_range_request(file, length)
         
-        # Encrypt the data
-        fernet = get_encryption_key()
-        encrypted_data = fernet.encrypt(data)
+        if byte_range is False:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f'bytes */{length}'
+            response.accept_ranges = 'bytes'
+            return response
         
-        # Write the encrypted data back to the file
-        with open(input_file_path, 'wb') as f:
-            f.write(encrypted_data)
-            
-        return True
+        if byte_range:
+            start, stop = byte_range
+            if plaintext is not None:
+                chunks = iter_bytes(memoryview(plaintext)[start:stop])
+            elif file.codec:
+                chunks = iter_compressed_range(file, start, stop)
+            elif file.is_encrypted:
+                chunks = iter_decrypted_range(file, ciphertext_size, start, stop)
+            else:
+                chunks = file_storage(file).iter_range(file.file_path, start, stop)
+            status = 206
+        elif plaintext is not None:
+            chunks = iter_bytes(plaintext)
+        else:
+            chunks = iter_plaintext(file)
+        
+        # Decrypt the first chunk before responding so errors can still be reported
+        first_chunk = next(chunks, b'')
     except Exception as e:
-        print(f"Encryption error: {e}")
-        return False
+        print(f"Decryption error: {e}")
+        return None
+    
+    response = Response(itertools.chain([first_chunk], chunks), status=status,
+                        mimetype=mimetype, direct_passthrough=True)
+    response.headers['Content-Disposition'] = content_disposition(
+        'attachment' if as_attachment else 'inline', file.original_filename)
+    
+    if length is not None:
+        response.accept_ranges = 'bytes'
+        if byte_range:
+            response.content_range = ContentRange('bytes', start, stop, length)
+            response.content_length = stop - start
+        else:
+            response.content_length = length
+    
+    return response
 
-def decrypt_file(input_file_path, output_file_path=None):
-    """Decrypt a file using Fernet symmetric encryption
+def offload_stored_file(file, file_path, as_attachment):
+    """Let the web server in front of the application send a plain local file
+    
+    With SENDFILE_MODE set, the response only carries an X-Sendfile
+    (Apache mod_xsendfile, lighttpd) or X-Accel-Redirect (nginx) header and
+    the web server sends the bytes itself, handling ranges and slow clients
+    without holding a worker. X-Accel-Redirect needs an internal location
+    mapping SENDFILE_ACCEL_PREFIX to UPLOAD_FOLDER, so it is only used for
+    files in the local backend.
     
     Args:
-        input_file_path: Path to the encrypted file
-        output_file_path: Optional path where to write the decrypted file
-                          If None, a temp file will be created
+        file: File record to send
+        file_path: Path of the file on the local file system
+        as_attachment: Whether to send the file as a download
         
     Returns:
-        Path to the decrypted file (could be a temp file)
+        Response for the web server, or None if the file cannot be offloaded
     """
-    try:
-        # Read the encrypted file
-        with open(input_file_path, 'rb') as f:
-            encrypted_data = f.read()
-        
-        # Decrypt the data
-        fernet = get_encryption_key()
-        decrypted_data = fernet.decrypt(encrypted_data)
-        
-        # If no output path provided, create a temporary file
-        if not output_file_path:
-            temp_file = tempfile.NamedTemporaryFile(delete=False)
-            output_file_path = temp_file.name
-            temp_file.close()
-        
-        # Write the decrypted data
-        with open(output_file_path, 'wb') as f:
-            f.write(decrypted_data)
-            
-        return output_file_path
-    except Exception as e:
-        print(f"Decryption error: {e}")
+    mode = app.config['SENDFILE_MODE']
+    if mode == 'x-accel-redirect' and (file.storage or LOCAL) == LOCAL:
+        header = ('X-Accel-Redirect',
+                  app.config['SENDFILE_ACCEL_PREFIX'].rstrip('/') + '/' + url_quote(file.file_path))
+    elif mode == 'x-sendfile':
+        header = ('X-Sendfile', file_path)
+    else:
         return None
+    
+    mimetype = (mimetypes.guess_type(file.original_filename)[0] or file.file_type
+                or 'application/octet-stream')
+    response = Response(mimetype=mimetype)
+    response.headers[header[0]] = header[1]
+    response.headers['Content-Disposition'] = content_disposition(
+        'attachment' if as_attachment else 'inline', file.original_filename)
+    return response
 
-def save_file(file, owner, encrypt=True):
-    # Generate a secure filename
-    original_filename = secure_filename(file.filename)
-    random_hex = secrets.token_hex(8)
-    filename = f"{random_hex}_{original_filename}"
-    file_path = filename
+def send_stored_file(file, as_attachment):
+    """Send a stored file's content, decrypting it if needed
+    
+    Plain files on the local file system are handed to the web server when
+    SENDFILE_MODE is set; everything else is streamed by the application.
+    Range requests are honoured for both plain and encrypted files, and
+    every response carries the file's ETag and cache policy.
+    
+    Args:
+        file: File record to send
+        as_attachment: Whether to send the file as a download
+        
+    Returns:
+        Response, or None if the file could not be decrypted
+    """
+    stored_as_is = not (file.is_encrypted or file.codec)
+    file_path = file_storage(file).local_path(file.file_path) if stored_as_is else None
+    if file_path is None:
+        response = stream_decrypted_file(file, as_attachment)
+    else:
+        response = offload_stored_file(file, file_path, as_attachment)
+        if response is None:
+            response = send_file(file_path,
+                                 as_attachment=as_attachment,
+                                 download_name=file.original_filename,
+                                 conditional=True,
+                                 etag=file_etag(file),
+                                 last_modified=file.updated_at)
+    
+    if response is not None:
+        set_cache_headers(response, file)
+    return response
+
+def archive_name(name):
+    """Make a file or folder name safe to use as one component of a path in an archive"""
+    name = name.replace('/', '_').replace('\\', '_').strip()
+    return '_' if name in ('', '.', '..') else name
+
+def archive_members(folders, files):
+    """Describe the contents of a ZIP download as archive members
+    
+    Single files go to the top of the archive, each folder into a directory
+    of its own with its whole subtree. Folder contents are read from the
+    database in batches while the archive is being written, and file
+    contents are decrypted on the fly.
+    
+    Args:
+        folders: Folders to include with everything below them
+        files: Files to include on their own
+        
+    Yields:
+        ArchiveMember for every directory and file
+    """
+    used = set()
+    
+    def unique(path):
+        # Files with the same name in one folder get a numbered suffix
+        stem, extension = os.path.splitext(path)
+        candidate, number = path, 2
+        while candidate in used:
+            candidate, number = f'{stem} ({number}){extension}', number + 1
+        used.add(candidate)
+        return candidate
+    
+    def member(name, file):
+        return ArchiveMember(name, file.updated_at, file.file_size, file.file_type,
+                             lambda: iter_plaintext(file))
+    
+    for file in files:
+        yield member(unique(archive_name(file.original_filename)), file)
+    
+    for folder in folders:
+        directories = {folder.id: unique(archive_name(folder.name))}
+        yield ArchiveMember(directories[folder.id] + '/', folder.updated_at)
+        
+        # Parents have shorter paths than their children, so they come first
+        subfolders = db.session.query(Folder.id, Folder.parent_id, Folder.name, Folder.updated_at).filter(
+            Folder.path_startswith(folder.subtree_prefix)
+        ).order_by(func.length(Folder.path), Folder.id)
+        for folder_id, parent_id, name, updated_at in subfolders:
+            directories[folder_id] = unique(f'{directories[parent_id]}/{archive_name(name)}')
+            yield ArchiveMember(directories[folder_id] + '/', updated_at)
+        
+        files_below = File.query.filter(
+            File.folder_id.in_(subtree_folder_ids(folder)),
+            File.is_trashed == False,
+            File.status == 'ready'
+        ).order_by(File.folder_id, File.id).yield_per(500)
+        for file in files_below:
+            name = f'{directories[file.folder_id]}/{archive_name(file.original_filename)}'
+            yield member(unique(name), file)
+
+def send_archive(download_name, folders, files):
+    """Stream a ZIP of folders and files as a chunked download"""
+    for folder in folders:
+        ensure_folder_path(folder)
+    
+    response = Response(stream_with_context(stream_zip(archive_members(folders, files))),
+                        mimetype='application/zip')
+    response.headers['Content-Disposition'] = content_disposition('attachment', download_name)
+    return response
+
+def get_preview_type(filename):
+    """Classify a file for preview purposes from its extension"""
+    file_extension = os.path.splitext(filename)[1].lower()
     
-    # Save the file
-    file_location = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(file_location)
+    if file_extension in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
+        return 'image'
+    elif file_extension == '.pdf':
+        return 'pdf'
+    elif file_extension in ['.mp4', '.webm', '.ogg', '.mov', '.avi', '.mkv']:
+        return 'video'
+    elif file_extension in ['.txt', '.md', '.py', '.js', '.html', '.css', '.json', '.xml', '.csv']:
+        return 'text'
+    return 'binary'
+
+class QuotaExceededError(Exception):
+    """Raised when an upload would take a user over their storage limit"""
+
+class UploadIntegrityError(Exception):
+    """Raised when uploaded content does not match its declared checksum"""
+
+def choose_codec(filename, content_type=None):
+    """Pick the compression codec for new content, or None to store it as it is
     
-    # Encrypt the file if requested
-    is_encrypted = False
-    if encrypt:
-        is_encrypted = encrypt_file(file_location)
+    Text and other compressible types use COMPRESSION_CODEC (zlib if zstd
+    is configured but zstandard is missing); media and archives, which are
+    already compressed, are stored as they are.
+    """
+    codec = app.config['COMPRESSION_CODEC']
+    if not codec or codec == 'none':
+        return None
+    if not is_compressible(filename, get_preview_type(filename), content_type):
+        return None
+    return codec if codec_available(codec) else ZLIB
+
+class UploadWriter:
+    """Hash, quota-check, compress and encrypt upload data as it is written
     
-    # Get file size
-    file_size = os.path.getsize(file_location)
+    Data goes to a temporary file in the upload folder which the caller
+    atomically renames into place, so plaintext never touches the disk when
+    encryption is on and partial uploads never appear under a real name.
     
-    # Update user's storage usage
-    owner.storage_used += file_size
+    Args:
+        owner: User the upload is charged to
+        encrypt: Whether to encrypt the file
+        codec: Optional compression codec applied before encryption
+    """
     
-    # Create file record
+    def __init__(self, owner, encrypt=True, codec=None):
+        self.codec = codec
+        self.size = 0
+        self.remaining = owner.storage_limit - owner.storage_used
+        self.hasher = hashlib.sha256()
+        self.compressor = FrameCompressor(codec) if codec else None
+        self.encryptor = StreamEncryptor(get_master_key(), app.config['ENCRYPTION_CHUNK_SIZE']) if encrypt else None
+        fd, self.temp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], prefix='.upload-')
+        self.out = os.fdopen(fd, 'wb')
+        if self.encryptor:
+            self.out.write(self.encryptor.header)
+    
+    def write(self, data):
+        """Add a piece of the upload
+        
+        Raises:
+            QuotaExceededError: If the upload grows larger than the owner's free space
+        """
+        self.size += len(data)
+        if self.size > self.remaining:
+            raise QuotaExceededError('Not enough storage space.')
+        self.hasher.update(data)
+        if self.compressor:
+            data = self.compressor.update(data)
+        if self.encryptor:
+            data = self.encryptor.update(data)
+        self.out.write(data)
+    
+    def finish(self, expected_hash=None):
+        """Write the end of the upload and close the temporary file
+        
+        Returns:
+            Tuple of (temporary path, plaintext size, SHA-256 hex digest of the plaintext)
+            
+        Raises:
+            UploadIntegrityError: If the content does not match expected_hash
+        """
+        tail = self.compressor.finalize() if self.compressor else b''
+        if self.encryptor:
+            tail = self.encryptor.update(tail) + self.encryptor.finalize()
+        self.out.write(tail)
+        self.out.close()
+        if expected_hash and self.hasher.hexdigest() != expected_hash:
+            raise UploadIntegrityError('Uploaded content does not match its checksum.')
+        return self.temp_path, self.size, self.hasher.hexdigest()
+    
+    def discard(self):
+        """Close and remove the temporary file"""
+        self.out.close()
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
+
+def write_upload_stream(stream, owner, encrypt=True, expected_hash=None, codec=None):
+    """Write an incoming stream to a temporary file in a single pass
+    
+    The stream is read in chunks; each chunk is hashed, counted against the
+    owner's remaining quota and (optionally) compressed and encrypted before
+    it is written (see UploadWriter).
+    
+    Args:
+        stream: Readable binary stream with the file content
+        owner: User the upload is charged to
+        encrypt: Whether to encrypt the file
+        expected_hash: Optional SHA-256 hex digest the content must match
+        codec: Optional compression codec applied before encryption
+        
+    Returns:
+        Tuple of (temporary path, plaintext size, SHA-256 hex digest of the plaintext)
+        
+    Raises:
+        QuotaExceededError: If the stream is larger than the owner's free space
+        UploadIntegrityError: If the content does not match expected_hash
+    """
+    chunk_size = app.config['ENCRYPTION_CHUNK_SIZE']
+    writer = UploadWriter(owner, encrypt, codec)
+    try:
+        while True:
+            data = stream.read(chunk_size)
+            if not data:
+                break
+            writer.write(data)
+        return writer.finish(expected_hash)
+    except BaseException:
+        writer.discard()
+        raise
+
+class ParsedUploadStream:
+    """Receives a file part of an /upload request while the form is parsed
+    
+    Werkzeug's form parser writes each file part into a stream of its own
+    choosing, by default a temporary file that spills to disk past 500 KB.
+    For uploads this stream takes its place and feeds the part straight into
+    an UploadWriter, so the plaintext is hashed, compressed and encrypted on
+    its way in and never lands in the system's temporary directory. Errors
+    are kept until save_file() collects the result; a part that is never
+    collected is removed when the request closes.
+    """
+    
+    def __init__(self, writer):
+        self.writer = writer
+        self.error = None
+        self.collected = False
+    
+    def write(self, data):
+        if self.error is None:
+            try:
+                self.writer.write(data)
+            except Exception as e:
+                self.error = e
+                self.writer.discard()
+        return len(data)
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        return 0  # The parser rewinds every file part once it is complete
+    
+    def read(self, size=-1):
+        raise io.UnsupportedOperation('Upload content was encrypted as it arrived')
+    
+    def finish(self, expected_hash=None):
+        """Get the written upload, see UploadWriter.finish()"""
+        self.collected = True
+        if self.error is not None:
+            raise self.error
+        try:
+            return self.writer.finish(expected_hash)
+        except BaseException:
+            self.writer.discard()
+            raise
+    
+    def close(self):
+        if not self.collected:
+            self.collected = True
+            if self.error is None:
+                self.writer.discard()
+
+class DriveRequest(Request):
+    """Request that runs files posted to /upload through the storage pipeline as they are parsed"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        if self.endpoint == 'upload_file' and filename and current_user.is_authenticated:
+            original_filename = secure_filename(filename)
+            if original_filename:
+                codec = choose_codec(original_filename, content_type)
+                return ParsedUploadStream(UploadWriter(current_user, True, codec))
+        return super()._get_file_stream(total_content_length, content_type, filename,
+                                        content_length)
+
+app.request_class = DriveRequest
+
+def owner_has_blob(owner_id, blob_id, exclude_file_id=None):
+    """Check whether a user already owns a file backed by the given blob"""
+    query = File.query.filter(File.owner_id == owner_id, File.blob_id == blob_id)
+    if exclude_file_id is not None:
+        query = query.filter(File.id != exclude_file_id)
+    return db.session.query(query.exists()).scalar()
+
+def attach_blob(file, blob, owner):
+    """Point a File record at a blob and charge it to its owner
+    
+    Args:
+        file: File record to update
+        blob: Blob holding the file content (already referenced for this file)
+        owner: User who owns the file
+    """
+    # Update user's storage usage, charging each distinct blob once per owner
+    if not owner_has_blob(owner.id, blob.id, exclude_file_id=file.id):
+        owner.storage_used += blob.size
+    
+    file.file_size = blob.size
+    file.file_path = blob.file_path
+    file.storage = blob.storage
+    file.blob_id = blob.id
+    file.content_hash = blob.sha256
+    file.is_encrypted = blob.is_encrypted
+    file.encryption_version = blob.encryption_version
+    file.codec = blob.codec
+
+def build_file_record(blob, original_filename, content_type, owner):
+    """Create a File record backed by a blob and charge it to its owner
+    
+    Args:
+        blob: Blob holding the file content (already referenced for this file)
+        original_filename: Sanitised name shown to the user
+        content_type: MIME type reported by the client
+        owner: User who owns the file
+        
+    Returns:
+        Created File object (not yet added to the session)
+    """
+    random_hex = secrets.token_hex(8)
     new_file = File(
-        filename=filename,
+        filename=f"{random_hex}_{original_filename}",
         original_filename=original_filename,
-        file_type=file.content_type if hasattr(file, 'content_type') else '',
-        file_size=file_size,
-        file_path=file_path,
-        is_encrypted=is_encrypted,
+        file_type=content_type or '',
         owner_id=owner.id
     )
-    
+    attach_blob(new_file, blob, owner)
     return new_file
 
+def save_file(file, owner, encrypt=True, expected_hash=None):
+    """Store an uploaded file and build its File record
+    
+    Args:
+        file: Uploaded file object
+        owner: User who owns the file
+        encrypt: Whether to encrypt the file
+        expected_hash: Optional SHA-256 hex digest the content must match
+        
+    Returns:
+        Created File object (not yet added to the session)
+        
+    Raises:
+        QuotaExceededError: If the file does not fit in the owner's quota
+        UploadIntegrityError: If the content does not match expected_hash
+    """
+    # Generate a secure filename
+    original_filename = secure_filename(file.filename)
+    
+    content_type = file.content_type if hasattr(file, 'content_type') else ''
+    if encrypt and isinstance(file.stream, ParsedUploadStream):
+        # Already hashed, compressed and encrypted while the request was parsed
+        codec = file.stream.writer.codec
+        temp_path, file_size, content_hash = file.stream.finish(expected_hash)
+    else:
+        # Stream, hash, compress, encrypt and write the file in one pass
+        codec = choose_codec(original_filename, content_type)
+        temp_path, file_size, content_hash = write_upload_stream(file.stream, owner, encrypt,
+                                                                 expected_hash, codec)
+    
+    # Identical content is stored once and shared through a blob
+    blob, _ = store_blob(temp_path, file_size, content_hash,
+                         SEGMENTED_AES_GCM if encrypt else None, codec)
+    
+    return build_file_record(blob, original_filename, content_type, owner)
+
+def create_folder_record(name, owner_id, parent=None):
+    """Create a Folder with its materialized path (not yet added to the session)"""
+    if parent is not None:
+        ensure_folder_path(parent)
+    folder = Folder(name=name, owner_id=owner_id)
+    folder.set_parent(parent)
+    return folder
+
+def rebuild_folder_paths(owner_id=None):
+    """Recompute materialized folder paths from the parent links
+    
+    Needed once for folders created before paths were stored.
+    
+    Args:
+        owner_id: Only rebuild this user's folders (all users if None)
+        
+    Returns:
+        Number of folders updated
+    """
+    query = db.session.query(Folder.id, Folder.parent_id)
+    if owner_id is not None:
+        query = query.filter(Folder.owner_id == owner_id)
+    
+    children = defaultdict(list)
+    for folder_id, parent_id in query.all():
+        children[parent_id].append(folder_id)
+    
+    paths = {}
+    pending = [(folder_id, '/') for folder_id in children[None]]
+    while pending:
+        folder_id, path = pending.pop()
+        paths[folder_id] = path
+        pending.extend((child_id, f'{path}{folder_id}/') for child_id in children[folder_id])
+    
+    db.session.bulk_update_mappings(Folder, [{'id': folder_id, 'path': path}
+                                             for folder_id, path in paths.items()])
+    db.session.commit()
+    return len(paths)
+
+def ensure_folder_path(folder):
+    """Make sure a folder (and its owner's tree) has materialized paths"""
+    if folder.path is None:
+        rebuild_folder_paths(folder.owner_id)
+        db.session.refresh(folder)
+
+def subtree_folder_ids(folder):
+    """Select the ids of a folder and every folder below it"""
+    return select(Folder.id).where(or_(Folder.id == folder.id,
+                                       Folder.path_startswith(folder.subtree_prefix)))
+
+def get_subtree_size(folder):
+    """Total size of the non-trashed files in a folder and all its subfolders"""
+    return db.session.query(func.coalesce(func.sum(File.file_size), 0)).filter(
+        File.folder_id.in_(subtree_folder_ids(folder)),
+        File.is_trashed == False
+    ).scalar()
+
+def move_folder(folder, new_parent):
+    """Move a folder under a new parent, rewriting the paths of its whole subtree
+    
+    Raises:
+        ValueError: If the move would create a cycle or moves a root folder
+    """
+    ensure_folder_path(folder)
+    ensure_folder_path(new_parent)
+    
+    if folder.parent_id is None:
+        raise ValueError('The root folder cannot be moved.')
+    if new_parent.id == folder.id or new_parent.path.startswith(folder.subtree_prefix):
+        raise ValueError('A folder cannot be moved into itself.')
+    
+    old_prefix = folder.subtree_prefix
+    folder.set_parent(new_parent)
+    new_prefix = folder.subtree_prefix
+    
+    Folder.query.filter(Folder.path_startswith(old_prefix)).update(
+        {Folder.path: literal(new_prefix, db.String) + func.substr(Folder.path, len(old_prefix) + 1)},
+        synchronize_session=False)
+
+def adjust_user_counters(user_id, **deltas):
+    """Change a user's cached counters with a single UPDATE in the current session
+    
+    Args:
+        user_id: ID of the user
+        **deltas: Amount to add per counter, e.g. file_count=1
+    """
+    values = {getattr(User, name): getattr(User, name) + delta
+              for name, delta in deltas.items() if delta}
+    if values:
+        User.query.filter(User.id == user_id).update(values, synchronize_session=False)
+        user_cache.invalidate_on_commit(user_id)
+
+def adjust_shared_counts(file_condition, sign):
+    """Add (sign=1) or remove (sign=-1) the shares of some files from their recipients' shared_count
+    
+    Args:
+        file_condition: SQL condition on File selecting the files
+        sign: 1 or -1
+    """
+    selected = select(File.id).where(file_condition)
+    recipient_ids = [user_id for (user_id,) in db.session.execute(
+        select(shares.c.user_id).where(shares.c.file_id.in_(selected)).distinct())]
+    if not recipient_ids:
+        return
+    
+    per_user = select(func.count()).select_from(shares).where(
+        shares.c.user_id == User.id, shares.c.file_id.in_(selected)).scalar_subquery()
+    User.query.filter(User.id.in_(recipient_ids)).update(
+        {User.shared_count: User.shared_count + sign * per_user}, synchronize_session=False)
+    user_cache.invalidate_on_commit(*recipient_ids)
+
+def remove_folder_shares(folder_ids):
+    """Delete the shares of some folders and take them out of the recipients' shared_count
+    
+    Args:
+        folder_ids: Select of the ids of the folders
+    """
+    per_user = db.session.execute(select(folder_shares.c.user_id, func.count()).where(
+        folder_shares.c.folder_id.in_(folder_ids)).group_by(folder_shares.c.user_id)).all()
+    for user_id, count in per_user:
+        adjust_user_counters(user_id, shared_count=-count)
+    if per_user:
+        db.session.execute(folder_shares.delete().where(folder_shares.c.folder_id.in_(folder_ids)))
+
+def rebuild_user_counters():
+    """Recompute every user's cached counters from the file and share tables"""
+    def count(*conditions):
+        return select(func.count(File.id)).where(*conditions).scalar_subquery()
+    
+    shared = select(func.count()).select_from(shares.join(File, File.id == shares.c.file_id)).where(
+        shares.c.user_id == User.id, File.is_trashed == False).scalar_subquery()
+    shared_folders = select(func.count()).select_from(folder_shares).where(
+        folder_shares.c.user_id == User.id).scalar_subquery()
+    User.query.update({
+        User.file_count: count(File.owner_id == User.id, File.is_trashed == False),
+        User.starred_count: count(File.owner_id == User.id, File.is_trashed == False,
+                                  File.is_starred == True),
+        User.trashed_count: count(File.owner_id == User.id, File.is_trashed == True),
+        User.shared_count: shared + shared_folders
+    }, synchronize_session=False)
+    db.session.commit()
+    user_cache.clear()
+
+def purge_files(owner, condition):
+    """Permanently delete a set of the owner's files with set-based statements
+    
+    Blob references are released and the owner's storage usage is reduced by
+    the space that is actually freed for them. Physical cleanup has to happen
+    after the transaction commits, using the returned values.
+    
+    Args:
+        owner: User owning the files
+        condition: SQL condition on File selecting the files to delete
+        
+    Returns:
+        Tuple of (blob ids to garbage collect, paths of unshared legacy files to unlink)
+    """
+    selected = select(File.id).where(File.owner_id == owner.id, condition)
+    
+    blob_ids = [blob_id for (blob_id,) in db.session.query(File.blob_id).filter(
+        File.owner_id == owner.id, condition, File.blob_id != None).distinct()]
+    # Resumable uploads that are still processing or failed were never charged
+    legacy_files = db.session.query(File.file_path, File.file_size).filter(
+        File.owner_id == owner.id, condition, File.blob_id == None,
+        File.status == 'ready').all()
+    
+    # Blobs the owner still has another copy of stay charged
+    freed = sum(size or 0 for _, size in legacy_files)
+    if blob_ids:
+        kept = select(File.blob_id).where(File.owner_id == owner.id,
+                                          File.blob_id.in_(blob_ids),
+                                          File.id.notin_(selected))
+        freed += db.session.query(func.coalesce(func.sum(Blob.size), 0)).filter(
+            Blob.id.in_(blob_ids), Blob.id.notin_(kept)).scalar()
+        
+        # Drop one blob reference per deleted file
+        released = select(func.count(File.id)).where(
+            File.blob_id == Blob.id, File.id.in_(selected)).scalar_subquery()
+        Blob.query.filter(Blob.id.in_(blob_ids)).update(
+            {Blob.ref_count: Blob.ref_count - released}, synchronize_session=False)
+    
+    # Take the files out of the owner's and the recipients' counters
+    total, trashed, starred = db.session.query(
+        func.count(File.id),
+        func.coalesce(func.sum(case((File.is_trashed == True, 1), else_=0)), 0),
+        func.coalesce(func.sum(case((and_(File.is_starred == True, File.is_trashed == False), 1),
+                                    else_=0)), 0)
+    ).filter(File.owner_id == owner.id, condition).one()
+    adjust_user_counters(owner.id, file_count=trashed - total, trashed_count=-trashed,
+                         starred_count=-starred)
+    adjust_shared_counts(and_(File.id.in_(selected), File.is_trashed == False), -1)
+    
+    db.session.execute(shares.delete().where(shares.c.file_id.in_(selected)))
+    file_ids = [file_id for (file_id,) in db.session.execute(selected)]
+    unindex_items('file', file_ids)
+    plaintext_cache.invalidate(*file_ids)
+    remove_postings(ContentPosting.file_id.in_(selected))
+    File.query.filter(File.owner_id == owner.id, condition).delete(synchronize_session=False)
+    owner.storage_used -= freed
+    
+    # An empty path would name the backend's root
+    return blob_ids, [file_path for file_path, _ in legacy_files if file_path]
+
+def remove_purged_files(blob_ids, legacy_paths):
+    """Remove the data of purged files from disk once their deletion is committed
+    
+    Unreferenced blobs are deleted in batches; the files themselves are
+    unlinked on a background thread pool.
+    """
+    collect_garbage(blob_ids)
+    delete_files(storage.get(LOCAL), legacy_paths)
+
+def trash_files(owner, condition):
+    """Move a set of the owner's files to the trash with set-based statements
+    
+    Args:
+        owner: User owning the files
+        condition: SQL condition on File selecting the files
+        
+    Returns:
+        IDs of the files that were moved to the trash
+    """
+    condition = and_(File.owner_id == owner.id, File.is_trashed == False, condition)
+    rows = db.session.query(File.id, File.is_starred).filter(condition).all()
+    if not rows:
+        return []
+    
+    file_ids = [file_id for file_id, _ in rows]
+    starred = sum(1 for _, is_starred in rows if is_starred)
+    adjust_user_counters(owner.id, file_count=-len(rows), trashed_count=len(rows),
+                         starred_count=-starred)
+    adjust_shared_counts(condition, -1)
+    unindex_items('file', file_ids)
+    plaintext_cache.invalidate(*file_ids)
+    File.query.filter(condition).update({File.is_trashed: True}, synchronize_session=False)
+    return file_ids
+
+def restore_files(owner, condition):
+    """Restore a set of the owner's files from the trash with set-based statements
+    
+    Returns:
+        IDs of the files that were restored
+    """
+    condition = and_(File.owner_id == owner.id, File.is_trashed == True, condition)
+    rows = db.session.query(File.id, File.original_filename, File.is_starred).filter(condition).all()
+    if not rows:
+        return []
+    
+    starred = sum(1 for _, _, is_starred in rows if is_starred)
+    adjust_user_counters(owner.id, file_count=len(rows), trashed_count=-len(rows),
+                         starred_count=starred)
+    adjust_shared_counts(condition, 1)
+    index_files([(file_id, owner.id, name) for file_id, name, _ in rows])
+    File.query.filter(condition).update({File.is_trashed: False}, synchronize_session=False)
+    return [file_id for file_id, _, _ in rows]
+
+def star_files(owner, condition, starred=True):
+    """Star or unstar a set of the owner's files with one UPDATE
+    
+    Returns:
+        IDs of the files whose star changed
+    """
+    condition = and_(File.owner_id == owner.id, File.is_starred != starred, condition)
+    rows = db.session.query(File.id, File.is_trashed).filter(condition).all()
+    if not rows:
+        return []
+    
+    # Trashed files are not part of the starred count
+    changed = sum(1 for _, is_trashed in rows if not is_trashed)
+    adjust_user_counters(owner.id, starred_count=changed if starred else -changed)
+    File.query.filter(condition).update({File.is_starred: starred}, synchronize_session=False)
+    return [file_id for file_id, _ in rows]
+
+def move_files(owner, condition, folder):
+    """Move a set of the owner's files into one of their folders with one UPDATE
+    
+    Returns:
+        IDs of the files that were moved
+    """
+    condition = and_(File.owner_id == owner.id, File.folder_id != folder.id, condition)
+    file_ids = [file_id for (file_id,) in db.session.query(File.id).filter(condition)]
+    if file_ids:
+        File.query.filter(condition).update({File.folder_id: folder.id}, synchronize_session=False)
+    return file_ids
+
+def encode_cursor(values):
+    """Encode the sort key of the last row of a page as an opaque cursor"""
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, columns):
+    """Decode a cursor produced by encode_cursor for the given sort columns
+    
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError('Invalid cursor')
+        if not all(isinstance(value, (str, int, float)) for value in values):
+            raise ValueError('Invalid cursor')
+        return [datetime.fromisoformat(value) if isinstance(column.type, db.DateTime) else value
+                for value, column in zip(values, columns)]
+    except (ValueError, TypeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+def keyset_page(query, columns, cursor=None, limit=100, descending=False):
+    """Fetch one page of a query using keyset (cursor) pagination
+    
+    Rows are ordered by ``columns``, which must form a unique key (end with
+    the id). The page starts right after the row the cursor points at, so
+    the cost of a page does not depend on how deep into the listing it is.
+    
+    Args:
+        query: Query to paginate
+        columns: Sort columns, e.g. (File.original_filename, File.id)
+        cursor: Cursor returned with the previous page, or None for the first page
+        limit: Maximum number of rows in the page
+        descending: Sort in descending order
+        
+    Returns:
+        Tuple of (rows, cursor for the next page or None)
+        
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    if cursor:
+        values = decode_cursor(cursor, columns)
+        
+        # Lexicographic comparison: (a, b) > (x, y) <=> a > x OR (a = x AND b > y)
+        condition = None
+        for index in reversed(range(len(columns))):
+            column, value = columns[index], values[index]
+            after = column < value if descending else column > value
+            condition = after if condition is None else or_(after, and_(column == value, condition))
+        query = query.filter(condition)
+    
+    ordering = [column.desc() if descending else column.asc() for column in columns]
+    rows = query.order_by(*ordering).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor([getattr(last, column.key) for column in columns])
+
+def list_folder_files(folder, sort='name', cursor=None, limit=100):
+    """Get one page of the non-trashed files in a folder"""
+    query = File.query.filter_by(folder_id=folder.id, is_trashed=False)
+    if sort == 'updated':
+        return keyset_page(query, (File.updated_at, File.id), cursor, limit, descending=True)
+    return keyset_page(query, (File.original_filename, File.id), cursor, limit)
+
+def list_shared_files(user, cursor=None, limit=100):
+    """Get one page of the non-trashed files shared directly with a user, by name"""
+    query = File.query.join(shares).filter(
+        shares.c.user_id == user.id,
+        File.is_trashed == False
+    ).options(db.joinedload(File.owner))
+    return keyset_page(query, (File.original_filename, File.id), cursor, limit)
+
+def list_subfolders(folder, cursor=None, limit=100):
+    """Get one page of the subfolders of a folder, by name"""
+    return keyset_page(Folder.query.filter_by(parent_id=folder.id),
+                       (Folder.name, Folder.id), cursor, limit)
+
+def get_page_limit():
+    """Get the requested page size, bounded by the configured folder page size"""
+    limit = request.args.get('limit', app.config['FOLDER_PAGE_SIZE'], type=int)
+    return max(1, min(limit, app.config['FOLDER_PAGE_SIZE']))
+
 def get_breadcrumbs(folder):
-    """Generate breadcrumbs for navigation"""
-    breadcrumbs = []
-    current = folder
+    """Generate breadcrumbs for navigation
     
-    while current:
-        breadcrumbs.append(current)
-        current = current.parent
+    All ancestors are loaded in one query using the folder's materialized path.
+    """
+    ensure_folder_path(folder)
+    ancestor_ids = folder.ancestor_ids
+    ancestors = {}
+    if ancestor_ids:
+        ancestors = {f.id: f for f in Folder.query.filter(Folder.id.in_(ancestor_ids)).all()}
     
-    return reversed(breadcrumbs)
+    return [ancestors[folder_id] for folder_id in ancestor_ids if folder_id in ancestors] + [folder]
+
+def record_bulk_activity(user, action, file_ids):
+    """Record the same action on many files as one buffered batch"""
+    activity_log.record_many(user.id, action, file_ids)
 
 def record_activity(user, action, file=None, folder=None):
-    """Record user activity"""
-    activity = Activity(
-        user_id=user.id,
-        action=action,
+    """Record user activity
+    
+    The event is buffered and written in bulk by the activity log, so this
+    neither commits nor touches the current session.
+    """
+    activity_log.record(
+        user.id,
+        action,
         file_id=file.id if file else None,
         folder_id=folder.id if folder else None
     )
-    db.session.add(activity)
-    db.session.commit()
 
 # Routes
 @app.route('/')
@@ -185,8 +1239,10 @@ def register():
         db.session.commit()
         
         # Create root folder for the user
-        root_folder = Folder(name='My Drive', owner_id=user.id)
+        root_folder = create_folder_record('My Drive', user.id)
         db.session.add(root_folder)
+        db.session.flush()
+        index_folder(root_folder)
         db.session.commit()
         
         flash('Your account has been created! You can now log in.', 'success')
@@ -224,14 +1280,18 @@ def dashboard():
     
     # If root folder doesn't exist, create it
     if not root_folder:
-        root_folder = Folder(name='My Drive', owner_id=current_user.id)
+        root_folder = create_folder_record('My Drive', current_user.id)
         db.session.add(root_folder)
+        db.session.flush()
+        index_folder(root_folder)
         db.session.commit()
     
     # Get stats
-    total_files = File.query.filter_by(owner_id=current_user.id, is_trashed=False).count()
+    total_files = current_user.file_count or 0
     recent_files = File.query.filter_by(owner_id=current_user.id, is_trashed=False).order_by(File.updated_at.desc()).limit(5).all()
-    starred_files = File.query.filter_by(owner_id=current_user.id, is_starred=True, is_trashed=False).all()
+    starred_files = []
+    if current_user.starred_count:
+        starred_files = File.query.filter_by(owner_id=current_user.id, is_starred=True, is_trashed=False).order_by(File.updated_at.desc()).limit(10).all()
     
     # Calculate storage
     storage_used = current_user.storage_used
@@ -247,6 +1307,8 @@ def dashboard():
                          total_files=total_files,
                          recent_files=recent_files,
                          starred_files=starred_files,
+                         starred_count=current_user.starred_count or 0,
+                         trashed_count=current_user.trashed_count or 0,
                          storage_used=storage_used_display,
                          storage_limit=storage_limit_display,
                          storage_percent=storage_percent)
@@ -256,15 +1318,27 @@ def dashboard():
 def view_folder(folder_id):
     folder = Folder.query.get_or_404(folder_id)
     
-    # Check if user has permission to view the folder
-    if folder.owner_id != current_user.id:
+    # Check if user has permission to view the folder, directly or through a shared ancestor
+    permission = get_folder_permission(current_user, folder)
+    if permission is None:
         abort(403)
+    is_owner = permission == OWNER
     
-    files = File.query.filter_by(folder_id=folder_id, is_trashed=False).all()
-    subfolders = Folder.query.filter_by(parent_id=folder_id).all()
+    # Only the first page is rendered; the rest is loaded on scroll
+    sort = request.args.get('sort', 'name')
+    if sort not in ('name', 'updated'):
+        sort = 'name'
+    page_size = app.config['FOLDER_PAGE_SIZE']
+    files, files_cursor = list_folder_files(folder, sort, limit=page_size)
+    subfolders, folders_cursor = list_subfolders(folder, limit=page_size)
     
     # Get breadcrumbs for navigation
     breadcrumbs = get_breadcrumbs(folder)
+    if not is_owner:
+        # Recipients only see the path below the folder that was shared with them
+        root_id = get_shared_root_id(current_user, folder)
+        breadcrumbs = breadcrumbs[[crumb.id for crumb in breadcrumbs].index(root_id):]
+    folder_size = get_subtree_size(folder)
     
     # Forms
     upload_form = UploadFileForm()
@@ -273,60 +1347,588 @@ def view_folder(folder_id):
     # Set the current folder as parent_id for the create folder form
     folder_form.parent_id.data = folder.id
     
-    # Get all user's folders for upload dropdown
-    user_folders = Folder.query.filter_by(owner_id=current_user.id).all()
-    upload_folder_choices = [(f.id, f.name if f.id != folder.id else f'Current Folder ({f.name})') for f in user_folders]
-    upload_form.folder_id.choices = upload_folder_choices
+    # Other upload targets are loaded on demand by the folder picker
+    upload_form.folder_id.choices = [(folder.id, f'Current Folder ({folder.name})')]
     
     return render_template('folder.html', title=folder.name,
                          folder=folder,
                          files=files,
+                         files_cursor=files_cursor,
                          subfolders=subfolders,
+                         folders_cursor=folders_cursor,
+                         sort=sort,
+                         is_owner=is_owner,
                          breadcrumbs=breadcrumbs,
+                         folder_size=folder_size,
                          upload_form=upload_form,
                          folder_form=folder_form)
 
+@app.route('/api/folder/<int:folder_id>/entries')
+@login_required
+def folder_entries(folder_id):
+    folder = Folder.query.get_or_404(folder_id)
+    
+    # Check if user has permission to view the folder
+    permission = get_folder_permission(current_user, folder)
+    if permission is None:
+        abort(403)
+    is_owner = permission == OWNER
+    
+    kind = request.args.get('kind', 'files')
+    cursor = request.args.get('cursor')
+    limit = get_page_limit()
+    
+    try:
+        if kind == 'folders':
+            subfolders, next_cursor = list_subfolders(folder, cursor, limit)
+            items = [{'id': f.id, 'name': f.name} for f in subfolders]
+            html = render_template('_folder_rows.html', subfolders=subfolders, is_owner=is_owner)
+        else:
+            sort = request.args.get('sort', 'name')
+            files, next_cursor = list_folder_files(folder, sort, cursor, limit)
+            items = [{
+                'id': f.id,
+                'name': f.original_filename,
+                'size': f.file_size,
+                'updated_at': f.updated_at.isoformat(),
+                'starred': f.is_starred,
+                'status': f.status
+            } for f in files]
+            html = render_template('_file_rows.html', files=files, is_owner=is_owner)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({'items': items, 'next_cursor': next_cursor, 'html': html})
+
+@app.route('/api/folders')
+@login_required
+def folder_picker():
+    """Search the current user's folders, one page at a time, for folder pickers"""
+    query = Folder.query.filter(Folder.owner_id == current_user.id)
+    search = request.args.get('q', '').strip()
+    if search:
+        query = query.filter(Folder.name.ilike(f'%{search}%'))
+    
+    try:
+        folders, next_cursor = keyset_page(query, (Folder.name, Folder.id),
+                                           request.args.get('cursor'), get_page_limit())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Label each folder with its location, loading all ancestors in one query
+    ancestor_ids = {folder_id for f in folders for folder_id in f.ancestor_ids}
+    names = {}
+    if ancestor_ids:
+        names = dict(db.session.query(Folder.id, Folder.name).filter(Folder.id.in_(ancestor_ids)))
+    
+    return jsonify({
+        'items': [{
+            'id': f.id,
+            'name': f.name,
+            'path': ' / '.join([names[i] for i in f.ancestor_ids if i in names] + [f.name])
+        } for f in folders],
+        'next_cursor': next_cursor
+    })
+
 @app.route('/upload', methods=['POST'])
 @login_required
 def upload_file():
     form = UploadFileForm()
     folder_id = request.form.get('folder_id')
     
-    # Set choices before validation
-    if folder_id:
-        form.folder_id.choices = [(int(folder_id), 'Folder')]
+    # Set choices before validation
+    if folder_id:
+        form.folder_id.choices = [(int(folder_id), 'Folder')]
+    
+    # Validate form
+    if form.validate_on_submit():
+        folder_id = form.folder_id.data
+        folder = Folder.query.get_or_404(folder_id)
+        
+        # Check if user has permission to upload to this folder
+        if folder.owner_id != current_user.id:
+            abort(403)
+        
+        # Check if user has enough storage
+        file_size = request.content_length or 0
+        if current_user.storage_used + file_size > current_user.storage_limit:
+            flash('Not enough storage space.', 'danger')
+            return redirect(url_for('view_folder', folder_id=folder_id))
+        
+        # Save the file
+        file = form.file.data
+        try:
+            new_file = save_file(file, current_user)
+        except QuotaExceededError:
+            flash('Not enough storage space.', 'danger')
+            return redirect(url_for('view_folder', folder_id=folder_id))
+        new_file.folder_id = folder_id
+        
+        db.session.add(new_file)
+        db.session.flush()
+        index_file(new_file)
+        enqueue_content_index(new_file)
+        enqueue_derivatives(new_file)
+        adjust_user_counters(current_user.id, file_count=1)
+        db.session.commit()
+        
+        # Record activity
+        record_activity(current_user, 'upload', file=new_file)
+        
+        flash('File uploaded successfully!', 'success')
+        return redirect(url_for('view_folder', folder_id=folder_id))
+    
+    flash('Error uploading file.', 'danger')
+    return redirect(url_for('dashboard'))
+
+# Background jobs
+@job_queue.task('assemble_upload', on_failure=lambda session_id: fail_upload_session(session_id))
+def assemble_upload(session_id):
+    """Assemble a completed upload session into its File through the storage pipeline"""
+    upload = UploadSession.query.get(session_id)
+    if upload is None:
+        return  # Already assembled by an earlier attempt
+    
+    file = File.query.get(upload.file_id)
+    if file is None:
+        # The file was deleted before it was assembled
+        discard_upload_session(upload)
+        db.session.commit()
+        return
+    
+    owner = User.query.get(upload.owner_id)
+    directory = upload_session_dir(upload)
+    reader = ChunkSequenceReader(os.path.join(directory, str(index))
+                                 for index in range(upload.chunk_count))
+    codec = choose_codec(file.original_filename, file.file_type)
+    try:
+        temp_path, file_size, content_hash = write_upload_stream(reader, owner, True,
+                                                                 upload.sha256, codec)
+    except (QuotaExceededError, UploadIntegrityError) as e:
+        # Retrying cannot help; fail the file straight away
+        print(f"Upload {session_id} rejected: {e}")
+        fail_upload_session(session_id)
+        return
+    finally:
+        reader.close()
+    
+    blob, reused = store_blob(temp_path, file_size, content_hash, SEGMENTED_AES_GCM, codec)
+    
+    # Claim the session by deleting it; if a requeued copy of this job got
+    # there first, drop this copy's blob so the owner is only charged once
+    claimed = UploadSession.query.filter_by(id=session_id).delete(synchronize_session=False)
+    if not claimed:
+        backend_name, blob_path = blob.storage, blob.file_path
+        db.session.rollback()
+        if not reused:
+            delete_files(storage.get(backend_name), [blob_path])
+        return
+    
+    attach_blob(file, blob, owner)
+    file.status = 'ready'
+    enqueue_content_index(file)
+    enqueue_derivatives(file)
+    db.session.commit()
+    shutil.rmtree(directory, ignore_errors=True)
+
+def enqueue_content_index(file):
+    """Schedule content indexing for a text file (in the current session)"""
+    if get_preview_type(file.original_filename) == 'text':
+        job_queue.enqueue('index_content', file_id=file.id)
+
+@job_queue.task('index_content')
+def index_content(file_id):
+    """Build the content index entries of a file
+    
+    Files with the same content as an already indexed file reuse its
+    postings; files that are no longer text have their entries dropped.
+    """
+    file = File.query.get(file_id)
+    if file is None or file.status != 'ready':
+        return  # Deleted, or indexed once its upload is assembled
+    
+    if get_preview_type(file.original_filename) != 'text':
+        remove_postings(ContentPosting.file_id == file.id)
+    elif not copy_postings(file):
+        postings = tokenize(iter_plaintext(file), app.config['CONTENT_INDEX_MAX_BYTES'])
+        store_postings(file, postings)
+    db.session.commit()
+
+def enqueue_derivatives(file):
+    """Schedule thumbnail rendering for an image, PDF or video (in the current session)"""
+    if can_render(get_preview_type(file.original_filename)):
+        job_queue.enqueue_once('render_derivatives', file_id=file.id)
+
+@job_queue.task('render_derivatives')
+def render_file_derivatives(file_id):
+    """Render the thumbnail and preview renditions of a file into the derivative cache
+    
+    Encrypted or compressed content is streamed to the renderer, so its
+    plaintext never touches the disk; images decoded in memory are capped
+    at DERIVATIVE_MAX_IMAGE_BYTES. Content the renderer fails on gets empty
+    entries, so it is not scheduled again; read errors fail the job so it
+    is retried.
+    """
+    file = File.query.get(file_id)
+    if file is None or file.status != 'ready':
+        return
+    
+    preview_type = get_preview_type(file.original_filename)
+    key = file_etag(file)
+    sizes = {name: size for name, size in app.config['DERIVATIVE_SIZES'].items()
+             if not derivative_cache.has(key, name)}
+    if not sizes or not can_render(preview_type):
+        return
+    
+    if not (file.is_encrypted or file.codec):
+        source = file_storage(file).local_path(file.file_path)
+    else:
+        source = lambda: iter_plaintext(file)
+    
+    renditions = {}
+    if (callable(source) and preview_type == 'image' and
+            file.file_size > app.config['DERIVATIVE_MAX_IMAGE_BYTES']):
+        print(f"Derivative skipped for file {file_id}: image too large to decode in memory")
+    else:
+        try:
+            renditions = render_derivatives(preview_type, source, sizes)
+        except SourceReadError:
+            raise
+        except Exception as e:
+            print(f"Derivative error for file {file_id}: {e}")
+    
+    for name in sizes:
+        derivative_cache.put(key, name, renditions.get(name, b''))
+
+def read_text_page(file, offset):
+    """Read the page of a text file's plaintext starting at a byte offset
+    
+    Only the chunks under the page are decrypted (legacy Fernet files are
+    decrypted in full), so memory use is bounded by TEXT_PREVIEW_PAGE_BYTES.
+    
+    Returns:
+        Tuple of (page bytes, offset of the next page or None at the end)
+    """
+    return read_page(lambda start, stop: read_plaintext_range(file, start, stop), offset,
+                     app.config['TEXT_PREVIEW_PAGE_BYTES'])
+
+def get_line_index(file):
+    """Get the cached line index of a text file, or None if it is not built yet"""
+    data = derivative_cache.get(file_etag(file), 'lines')
+    return LineIndex.unpack(data) if data else None
+
+def build_file_line_index(file):
+    """Index the lines of a text file in one pass and cache the index"""
+    index = build_line_index(iter_plaintext(file), app.config['TEXT_PREVIEW_LINE_INTERVAL'])
+    derivative_cache.put(file_etag(file), 'lines', index.pack())
+    return index
+
+@job_queue.task('index_lines')
+def index_file_lines(file_id):
+    """Build the line index of a text file for the paged preview"""
+    file = File.query.get(file_id)
+    if file is None or file.status != 'ready':
+        return
+    if not derivative_cache.has(file_etag(file), 'lines'):
+        build_file_line_index(file)
+
+def content_snippet(file, offset):
+    """Get the text around a content match, or None if it cannot be read"""
+    start = max(offset - SNIPPET_BEFORE, 0)
+    try:
+        data = read_plaintext_range(file, start, offset + SNIPPET_AFTER)
+    except Exception as e:
+        print(f"Snippet error: {e}")
+        return None
+    
+    text = ' '.join(data.decode('utf-8', errors='ignore').split())
+    return ('…' if start > 0 else '') + text + '…'
+
+def fail_upload_session(session_id):
+    """Mark the file of an upload session as failed and drop the received chunks"""
+    upload = UploadSession.query.get(session_id)
+    if upload is None:
+        return
+    
+    File.query.filter_by(id=upload.file_id).update({File.status: 'failed'})
+    discard_upload_session(upload)
+    db.session.commit()
+
+# Resumable upload API
+class ChunkSequenceReader:
+    """Read the encrypted chunk files of an upload session as one continuous plaintext stream
+    
+    Each read returns the next decrypted piece of at most one encrypted
+    segment, whatever size is asked for. Opening each chunk file sends a
+    job heartbeat, so a long assembly is not requeued while it runs.
+    """
+    
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.current = None
+        self.pieces = iter(())
+    
+    def read(self, size=-1):
+        while True:
+            data = next(self.pieces, b'')
+            if data:
+                return data
+            self.close()
+            if not self.paths:
+                return b''
+            job_queue.heartbeat()
+            self.current = open(self.paths.pop(0), 'rb')
+            self.pieces = decrypt_chunks(get_master_key(), self.current)
+    
+    def close(self):
+        self.pieces = iter(())
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+def upload_session_dir(upload):
+    """Get the directory holding the received chunks of an upload session"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], '.sessions', upload.id)
+
+def received_chunks(upload):
+    """Get the set of chunk indexes received so far for an upload session"""
+    try:
+        names = os.listdir(upload_session_dir(upload))
+    except FileNotFoundError:
+        return set()
+    return {int(name) for name in names if name.isdigit()}
+
+def collapse_ranges(indexes):
+    """Collapse sorted integers into inclusive [first, last] ranges"""
+    ranges = []
+    for index in indexes:
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ranges
+
+def discard_upload_session(upload):
+    """Delete an upload session and its received chunks"""
+    shutil.rmtree(upload_session_dir(upload), ignore_errors=True)
+    db.session.delete(upload)
+
+def purge_expired_upload_sessions():
+    """Delete upload sessions that were never completed
+    
+    Completed sessions are left to their assemble_upload job, however long
+    it has been waiting in the queue.
+    """
+    expired = UploadSession.query.filter(UploadSession.expires_at < datetime.utcnow(),
+                                         UploadSession.file_id == None).all()
+    for upload in expired:
+        discard_upload_session(upload)
+    db.session.commit()
+
+def open_upload_bytes(owner_id):
+    """Get the total declared size of a user's upload sessions that still hold chunks"""
+    return db.session.query(func.coalesce(func.sum(UploadSession.total_size), 0)).filter(
+        UploadSession.owner_id == owner_id,
+        UploadSession.expires_at >= datetime.utcnow()
+    ).scalar()
+
+def get_upload_session_or_404(session_id, writable=False):
+    """Get an active upload session owned by the current user
+    
+    Args:
+        session_id: ID of the upload session
+        writable: Reject sessions that have already been completed
+    """
+    upload = UploadSession.query.get_or_404(session_id)
+    
+    # Check if user has permission to use this upload session
+    if upload.owner_id != current_user.id:
+        abort(403)
+    
+    if upload.expires_at < datetime.utcnow():
+        abort(404)
+    
+    if writable and upload.file_id is not None:
+        abort(409)
+    
+    return upload
+
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+def create_upload_session():
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(str(data.get('filename') or ''))
+    size = data.get('size')
+    folder_id = data.get('folder_id')
+    sha256 = data.get('sha256')
+    
+    if not filename or not isinstance(size, int) or size < 0 or not isinstance(folder_id, int):
+        return jsonify({'error': 'filename, size and folder_id are required.'}), 400
+    if sha256 is not None and not re.fullmatch(r'[0-9a-f]{64}', str(sha256)):
+        return jsonify({'error': 'sha256 must be a lowercase hex SHA-256 digest.'}), 400
+    
+    folder = Folder.query.get_or_404(folder_id)
+    
+    # Check if user has permission to upload to this folder
+    if folder.owner_id != current_user.id:
+        abort(403)
+    
+    # Check if user has enough storage
+    if current_user.storage_used + size > current_user.storage_limit:
+        return jsonify({'error': 'Not enough storage space.'}), 413
+    
+    # Content the user already stores needs no transfer at all
+    if sha256:
+        blob = Blob.query.filter_by(sha256=sha256, size=size).first()
+        if blob and owner_has_blob(current_user.id, blob.id) and acquire_blob(blob.id):
+            new_file = build_file_record(blob, filename, data.get('content_type'), current_user)
+            new_file.folder_id = folder.id
+            db.session.add(new_file)
+            db.session.flush()
+            index_file(new_file)
+            enqueue_content_index(new_file)
+            enqueue_derivatives(new_file)
+            adjust_user_counters(current_user.id, file_count=1)
+            db.session.commit()
+            
+            record_activity(current_user, 'upload', file=new_file)
+            return jsonify({'complete': True, 'file_id': new_file.id}), 201
+    
+    # Chunks of open sessions take up space until they are assembled or expire
+    purge_expired_upload_sessions()
+    pending = open_upload_bytes(current_user.id)
+    if current_user.storage_used + pending + size > current_user.storage_limit:
+        return jsonify({'error': 'Not enough storage space for another upload in progress.'}), 413
+    if pending + size > app.config['UPLOAD_SESSIONS_MAX_BYTES']:
+        return jsonify({'error': 'Too many uploads in progress.'}), 413
+    
+    upload = UploadSession(
+        owner_id=current_user.id,
+        folder_id=folder.id,
+        filename=filename,
+        content_type=data.get('content_type'),
+        total_size=size,
+        chunk_size=app.config['UPLOAD_CHUNK_SIZE'],
+        sha256=sha256,
+        expires_at=datetime.utcnow() + timedelta(seconds=app.config['UPLOAD_SESSION_LIFETIME'])
+    )
+    db.session.add(upload)
+    db.session.commit()
+    os.makedirs(upload_session_dir(upload), exist_ok=True)
+    
+    return jsonify({
+        'complete': False,
+        'session_id': upload.id,
+        'chunk_size': upload.chunk_size,
+        'chunk_count': upload.chunk_count,
+        'expires_at': upload.expires_at.isoformat()
+    }), 201
+
+@app.route('/api/uploads/<session_id>', methods=['GET'])
+@login_required
+def upload_session_status(session_id):
+    upload = get_upload_session_or_404(session_id)
+    received = sorted(received_chunks(upload))
+    
+    return jsonify({
+        'session_id': upload.id,
+        'filename': upload.filename,
+        'size': upload.total_size,
+        'chunk_size': upload.chunk_size,
+        'chunk_count': upload.chunk_count,
+        'received': collapse_ranges(received),
+        'received_bytes': sum(upload.expected_chunk_size(index) for index in received),
+        'expires_at': upload.expires_at.isoformat(),
+        'file_id': upload.file_id
+    })
+
+@app.route('/api/uploads/<session_id>/chunks/<int:index>', methods=['PUT'])
+@login_required
+def upload_chunk(session_id, index):
+    upload = get_upload_session_or_404(session_id, writable=True)
+    
+    if index >= upload.chunk_count:
+        return jsonify({'error': 'Chunk index out of range.'}), 400
+    
+    # Write to a temporary name so a dropped connection never leaves a partial chunk
+    expected = upload.expected_chunk_size(index)
+    directory = upload_session_dir(upload)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.chunk-')
+    received = 0
+    
+    def request_chunks():
+        nonlocal received
+        while received <= expected:
+            data = request.stream.read(min(64 * 1024, expected + 1 - received))
+            if not data:
+                break
+            received += len(data)
+            yield data
+    
+    # Each chunk is encrypted on arrival, so no plaintext waits on disk for the rest
+    with os.fdopen(fd, 'wb') as out:
+        for data in encrypt_chunks(get_master_key(), request_chunks(),
+                                   app.config['ENCRYPTION_CHUNK_SIZE']):
+            out.write(data)
+    
+    if received != expected:
+        os.unlink(temp_path)
+        return jsonify({'error': f'Chunk {index} must be {expected} bytes.'}), 400
+    
+    os.replace(temp_path, os.path.join(directory, str(index)))
+    return jsonify({'index': index, 'size': received})
+
+@app.route('/api/uploads/<session_id>/complete', methods=['POST'])
+@login_required
+def complete_upload_session(session_id):
+    upload = get_upload_session_or_404(session_id, writable=True)
+    folder = Folder.query.get_or_404(upload.folder_id)
+    
+    # Check if user still has permission to upload to this folder
+    if folder.owner_id != current_user.id:
+        abort(403)
+    
+    received = received_chunks(upload)
+    missing = [index for index in range(upload.chunk_count) if index not in received]
+    if missing:
+        return jsonify({'error': 'Upload is incomplete.', 'missing': collapse_ranges(missing)}), 409
     
-    # Validate form
-    if form.validate_on_submit():
-        folder_id = form.folder_id.data
-        folder = Folder.query.get_or_404(folder_id)
-        
-        # Check if user has permission to upload to this folder
-        if folder.owner_id != current_user.id:
-            abort(403)
-        
-        # Check if user has enough storage
-        file_size = request.content_length
-        if current_user.storage_used + file_size > current_user.storage_limit:
-            flash('Not enough storage space.', 'danger')
-            return redirect(url_for('view_folder', folder_id=folder_id))
-        
-        # Save the file
-        file = form.file.data
-        new_file = save_file(file, current_user)
-        new_file.folder_id = folder_id
-        
-        db.session.add(new_file)
-        db.session.commit()
-        
-        # Record activity
-        record_activity(current_user, 'upload', file=new_file)
-        
-        flash('File uploaded successfully!', 'success')
-        return redirect(url_for('view_folder', folder_id=folder_id))
+    if current_user.storage_used + upload.total_size > current_user.storage_limit:
+        return jsonify({'error': 'Not enough storage space.'}), 413
     
-    flash('Error uploading file.', 'danger')
-    return redirect(url_for('dashboard'))
+    # Create the file now and assemble, hash and encrypt it in the background
+    original_filename = secure_filename(upload.filename)
+    new_file = File(
+        filename=f"{secrets.token_hex(8)}_{original_filename}",
+        original_filename=original_filename,
+        file_type=upload.content_type or '',
+        file_size=upload.total_size,
+        file_path='',
+        status='processing',
+        owner_id=current_user.id,
+        folder_id=upload.folder_id
+    )
+    db.session.add(new_file)
+    db.session.flush()
+    
+    upload.file_id = new_file.id
+    index_file(new_file)
+    adjust_user_counters(current_user.id, file_count=1)
+    job_queue.enqueue('assemble_upload', session_id=upload.id)
+    db.session.commit()
+    
+    # Record activity
+    record_activity(current_user, 'upload', file=new_file)
+    
+    return jsonify({'complete': True, 'file_id': new_file.id, 'status': new_file.status}), 202
+
+@app.route('/api/uploads/<session_id>', methods=['DELETE'])
+@login_required
+def cancel_upload_session(session_id):
+    upload = get_upload_session_or_404(session_id)
+    discard_upload_session(upload)
+    db.session.commit()
+    return '', 204
 
 @app.route('/create_folder/<int:parent_id>', methods=['POST'])
 @login_required
@@ -334,6 +1936,7 @@ def create_folder(parent_id):
     form = CreateFolderForm()
     
     # Always use the current folder as parent
+    form.parent_id.choices = [(parent_id, 'Folder')]
     form.parent_id.data = parent_id
     
     if form.validate_on_submit():
@@ -344,13 +1947,11 @@ def create_folder(parent_id):
         if parent_folder.owner_id != current_user.id:
             abort(403)
         
-        new_folder = Folder(
-            name=form.name.data,
-            owner_id=current_user.id,
-            parent_id=parent_id
-        )
+        new_folder = create_folder_record(form.name.data, current_user.id, parent_folder)
         
         db.session.add(new_folder)
+        db.session.flush()
+        index_folder(new_folder)
         db.session.commit()
         
         # Record activity
@@ -368,44 +1969,73 @@ def download_file(file_id):
     file = File.query.get_or_404(file_id)
     
     # Check if user has permission to download this file
-    is_owner = file.owner_id == current_user.id
-    is_shared = current_user in file.shared_with
-    
-    if not (is_owner or is_shared):
+    if not has_file_permission(current_user, file):
         abort(403)
     
+    # Files still being processed in the background have no content yet
+    if file.status != 'ready':
+        flash('This file is still being processed.' if file.status == 'processing'
+              else 'This file could not be processed.', 'warning')
+        return redirect(url_for('view_folder', folder_id=file.folder_id or 0))
+    
+    # Answer revalidations of a cached copy before touching the stored file
+    response = not_modified_response(file)
+    if response is not None:
+        return response
+    
     # Record activity
     record_activity(current_user, 'download', file=file)
     
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], file.file_path)
-    
-    # If the file is encrypted, decrypt it first
-    if file.is_encrypted:
-        # Create a temporary file for the decrypted content
-        decrypted_path = decrypt_file(file_path)
-        if decrypted_path:
-            # Send the decrypted file
-            response = send_file(decrypted_path, 
-                            as_attachment=True, 
-                            download_name=file.original_filename)
-            
-            # Schedule temp file for deletion after response is sent
-            @response.call_on_close
-            def cleanup():
-                try:
-                    os.unlink(decrypted_path)
-                except:
-                    pass
-                
-            return response
-        else:
-            flash('Error decrypting file.', 'danger')
-            return redirect(url_for('view_folder', folder_id=file.folder_id or 0))
+    response = send_stored_file(file, as_attachment=True)
+    if response is None:
+        flash('Error decrypting file.', 'danger')
+        return redirect(url_for('view_folder', folder_id=file.folder_id or 0))
+    
+    return response
+
+@app.route('/download_folder/<int:folder_id>')
+@login_required
+def download_folder(folder_id):
+    folder = Folder.query.get_or_404(folder_id)
+    
+    # Check if user has permission to download this folder
+    if get_folder_permission(current_user, folder) is None:
+        abort(403)
+    
+    # Record activity
+    record_activity(current_user, 'download_folder', folder=folder)
     
-    # If not encrypted, send directly
-    return send_file(file_path, 
-                   as_attachment=True, 
-                   download_name=file.original_filename)
+    return send_archive(f'{archive_name(folder.name)}.zip', [folder], [])
+
+@app.route('/download_zip')
+@login_required
+def download_zip():
+    """Download a selection of files and folders as one ZIP archive"""
+    file_ids = request.args.getlist('file_id', type=int)
+    folder_ids = request.args.getlist('folder_id', type=int)
+    if not file_ids and not folder_ids:
+        abort(400)
+    if len(file_ids) + len(folder_ids) > app.config['BULK_MAX_FILE_IDS']:
+        abort(400)
+    
+    files = File.query.filter(File.id.in_(file_ids), File.is_trashed == False,
+                              File.status == 'ready').order_by(File.id).all()
+    folders = Folder.query.filter(Folder.id.in_(folder_ids)).order_by(Folder.id).all()
+    if len(files) != len(set(file_ids)) or len(folders) != len(set(folder_ids)):
+        abort(404)
+    
+    # Check if user has permission to download everything selected
+    if not all(has_file_permission(current_user, file) for file in files):
+        abort(403)
+    if not all(get_folder_permission(current_user, folder) for folder in folders):
+        abort(403)
+    
+    # Record activity
+    record_bulk_activity(current_user, 'download', [file.id for file in files])
+    for folder in folders:
+        record_activity(current_user, 'download_folder', folder=folder)
+    
+    return send_archive('files.zip', folders, files)
 
 @app.route('/preview/<int:file_id>')
 @login_required
@@ -418,92 +2048,164 @@ def preview_file(file_id):
     file = File.query.get_or_404(file_id)
     
     # Check if user has permission to preview this file
-    is_owner = file.owner_id == current_user.id
-    is_shared = current_user in file.shared_with
-    
-    if not (is_owner or is_shared):
+    if not has_file_permission(current_user, file):
         abort(403)
     
-    # Record activity
-    record_activity(current_user, 'preview', file=file)
+    # Files still being processed in the background have no content yet
+    if file.status != 'ready':
+        flash('This file is still being processed.' if file.status == 'processing'
+              else 'This file could not be processed.', 'warning')
+        return redirect(url_for('view_folder', folder_id=file.folder_id or 0))
     
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], file.file_path)
     file_extension = os.path.splitext(file.original_filename)[1].lower()
     
-    # If file is encrypted, decrypt it to a temporary file for preview
-    preview_path = file_path
-    temp_file_created = False
+    # Determine the file type
+    file_type = get_preview_type(file.original_filename)
+    file_content = None
     
-    if file.is_encrypted:
-        decrypted_path = decrypt_file(file_path)
-        if decrypted_path:
-            preview_path = decrypted_path
-            temp_file_created = True
-        else:
+    # For direct viewing in new tab or inline media content
+    if direct or (inline and file_type in ['image', 'pdf', 'video']):
+        # Answer revalidations of a cached copy before touching the stored file
+        response = not_modified_response(file)
+        if response is not None:
+            return response
+        
+        record_activity(current_user, 'preview', file=file)
+        response = send_stored_file(file, as_attachment=False)
+        if response is None:
             flash('Error decrypting file for preview.', 'danger')
             return redirect(url_for('view_folder', folder_id=file.folder_id or 0))
+        return response
     
-    # Determine the file type
-    if file_extension in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
-        file_type = 'image'
-    elif file_extension == '.pdf':
-        file_type = 'pdf'
-    elif file_extension in ['.mp4', '.webm', '.ogg', '.mov', '.avi', '.mkv']:
-        file_type = 'video'
-    elif file_extension in ['.txt', '.md', '.py', '.js', '.html', '.css', '.json', '.xml', '.csv']:
-        file_type = 'text'
-        # Read the file content for text files
+    # Record activity
+    record_activity(current_user, 'preview', file=file)
+    
+    text_next_offset = None
+    if file_type == 'text':
+        # Only the first page is read; the rest is loaded as the reader scrolls
+        try:
+            raw_content, text_next_offset = read_text_page(file, 0)
+        except Exception as e:
+            print(f"Decryption error: {e}")
+            flash('Error decrypting file for preview.', 'danger')
+            return redirect(url_for('view_folder', folder_id=file.folder_id or 0))
+        
         try:
-            with open(preview_path, 'r', encoding='utf-8') as f:
-                file_content = f.read()
+            file_content = raw_content.decode('utf-8')
         except UnicodeDecodeError:
             # If we can't decode as text, treat as binary
             file_type = 'binary'
-            file_content = None
-    else:
-        file_type = 'binary'
-        file_content = None
-    
-    # Clean up temporary decrypted file if text content was already read
-    if temp_file_created and file_type == 'text':
-        try:
-            os.unlink(preview_path)
-            temp_file_created = False
-        except:
-            pass
     
     # For modal preview requests, return JSON with file information
     if modal:
-        from flask import jsonify
         response_data = {
             'filename': file.original_filename,
             'file_type': file_type,
             'extension': file_extension[1:] if file_extension else '',
             'file_id': file.id,
-            'content': file_content if file_type == 'text' else None
+            'has_preview': can_render(file_type),
+            'content': file_content if file_type == 'text' else None,
+            'next_offset': text_next_offset if file_type == 'text' else None
         }
         return jsonify(response_data)
     
-    # For direct viewing in new tab or inline media content
-    if direct or (inline and file_type in ['image', 'pdf', 'video']):
-        response = send_file(preview_path, download_name=file.original_filename, as_attachment=False)
-        
-        # Clean up temporary file after response is sent
-        if temp_file_created:
-            @response.call_on_close
-            def cleanup():
-                try:
-                    os.unlink(preview_path)
-                except:
-                    pass
-        
-        return response
-    
     return render_template('preview.html', 
                          title=f'Preview: {file.original_filename}',
                          file=file,
                          file_type=file_type,
-                         file_content=file_content if file_type == 'text' else None)
+                         file_content=file_content if file_type == 'text' else None,
+                         text_next_offset=text_next_offset if file_type == 'text' else None)
+
+@app.route('/thumbnail/<int:file_id>')
+@login_required
+def file_thumbnail(file_id):
+    """Serve a downscaled rendition of an image, PDF or video
+    
+    Renditions come from the derivative cache; a missing one is scheduled
+    for rendering and answered with 404 until it is ready.
+    """
+    size = request.args.get('size', 'thumb')
+    if size not in app.config['DERIVATIVE_SIZES']:
+        abort(404)
+    
+    file = File.query.get_or_404(file_id)
+    
+    # Check if user has permission to view this file
+    if not has_file_permission(current_user, file):
+        abort(403)
+    
+    if file.status != 'ready' or not can_render(get_preview_type(file.original_filename)):
+        abort(404)
+    
+    # Renditions of the same content never change
+    key = file_etag(file)
+    etag = f'{key}-{size}'
+    if request.if_none_match and not is_resource_modified(request.environ, etag=etag):
+        response = Response(status=304)
+    else:
+        data = derivative_cache.get(key, size)
+        if data is None:
+            enqueue_derivatives(file)
+            db.session.commit()
+            response = Response(status=404)
+            response.headers['Retry-After'] = '5'
+            return response
+        if not data:
+            abort(404)
+        response = Response(data, mimetype='image/jpeg')
+    
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = app.config['DERIVATIVE_CACHE_MAX_AGE']
+    return response
+
+@app.route('/api/files/<int:file_id>/text')
+@login_required
+def text_preview_page(file_id):
+    """Get a page of a text file for the paged preview
+    
+    Pages start at a byte offset (the next_offset of the previous page) or
+    at a line number. Lines are found through the file's line index, which
+    is built in the background once a file turns out to need more than one
+    page, or on the spot when a line is asked for before it exists.
+    """
+    file = File.query.get_or_404(file_id)
+    
+    # Check if user has permission to preview this file
+    if not has_file_permission(current_user, file):
+        abort(403)
+    
+    if file.status != 'ready' or get_preview_type(file.original_filename) != 'text':
+        abort(404)
+    
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    line = request.args.get('line', type=int)
+    
+    try:
+        index = get_line_index(file)
+        if line is not None:
+            if index is None:
+                index = build_file_line_index(file)
+            start, skip = index.locate(line)
+            offset = skip_lines(lambda start, stop: read_plaintext_range(file, start, stop), start, skip)
+            if offset is None:
+                offset = index.size
+        content, next_offset = read_text_page(file, offset)
+    except Exception as e:
+        print(f"Decryption error: {e}")
+        return jsonify({'error': 'The file could not be read.'}), 500
+    
+    if index is None and next_offset is not None:
+        job_queue.enqueue_once('index_lines', file_id=file.id)
+        db.session.commit()
+    
+    return jsonify({
+        'content': content.decode('utf-8', errors='replace'),
+        'offset': offset,
+        'next_offset': next_offset,
+        'size': file.file_size,
+        'line_count': index.line_count if index else None
+    })
 
 @app.route('/delete/<int:file_id>', methods=['POST'])
 @login_required
@@ -515,7 +2217,7 @@ def delete_file(file_id):
         abort(403)
     
     # Soft delete (move to trash)
-    file.is_trashed = True
+    trash_files(current_user, File.id == file.id)
     db.session.commit()
     
     # Record activity
@@ -536,9 +2238,18 @@ def delete_folder(folder_id):
     # Get parent folder for redirect
     parent_id = folder.parent_id
     
-    # Delete the folder and all its contents
-    db.session.delete(folder)
+    # Delete the folder, its subfolders and all their files in a few statements
+    ensure_folder_path(folder)
+    subtree = subtree_folder_ids(folder)
+    blob_ids, legacy_paths = purge_files(current_user, File.folder_id.in_(subtree))
+    unindex_items('folder', [folder_id for (folder_id,) in db.session.execute(subtree)])
+    remove_folder_shares(subtree)
+    db.session.expunge(folder)
+    Folder.query.filter(or_(Folder.id == folder.id,
+                            Folder.path_startswith(folder.subtree_prefix))).delete(
+        synchronize_session=False)
     db.session.commit()
+    remove_purged_files(blob_ids, legacy_paths)
     
     # Record activity
     record_activity(current_user, 'delete_folder', folder=folder)
@@ -546,6 +2257,30 @@ def delete_folder(folder_id):
     flash('Folder deleted successfully.', 'success')
     return redirect(url_for('view_folder', folder_id=parent_id) if parent_id else url_for('dashboard'))
 
+@app.route('/move_folder/<int:folder_id>', methods=['POST'])
+@login_required
+def move_folder_to(folder_id):
+    folder = Folder.query.get_or_404(folder_id)
+    new_parent = Folder.query.get_or_404(request.form.get('parent_id', type=int))
+    
+    # Check if user has permission to move this folder there
+    if folder.owner_id != current_user.id or new_parent.owner_id != current_user.id:
+        abort(403)
+    
+    try:
+        move_folder(folder, new_parent)
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('view_folder', folder_id=folder.parent_id or folder.id))
+    
+    db.session.commit()
+    
+    # Record activity
+    record_activity(current_user, 'move_folder', folder=folder)
+    
+    flash('Folder moved successfully.', 'success')
+    return redirect(url_for('view_folder', folder_id=new_parent.id))
+
 @app.route('/star/<int:file_id>', methods=['POST'])
 @login_required
 def star_file(file_id):
@@ -556,7 +2291,7 @@ def star_file(file_id):
         abort(403)
     
     # Toggle star status
-    file.is_starred = not file.is_starred
+    star_files(current_user, File.id == file.id, not file.is_starred)
     db.session.commit()
     
     # Record activity
@@ -579,8 +2314,15 @@ def rename_file(file_id):
     
     if form.validate_on_submit():
         # Update file name
+        was_text = get_preview_type(file.original_filename) == 'text'
         file.original_filename = form.filename.data
         file.updated_at = datetime.utcnow()
+        index_file(file)
+        plaintext_cache.invalidate(file.id)
+        
+        # The new extension may change whether the content is indexed
+        if was_text != (get_preview_type(file.original_filename) == 'text'):
+            job_queue.enqueue('index_content', file_id=file.id)
         db.session.commit()
         
         # Record activity
@@ -619,7 +2361,7 @@ def share_file(file_id):
             return redirect(url_for('share_file', file_id=file_id))
         
         # Check if already shared
-        if user in file.shared_with:
+        if get_share_permission(file.id, user.id) is not None:
             flash('File already shared with this user.', 'warning')
             return redirect(url_for('share_file', file_id=file_id))
         
@@ -630,7 +2372,10 @@ def share_file(file_id):
             permission=form.permission.data
         )
         db.session.execute(statement)
+        if not file.is_trashed:
+            adjust_user_counters(user.id, shared_count=1)
         db.session.commit()
+        forget_file_permissions(file.id)
         
         # Record activity
         record_activity(current_user, 'share', file=file)
@@ -638,21 +2383,8 @@ def share_file(file_id):
         flash(f'File shared with {user.email} successfully!', 'success')
         return redirect(url_for('view_folder', folder_id=file.folder_id or 0))
     
-    # Get current shares
-    shared_users = []
-    for user in file.shared_with:
-        # Get permission
-        share = db.session.query(shares).filter_by(
-            file_id=file.id,
-            user_id=user.id
-        ).first()
-        
-        shared_users.append({
-            'id': user.id,
-            'username': user.username,
-            'email': user.email,
-            'permission': share.permission if share else 'view'
-        })
+    # Get current shares with their permissions in one query
+    shared_users = list_file_shares(file.id)
     
     return render_template('share.html', title='Share File',
                          file=file,
@@ -673,7 +2405,8 @@ def unshare_file(file_id, user_id):
     statement = shares.delete().where(
         and_(shares.c.file_id == file.id, shares.c.user_id == user.id)
     )
-    db.session.execute(statement)
+    if db.session.execute(statement).rowcount and not file.is_trashed:
+        adjust_user_counters(user.id, shared_count=-1)
     db.session.commit()
     
     # Record activity
@@ -685,14 +2418,35 @@ def unshare_file(file_id, user_id):
 @app.route('/shared')
 @login_required
 def shared_with_me():
-    # Get files shared with the current user
-    shared_files = File.query.join(shares).filter(
-        shares.c.user_id == current_user.id,
-        File.is_trashed == False
-    ).all()
+    # Shared folders are listed as roots; their contents load when opened
+    shared_folders = Folder.query.join(folder_shares).filter(
+        folder_shares.c.user_id == current_user.id
+    ).options(db.joinedload(Folder.owner)).order_by(Folder.name, Folder.id).all()
+    
+    # Only the first page of directly shared files is rendered
+    shared_files, files_cursor = list_shared_files(current_user, limit=app.config['FOLDER_PAGE_SIZE'])
     
     return render_template('shared.html', title='Shared with Me',
-                         files=shared_files)
+                         folders=shared_folders,
+                         files=shared_files,
+                         files_cursor=files_cursor)
+
+@app.route('/api/shared/entries')
+@login_required
+def shared_entries():
+    """Return the next page of files shared directly with the current user"""
+    try:
+        files, next_cursor = list_shared_files(current_user, request.args.get('cursor'),
+                                               get_page_limit())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'items': [{'id': f.id, 'name': f.original_filename, 'owner': f.owner.username}
+                  for f in files],
+        'next_cursor': next_cursor,
+        'html': render_template('_shared_rows.html', files=files)
+    })
 
 @app.route('/remove_shared/<int:file_id>', methods=['POST'])
 @login_required
@@ -704,7 +2458,8 @@ def remove_shared(file_id):
     statement = shares.delete().where(
         and_(shares.c.file_id == file.id, shares.c.user_id == current_user.id)
     )
-    db.session.execute(statement)
+    if db.session.execute(statement).rowcount and not file.is_trashed:
+        adjust_user_counters(current_user.id, shared_count=-1)
     db.session.commit()
     
     # Record activity
@@ -713,6 +2468,100 @@ def remove_shared(file_id):
     flash('File removed from your shared files.', 'success')
     return redirect(url_for('shared_with_me'))
 
+@app.route('/share_folder/<int:folder_id>', methods=['GET', 'POST'])
+@login_required
+def share_folder(folder_id):
+    folder = Folder.query.get_or_404(folder_id)
+    
+    # Check if user has permission to share this folder
+    if folder.owner_id != current_user.id:
+        abort(403)
+    
+    form = ShareFileForm()
+    
+    if form.validate_on_submit():
+        # Get user to share with
+        user = User.query.filter_by(email=form.email.data).first()
+        
+        if not user:
+            flash('User not found.', 'danger')
+            return redirect(url_for('share_folder', folder_id=folder_id))
+        
+        if user.id == current_user.id:
+            flash('You cannot share with yourself.', 'danger')
+            return redirect(url_for('share_folder', folder_id=folder_id))
+        
+        # Check if already shared
+        existing = db.session.execute(select(folder_shares.c.permission).where(
+            folder_shares.c.folder_id == folder.id, folder_shares.c.user_id == user.id)).first()
+        if existing:
+            flash('Folder already shared with this user.', 'warning')
+            return redirect(url_for('share_folder', folder_id=folder_id))
+        
+        # One share row covers the folder and everything below it
+        statement = folder_shares.insert().values(
+            folder_id=folder.id,
+            user_id=user.id,
+            permission=form.permission.data
+        )
+        db.session.execute(statement)
+        adjust_user_counters(user.id, shared_count=1)
+        db.session.commit()
+        forget_folder_permissions()
+        
+        # Record activity
+        record_activity(current_user, 'share_folder', folder=folder)
+        
+        flash(f'Folder shared with {user.email} successfully!', 'success')
+        return redirect(url_for('view_folder', folder_id=folder.id))
+    
+    return render_template('share_folder.html', title='Share Folder',
+                         folder=folder,
+                         form=form,
+                         shared_users=list_folder_shares(folder.id))
+
+@app.route('/unshare_folder/<int:folder_id>/<int:user_id>', methods=['POST'])
+@login_required
+def unshare_folder(folder_id, user_id):
+    folder = Folder.query.get_or_404(folder_id)
+    
+    # Check if user has permission to unshare this folder
+    if folder.owner_id != current_user.id:
+        abort(403)
+    
+    # Remove share
+    statement = folder_shares.delete().where(
+        and_(folder_shares.c.folder_id == folder.id, folder_shares.c.user_id == user_id)
+    )
+    if db.session.execute(statement).rowcount:
+        adjust_user_counters(user_id, shared_count=-1)
+    db.session.commit()
+    
+    # Record activity
+    record_activity(current_user, 'unshare_folder', folder=folder)
+    
+    flash('Folder unshared successfully.', 'success')
+    return redirect(url_for('share_folder', folder_id=folder_id))
+
+@app.route('/remove_shared_folder/<int:folder_id>', methods=['POST'])
+@login_required
+def remove_shared_folder(folder_id):
+    folder = Folder.query.get_or_404(folder_id)
+    
+    # Remove the share record for this user
+    statement = folder_shares.delete().where(
+        and_(folder_shares.c.folder_id == folder.id, folder_shares.c.user_id == current_user.id)
+    )
+    if db.session.execute(statement).rowcount:
+        adjust_user_counters(current_user.id, shared_count=-1)
+    db.session.commit()
+    
+    # Record activity
+    record_activity(current_user, 'remove_shared', folder=folder)
+    
+    flash('Folder removed from your shared files.', 'success')
+    return redirect(url_for('shared_with_me'))
+
 @app.route('/trash')
 @login_required
 def trash():
@@ -732,7 +2581,7 @@ def restore_file(file_id):
         abort(403)
     
     # Restore from trash
-    file.is_trashed = False
+    restore_files(current_user, File.id == file.id)
     db.session.commit()
     
     # Record activity
@@ -750,25 +2599,115 @@ def permanent_delete(file_id):
     if file.owner_id != current_user.id:
         abort(403)
     
-    # Update user's storage usage
-    current_user.storage_used -= file.file_size
-    
-    # Delete the file from disk
-    try:
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], file.file_path))
-    except:
-        pass  # File might not exist on disk
-    
-    # Delete from database
-    db.session.delete(file)
+    # Delete from database, releasing the file's storage
+    blob_ids, legacy_paths = purge_files(current_user, File.id == file.id)
+    db.session.expunge(file)
     db.session.commit()
     
+    # Remove the data from disk if this was its last reference
+    remove_purged_files(blob_ids, legacy_paths)
+    
     # Record activity
     record_activity(current_user, 'permanent_delete', file=file)
     
     flash('File permanently deleted.', 'success')
     return redirect(url_for('trash'))
 
+@app.route('/empty_trash', methods=['POST'])
+@login_required
+def empty_trash():
+    # Delete everything in the trash in one transaction
+    condition = File.is_trashed == True
+    file_ids = [file_id for (file_id,) in db.session.query(File.id).filter(
+        File.owner_id == current_user.id, condition)]
+    blob_ids, legacy_paths = purge_files(current_user, condition)
+    db.session.commit()
+    remove_purged_files(blob_ids, legacy_paths)
+    
+    # Record activity
+    record_bulk_activity(current_user, 'permanent_delete', file_ids)
+    
+    flash(f'{len(file_ids)} files permanently deleted.', 'success')
+    return redirect(url_for('trash'))
+
+def bulk_selection(data):
+    """Build the SQL condition for the files selected in a bulk request
+    
+    Files are selected by a list of ``file_ids``, by ``folder_id`` (with
+    ``recursive`` for the whole subtree) or by ``trashed`` for the whole
+    trash. Only the current user's files are ever affected.
+    
+    Raises:
+        ValueError: If the selection is missing or invalid
+    """
+    if 'file_ids' in data:
+        file_ids = data['file_ids']
+        if not isinstance(file_ids, list) or not all(isinstance(i, int) for i in file_ids):
+            raise ValueError('file_ids must be a list of integers.')
+        if len(file_ids) > app.config['BULK_MAX_FILE_IDS']:
+            raise ValueError(f"At most {app.config['BULK_MAX_FILE_IDS']} file_ids per request; "
+                             "select a folder or the trash instead.")
+        return File.id.in_(file_ids)
+    
+    if 'folder_id' in data:
+        folder = Folder.query.get_or_404(data['folder_id'])
+        if folder.owner_id != current_user.id:
+            abort(403)
+        if data.get('recursive'):
+            ensure_folder_path(folder)
+            return File.folder_id.in_(subtree_folder_ids(folder))
+        return File.folder_id == folder.id
+    
+    if data.get('trashed'):
+        return File.is_trashed == True
+    
+    raise ValueError('Select files with file_ids, folder_id or trashed.')
+
+@app.route('/api/files/bulk', methods=['POST'])
+@login_required
+def bulk_files():
+    """Apply one action to many files in a single transaction
+    
+    Expects JSON with an ``action`` (trash, restore, star, unstar, move or
+    delete), a selection (see bulk_selection) and ``target_folder_id`` for
+    moves.
+    """
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    
+    try:
+        condition = bulk_selection(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    blob_ids, legacy_paths = [], []
+    if action == 'trash':
+        file_ids = trash_files(current_user, condition)
+    elif action == 'restore':
+        file_ids = restore_files(current_user, condition)
+    elif action in ('star', 'unstar'):
+        file_ids = star_files(current_user, condition, action == 'star')
+    elif action == 'move':
+        target = Folder.query.get_or_404(data.get('target_folder_id'))
+        if target.owner_id != current_user.id:
+            abort(403)
+        file_ids = move_files(current_user, condition, target)
+    elif action == 'delete':
+        file_ids = [file_id for (file_id,) in db.session.query(File.id).filter(
+            File.owner_id == current_user.id, condition)]
+        blob_ids, legacy_paths = purge_files(current_user, condition)
+        action = 'permanent_delete'
+    else:
+        return jsonify({'error': 'Unknown action.'}), 400
+    
+    db.session.commit()
+    remove_purged_files(blob_ids, legacy_paths)
+    
+    # Record activity
+    record_bulk_activity(current_user, action, file_ids)
+    
+    return jsonify({'action': action, 'count': len(file_ids), 'file_ids': file_ids})
+
 @app.route('/search')
 @login_required
 def search():
@@ -777,23 +2716,25 @@ def search():
     if not query:
         return redirect(url_for('dashboard'))
     
-    # Search files
-    files = File.query.filter(
-        File.owner_id == current_user.id,
-        File.is_trashed == False,
-        File.original_filename.ilike(f'%{query}%')
-    ).all()
+    # Search the name index, one ranked page at a time
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_size = app.config['SEARCH_PAGE_SIZE']
+    offset = (page - 1) * page_size
+    files, more_files = search_index('file', current_user.id, query, page_size, offset)
+    folders, more_folders = search_index('folder', current_user.id, query, page_size, offset)
     
-    # Search folders
-    folders = Folder.query.filter(
-        Folder.owner_id == current_user.id,
-        Folder.name.ilike(f'%{query}%')
-    ).all()
+    # Search inside text files; snippets only decrypt the text around the match
+    content_hits, more_content = search_content(current_user.id, query, page_size, offset)
+    content_matches = [(file, content_snippet(file, match_offset))
+                       for file, match_offset in content_hits]
     
     return render_template('search.html', title='Search Results',
                          query=query,
                          files=files,
-                         folders=folders)
+                         folders=folders,
+                         content_matches=content_matches,
+                         page=page,
+                         has_next=more_files or more_folders or more_content)
 
 @app.route('/profile', methods=['GET', 'POST'])
 @login_required
@@ -810,7 +2751,8 @@ def profile():
         form.username.data = current_user.username
         form.email.data = current_user.email
     
-    # Get recent activity
+    # Get recent activity, including events still in the buffer
+    activity_log.flush()
     activities = Activity.query.filter_by(user_id=current_user.id).order_by(Activity.timestamp.desc()).limit(10).all()
     
     # Format storage
@@ -841,6 +2783,86 @@ def internal_error(error):
     db.session.rollback()
     return render_template('500.html'), 500
 
+@app.cli.command('run-jobs')
+def run_jobs_command():
+    """Process background jobs in this process until interrupted"""
+    remove_render_leftovers()
+    job_queue.start(workers=max(app.config['JOB_WORKERS'], 1))
+    print(f"Processing jobs with {len(job_queue.threads)} worker(s). Press CTRL+C to stop.")
+    try:
+        for thread in job_queue.threads:
+            thread.join()
+    except KeyboardInterrupt:
+        job_queue.stop()
+
+@app.cli.command('rebuild-folder-paths')
+def rebuild_folder_paths_command():
+    """Recompute the materialized paths of all folders"""
+    count = rebuild_folder_paths()
+    print(f"Rebuilt paths for {count} folder(s).")
+
+@app.cli.command('reindex-search')
+def reindex_search_command():
+    """Rebuild the filename search index, creating the FTS5 table if supported"""
+    backend = 'FTS5' if create_fts_table() else 'trigram table'
+    count = rebuild_search_index()
+    print(f"Indexed {count} file(s) and folder(s) using the {backend}.")
+
+@app.cli.command('reindex-content')
+def reindex_content_command():
+    """Queue content indexing jobs for every text file"""
+    count = 0
+    files = File.query.with_entities(File.id, File.original_filename).filter_by(status='ready')
+    for file_id, original_filename in files.all():
+        if get_preview_type(original_filename) == 'text':
+            job_queue.enqueue('index_content', file_id=file_id)
+            count += 1
+    db.session.commit()
+    print(f"Queued content indexing for {count} file(s).")
+
+@app.cli.command('recount-users')
+def recount_users_command():
+    """Recompute the cached per-user file, starred, trashed and shared counters"""
+    rebuild_user_counters()
+    print(f"Recounted {User.query.count()} user(s).")
+
+@app.cli.command('gc-blobs')
+def gc_blobs_command():
+    """Delete blobs that are no longer referenced by any file"""
+    removed = collect_garbage()
+    print(f"Removed {removed} unreferenced blob(s).")
+
+@app.cli.command('tier-storage')
+@click.option('--to', 'target', default=None, help='Backend to move idle blobs to.')
+@click.option('--from', 'source', default=None, help='Only move blobs from this backend.')
+@click.option('--idle-days', type=int, default=None, help='Days without access before a blob is moved.')
+@click.option('--batch-size', default=100, show_default=True, help='Blobs moved per transaction.')
+@click.option('--pause', default=0.5, show_default=True, help='Seconds to wait between batches.')
+@click.option('--limit', type=int, default=None, help='Stop after moving this many blobs.')
+def tier_storage_command(target, source, idle_days, batch_size, pause, limit):
+    """Move blobs nobody has touched for a while to a cheaper storage backend
+    
+    Without --to and --idle-days the rules in STORAGE_TIERING_RULES are applied.
+    """
+    if target and idle_days is not None:
+        rules = [{'from': source, 'to': target, 'idle_days': idle_days}]
+    else:
+        rules = app.config['STORAGE_TIERING_RULES']
+    
+    for rule in rules:
+        moved = tier_blobs(rule['to'], rule['idle_days'], source=rule.get('from'),
+                           batch_size=batch_size, pause=pause, limit=limit)
+        print(f"Moved {moved} blob(s) to the {rule['to']} backend.")
+
+@app.cli.command('migrate-layout')
+@click.option('--batch-size', default=500, show_default=True, help='Files moved per transaction.')
+@click.option('--pause', default=0.5, show_default=True, help='Seconds to wait between batches.')
+@click.option('--limit', type=int, default=None, help='Stop after moving this many files.')
+def migrate_layout_command(batch_size, pause, limit):
+    """Move stored files into the ab/cd/<name> fan-out layout; safe to interrupt and rerun"""
+    moved = migrate_layout(batch_size=batch_size, pause=pause, limit=limit)
+    print(f"Moved {moved} file(s) into the fan-out layout.")
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
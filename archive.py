@@ -0,0 +1,123 @@
+import io
+import mimetypes
+import zipfile
+from datetime import datetime
+
+# Media that is already compressed; deflating it again costs CPU for nothing
+COMPRESSED_PREFIXES = ('image/', 'video/', 'audio/')
+UNCOMPRESSED_MEDIA = {'image/bmp', 'image/x-ms-bmp', 'image/svg+xml', 'image/tiff', 'audio/wav',
+                      'audio/x-wav'}
+COMPRESSED_TYPES = {
+    'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2',
+    'application/x-xz', 'application/x-7z-compressed', 'application/vnd.rar',
+    'application/x-rar-compressed', 'application/zstd', 'application/pdf', 'application/epub+zip',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    'application/vnd.oasis.opendocument.text', 'application/vnd.oasis.opendocument.spreadsheet'
+}
+
+
+class ArchiveMember:
+    """A file or directory to be written to a streamed archive
+
+    Args:
+        name: Path inside the archive; directories end with '/'
+        modified: Modification time, or None for now
+        size: Expected size in bytes, used to switch to ZIP64 up front
+        mime_type: Content type, used to decide whether to compress
+        chunks: Callable returning an iterable of the content's byte strings
+    """
+
+    def __init__(self, name, modified=None, size=0, mime_type=None, chunks=None):
+        self.name = name
+        self.modified = modified
+        self.size = size or 0
+        self.mime_type = mime_type
+        self.chunks = chunks
+
+    @property
+    def is_dir(self):
+        return self.name.endswith('/')
+
+
+class _StreamSink(io.RawIOBase):
+    """Write-only stream that collects what zipfile writes until it is drained
+
+    It cannot seek or tell, so zipfile writes sizes and CRCs in data
+    descriptors after each member instead of going back to patch headers.
+    """
+
+    def __init__(self):
+        self._parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def is_compressed_type(name, mime_type=None):
+    """Check whether a file's content is already compressed, from its type or name"""
+    mime_type = (mime_type or '').split(';')[0].strip().lower()
+    if not mime_type or mime_type == 'application/octet-stream':
+        mime_type = mimetypes.guess_type(name)[0] or ''
+    if mime_type in UNCOMPRESSED_MEDIA:
+        return False
+    return mime_type.startswith(COMPRESSED_PREFIXES) or mime_type in COMPRESSED_TYPES
+
+
+def _date_time(modified):
+    # ZIP timestamps cannot go back further than 1980
+    modified = max(modified or datetime.utcnow(), datetime(1980, 1, 1))
+    return modified.timetuple()[:6]
+
+
+def stream_zip(members):
+    """Yield a ZIP archive of the members piece by piece
+
+    Each member's content is read and written chunk by chunk, so nothing
+    is buffered beyond a chunk and the compressor's window, and no
+    archive is built on disk. Members of already compressed types are
+    stored as they are; everything else is deflated. ZIP64 records are
+    used for members and archives past the 4 GiB / 65535 entry limits.
+
+    Args:
+        members: Iterable of ArchiveMember
+
+    Yields:
+        Byte strings of the archive
+    """
+    sink = _StreamSink()
+    archive = zipfile.ZipFile(sink, 'w', allowZip64=True)
+
+    for member in members:
+        info = zipfile.ZipInfo(member.name, _date_time(member.modified))
+        if member.is_dir:
+            info.external_attr = (0o40755 << 16) | 0x10
+            archive.writestr(info, b'')
+        else:
+            info.external_attr = 0o644 << 16
+            info.compress_type = (zipfile.ZIP_STORED if is_compressed_type(member.name, member.mime_type)
+                                  else zipfile.ZIP_DEFLATED)
+            # Lets zipfile write a ZIP64 header for members that will not fit a plain one
+            info.file_size = member.size
+            with archive.open(info, 'w') as entry:
+                for data in member.chunks():
+                    entry.write(data)
+                    output = sink.drain()
+                    if output:
+                        yield output
+        output = sink.drain()
+        if output:
+            yield output
+
+    archive.close()
+    yield sink.drain()
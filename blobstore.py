@@ -0,0 +1,394 @@
+import os
+import time
+import shutil
+import hashlib
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Blob, File
+from storage import storage, LOCAL
+
+_deleter = None
+_deleter_lock = threading.Lock()
+
+
+def blob_full_path(blob_path):
+    """Get the full path of a blob kept in the local backend"""
+    return storage.get(LOCAL).local_path(blob_path)
+
+
+def shard_path(name):
+    """Place a stored file name in the fan-out layout, e.g. 'ab/cd/<name>'
+
+    The two directory levels come from a hash of the name, so files spread
+    evenly over 65536 directories instead of piling up in UPLOAD_FOLDER.
+    Paths are stored relative to UPLOAD_FOLDER in Blob.file_path and
+    File.file_path, so flat and sharded files can be read side by side.
+    """
+    digest = hashlib.sha256(name.encode()).hexdigest()
+    return f'{digest[:2]}/{digest[2:4]}/{name}'
+
+
+def acquire_blob(blob_id):
+    """Take a reference on an existing blob
+
+    The increment is a single conditional UPDATE, so it cannot revive a
+    blob that a concurrent garbage collection pass has already removed.
+
+    Returns:
+        True if the reference was taken, False if the blob is gone
+    """
+    updated = Blob.query.filter(Blob.id == blob_id, Blob.ref_count > 0).update(
+        {Blob.ref_count: Blob.ref_count + 1}, synchronize_session=False)
+    return updated == 1
+
+
+def store_blob(temp_path, size, content_hash, encryption_version=None, codec=None):
+    """Move a freshly written upload into the blob store, deduplicating by hash
+
+    If a blob with the same SHA-256 already exists the temporary file is
+    discarded and a reference is taken on the existing blob instead. Each
+    blob gets a unique name, so a blob being garbage collected can never
+    clobber a newly stored copy of the same content. New blobs go to the
+    STORAGE_DEFAULT backend. The data is stored before the row is inserted,
+    so no database transaction is held open while it is copied to a remote
+    backend; if the row cannot be inserted the stored data is deleted again.
+
+    Args:
+        temp_path: Path of the stored (possibly encrypted) content
+        size: Plaintext size in bytes
+        content_hash: SHA-256 hex digest of the plaintext
+        encryption_version: Encryption format of the content, None if plain
+        codec: Compression applied to the content before encryption, None if none
+
+    Returns:
+        Tuple of (Blob, whether an existing blob was reused)
+    """
+    blob = Blob.query.filter_by(sha256=content_hash).first()
+    if blob and acquire_blob(blob.id):
+        os.unlink(temp_path)
+        db.session.expire(blob, ['ref_count'])
+        return blob, True
+
+    file_path = shard_path(f"{content_hash}_{secrets.token_hex(4)}")
+    backend_name = storage.default_name
+    backend = storage.get(backend_name)
+    backend.store(file_path, temp_path)
+
+    for _ in range(3):
+        blob = Blob(
+            sha256=content_hash,
+            file_path=file_path,
+            storage=backend_name,
+            size=size,
+            is_encrypted=encryption_version is not None,
+            encryption_version=encryption_version,
+            codec=codec,
+            ref_count=1
+        )
+        try:
+            with db.session.begin_nested():
+                db.session.add(blob)
+                db.session.flush()
+            return blob, False
+        except IntegrityError:
+            # Another upload stored the same content first; use theirs
+            pass
+
+        blob = Blob.query.filter_by(sha256=content_hash).first()
+        if blob and acquire_blob(blob.id):
+            _delete_quietly(backend, file_path)
+            db.session.expire(blob, ['ref_count'])
+            return blob, True
+
+    _delete_quietly(backend, file_path)
+    raise RuntimeError(f'Could not store blob {content_hash}')
+
+
+def _delete_quietly(backend, path):
+    try:
+        backend.delete(path)
+    except Exception as e:
+        print(f"Storage delete error: {e}")
+
+
+def delete_files(backend, paths):
+    """Delete stored files on a background thread pool
+
+    Deleting thousands of files at once should not hold up the request that
+    released them. With UNLINK_WORKERS set to 0 the files are deleted
+    before returning.
+
+    Args:
+        backend: StorageBackend holding the files
+        paths: Stored paths of the files to delete
+    """
+    global _deleter
+    paths = list(paths)
+    workers = current_app.config.get('UNLINK_WORKERS', 4)
+    if not paths:
+        return
+    if not workers:
+        for path in paths:
+            _delete_quietly(backend, path)
+        return
+
+    with _deleter_lock:
+        if _deleter is None:
+            _deleter = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='unlink')
+    for path in paths:
+        _deleter.submit(_delete_quietly, backend, path)
+
+
+def collect_garbage(blob_ids=None):
+    """Delete unreferenced blobs from the database and from disk
+
+    Blobs whose reference count dropped to zero can no longer be acquired,
+    so they are deleted in batches and their data is unlinked in the
+    background once the deletions are committed.
+
+    Args:
+        blob_ids: Optional list of blob ids to check; all blobs if None
+
+    Returns:
+        Number of blobs removed
+    """
+    query = Blob.query.filter(Blob.ref_count <= 0)
+    if blob_ids is not None:
+        if not blob_ids:
+            return 0
+        query = query.filter(Blob.id.in_(blob_ids))
+
+    garbage = query.with_entities(Blob.id, Blob.file_path, Blob.storage).all()
+    removed = 0
+    for start in range(0, len(garbage), 500):
+        batch = [blob_id for blob_id, _, _ in garbage[start:start + 500]]
+        # Keep the count check in the DELETE itself
+        removed += Blob.query.filter(Blob.id.in_(batch), Blob.ref_count <= 0).delete(
+            synchronize_session=False)
+    db.session.commit()
+
+    by_backend = {}
+    for _, blob_path, backend_name in garbage:
+        by_backend.setdefault(backend_name or LOCAL, []).append(blob_path)
+    for backend_name, paths in by_backend.items():
+        delete_files(storage.get(backend_name), paths)
+    return removed
+
+
+def _link_into_layout(path):
+    """Make a flat stored file also available at its sharded path
+
+    Returns:
+        The sharded path, or None if the file is missing
+    """
+    new_path = shard_path(path)
+    source, target = blob_full_path(path), blob_full_path(new_path)
+    if not os.path.exists(source):
+        return new_path if os.path.exists(target) else None
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        # Left behind by an interrupted run
+        if not os.path.samefile(source, target):
+            raise
+    except OSError:
+        # File systems without hard links get a copy
+        temp_path = f'{target}.tmp'
+        shutil.copy2(source, temp_path)
+        os.replace(temp_path, target)
+    return new_path
+
+
+def _flat_rows(model, last_id, limit):
+    query = db.session.query(model.id, model.file_path).filter(
+        model.id > last_id,
+        ~model.file_path.contains('/'),
+        model.file_path != '',
+        db.or_(model.storage == None, model.storage == LOCAL)
+    )
+    if model is File:
+        query = query.filter(File.blob_id == None)
+    return query.order_by(model.id).limit(limit).all()
+
+
+def migrate_layout(batch_size=500, pause=0.5, limit=None, report=print):
+    """Move stored files from the flat UPLOAD_FOLDER into the fan-out layout
+
+    Runs in small batches while the application keeps serving requests.
+    Each file is hard linked at its new path first, then the rows of the
+    batch are switched in one commit. The old names are removed only after
+    a pause, once rows written concurrently with the old path (a deduplicated
+    upload of the same blob) have been pointed at the new one, so readers
+    never find a path missing. Only rows still holding flat paths are
+    selected, so an interrupted run resumes where it stopped.
+
+    Args:
+        batch_size: Files moved per transaction
+        pause: Seconds to wait between batches, to throttle disk and database load
+        limit: Optional maximum number of files to move in this run
+        report: Callable receiving progress messages
+
+    Returns:
+        Number of files moved
+    """
+    moved = 0
+    for model in (Blob, File):
+        last_id = 0
+        while limit is None or moved < limit:
+            size = batch_size if limit is None else min(batch_size, limit - moved)
+            rows = _flat_rows(model, last_id, size)
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            switched = {}
+            for row_id, path in rows:
+                new_path = _link_into_layout(path)
+                if new_path is None:
+                    report(f"Missing file for {model.__name__} {row_id}: {path}")
+                    continue
+                model.query.filter(model.id == row_id, model.file_path == path).update(
+                    {model.file_path: new_path}, synchronize_session=False)
+                switched[row_id] = path
+            if model is Blob and switched:
+                _repoint_files(list(switched))
+            db.session.commit()
+
+            time.sleep(pause)
+            if model is Blob and switched:
+                _repoint_files(list(switched))
+                db.session.commit()
+            for path in switched.values():
+                try:
+                    os.remove(blob_full_path(path))
+                except OSError:
+                    pass  # Already removed
+            moved += len(switched)
+            report(f"Moved {moved} file(s).")
+
+    if limit is None or moved < limit:
+        sweep_flat_files()
+    return moved
+
+
+def _repoint_files(blob_ids):
+    """Copy the current path and backend of the given blobs to their files"""
+    def current(column):
+        return db.select(column).where(Blob.id == File.blob_id).scalar_subquery()
+    File.query.filter(File.blob_id.in_(blob_ids)).update(
+        {File.file_path: current(Blob.file_path), File.storage: current(Blob.storage)},
+        synchronize_session=False)
+
+
+def _is_referenced(path):
+    return (db.session.query(Blob.id).filter(Blob.file_path == path).first() is not None or
+            db.session.query(File.id).filter(File.file_path == path).first() is not None)
+
+
+def sweep_flat_files():
+    """Remove flat files whose sharded copy is already in place
+
+    These are left behind when a migration is interrupted between the
+    commit of a batch and the removal of its old names.
+
+    Returns:
+        Number of files removed
+    """
+    removed = 0
+    with os.scandir(current_app.config['UPLOAD_FOLDER']) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.is_file(follow_symlinks=False):
+                continue
+            target = blob_full_path(shard_path(entry.name))
+            try:
+                if (os.path.exists(target) and os.path.samefile(entry.path, target)
+                        and not _is_referenced(entry.name)):
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+def tier_blobs(target, idle_days, source=None, batch_size=100, pause=0.5, limit=None, report=print):
+    """Move blobs whose files have not been touched for a while to another backend
+
+    A blob qualifies when it is older than the idle period and none of its
+    files was created or accessed within it. Blobs are copied first, then
+    their rows (and their files' copies of the backend name) are switched
+    in one commit per batch, and the old copies are deleted after a pause,
+    the same way migrate_layout() moves files while the application runs.
+
+    Args:
+        target: Name of the backend to move blobs to
+        idle_days: Days without access after which a blob is moved
+        source: Optional backend to move blobs from; any other backend if None
+        batch_size: Blobs moved per transaction
+        pause: Seconds to wait between batches
+        limit: Optional maximum number of blobs to move in this run
+        report: Callable receiving progress messages
+
+    Returns:
+        Number of blobs moved
+    """
+    cutoff = datetime.utcnow() - timedelta(days=idle_days)
+    target_backend = storage.get(target)
+    backend_name = db.func.coalesce(Blob.storage, LOCAL)
+    recently_used = db.select(File.id).where(
+        File.blob_id == Blob.id,
+        db.or_(File.created_at >= cutoff, File.last_accessed_at >= cutoff)
+    ).exists()
+    candidates = db.session.query(Blob.id, Blob.file_path, backend_name).filter(
+        Blob.ref_count > 0,
+        Blob.created_at < cutoff,
+        backend_name != target,
+        ~recently_used
+    )
+    if source:
+        candidates = candidates.filter(backend_name == source)
+
+    moved = 0
+    last_id = 0
+    while limit is None or moved < limit:
+        size = batch_size if limit is None else min(batch_size, limit - moved)
+        rows = candidates.filter(Blob.id > last_id).order_by(Blob.id).limit(size).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        switched = []
+        for blob_id, path, name in rows:
+            backend = storage.get(name)
+            try:
+                with backend.open(path) as f:
+                    target_backend.write(path, f)
+            except Exception as e:
+                report(f"Could not copy blob {blob_id}: {e}")
+                continue
+            updated = Blob.query.filter(Blob.id == blob_id, backend_name == name).update(
+                {Blob.storage: target}, synchronize_session=False)
+            if updated:
+                switched.append((blob_id, backend, path))
+        if switched:
+            _repoint_files([blob_id for blob_id, _, _ in switched])
+        db.session.commit()
+
+        time.sleep(pause)
+        if switched:
+            # Files attached in the meantime copied the old backend name
+            _repoint_files([blob_id for blob_id, _, _ in switched])
+            db.session.commit()
+        for _, backend, path in switched:
+            _delete_quietly(backend, path)
+        moved += len(switched)
+        report(f"Moved {moved} blob(s) to {target}.")
+
+    return moved
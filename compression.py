@@ -0,0 +1,183 @@
+import importlib.util
+import mimetypes
+import struct
+import zlib
+
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+
+# Content worth compressing; media and archives are already compressed
+COMPRESSIBLE_PREVIEW_TYPES = {'text'}
+COMPRESSIBLE_MIME_TYPES = {
+    'application/json', 'application/xml', 'application/javascript', 'application/x-javascript',
+    'application/x-ndjson', 'application/x-yaml', 'application/yaml', 'application/sql',
+    'application/x-sh', 'application/csv', 'application/x-tex', 'application/rtf', 'image/svg+xml',
+    'image/bmp', 'image/x-ms-bmp'
+}
+
+# Plaintext bytes per independently compressed frame
+DEFAULT_FRAME_SIZE = 1024 * 1024
+
+_LENGTH = struct.Struct('>I')  # Compressed length before each frame; 0 ends the frames
+_OFFSET = struct.Struct('>Q')  # Offset of a frame in the index after the frames
+_FOOTER = struct.Struct('>IQ')  # Frame size and number of frames, at the very end
+
+
+def codec_available(codec):
+    """Check whether a codec can be used here; zstd needs the zstandard package"""
+    if codec == ZLIB:
+        return True
+    if codec == ZSTD:
+        return importlib.util.find_spec('zstandard') is not None
+    return False
+
+
+def is_compressible(filename, preview_type=None, mime_type=None):
+    """Check whether content is worth compressing, from its preview type, MIME type or name"""
+    if preview_type in COMPRESSIBLE_PREVIEW_TYPES:
+        return True
+    mime_type = (mime_type or '').split(';')[0].strip().lower()
+    if not mime_type or mime_type == 'application/octet-stream':
+        mime_type = mimetypes.guess_type(filename)[0] or ''
+    return mime_type.startswith('text/') or mime_type in COMPRESSIBLE_MIME_TYPES
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError('Content compressed with zstd requires zstandard (pip install zstandard).')
+    return zstandard
+
+
+def _compress_frame(codec, data):
+    if codec == ZLIB:
+        return zlib.compress(data, 6)
+    if codec == ZSTD:
+        return _zstandard().ZstdCompressor(level=3).compress(data)
+    raise ValueError(f'Unknown compression codec: {codec}')
+
+
+def _decompress_frame(codec, data):
+    if codec == ZLIB:
+        return zlib.decompress(data)
+    if codec == ZSTD:
+        return _zstandard().ZstdDecompressor().decompress(data)
+    raise ValueError(f'Unknown compression codec: {codec}')
+
+
+class FrameCompressor:
+    """Compress data into independently compressed frames as it is written
+
+    The push-style counterpart of compress_chunks(); see there for the
+    layout. At most one frame is buffered.
+
+    Args:
+        codec: ZLIB or ZSTD
+        frame_size: Plaintext bytes per frame
+    """
+
+    def __init__(self, codec, frame_size=DEFAULT_FRAME_SIZE):
+        self.codec = codec
+        self._frame_size = frame_size
+        self._offsets = []
+        self._position = 0
+        self._buffer = bytearray()
+
+    def _frame(self, data):
+        compressed = _compress_frame(self.codec, bytes(data))
+        self._offsets.append(self._position)
+        self._position += _LENGTH.size + len(compressed)
+        return _LENGTH.pack(len(compressed)) + compressed
+
+    def update(self, data):
+        """Add plaintext and get the frames that could be compressed, joined (possibly b'')"""
+        self._buffer += data
+        frames = []
+        while len(self._buffer) >= self._frame_size:
+            frames.append(self._frame(self._buffer[:self._frame_size]))
+            del self._buffer[:self._frame_size]
+        return b''.join(frames)
+
+    def finalize(self):
+        """Compress what is left and get it followed by the index of the frames"""
+        tail = self._frame(self._buffer) if self._buffer else b''
+        return (tail + _LENGTH.pack(0) + b''.join(_OFFSET.pack(offset) for offset in self._offsets) +
+                _FOOTER.pack(self._frame_size, len(self._offsets)))
+
+
+def compress_chunks(codec, chunks, frame_size=DEFAULT_FRAME_SIZE):
+    """Compress an iterable of byte strings into independently compressed frames
+
+    Each frame_size bytes of plaintext are compressed on their own and
+    written with their compressed length. An index of the frames' offsets
+    follows them, so decompress_range() can find and decompress only the
+    frames under a byte range. At most one frame is held in memory.
+
+    Args:
+        codec: ZLIB or ZSTD
+        chunks: Iterable of plaintext byte strings of any size
+        frame_size: Plaintext bytes per frame
+
+    Yields:
+        The frames followed by their index
+    """
+    compressor = FrameCompressor(codec, frame_size)
+    for data in chunks:
+        frames = compressor.update(data)
+        if frames:
+            yield frames
+    yield compressor.finalize()
+
+
+def decompress_chunks(codec, chunks):
+    """Decompress a stream written by compress_chunks() frame by frame
+
+    Args:
+        codec: Codec the stream was compressed with
+        chunks: Iterable of the stream's byte strings
+
+    Yields:
+        Plaintext byte strings, one per frame
+    """
+    buffer = bytearray()
+    for data in chunks:
+        buffer += data
+        while len(buffer) >= _LENGTH.size:
+            (length,) = _LENGTH.unpack_from(buffer)
+            if length == 0:
+                return  # The rest is the index
+            if len(buffer) < _LENGTH.size + length:
+                break
+            yield _decompress_frame(codec, bytes(buffer[_LENGTH.size:_LENGTH.size + length]))
+            del buffer[:_LENGTH.size + length]
+    raise ValueError('Compressed stream is truncated')
+
+
+def decompress_range(codec, read_stored, stored_size, start, stop):
+    """Decompress only the frames overlapping a plaintext byte range
+
+    Args:
+        codec: Codec the stream was compressed with
+        read_stored: Callable returning the bytes [start, stop) of the compressed stream
+        stored_size: Size of the compressed stream in bytes
+        start: First plaintext byte to return
+        stop: Plaintext byte to stop before (clamped to the end of the content)
+
+    Yields:
+        Plaintext bytes of the range, one piece per frame
+    """
+    frame_size, count = _FOOTER.unpack(read_stored(stored_size - _FOOTER.size, stored_size))
+    index_start = stored_size - _FOOTER.size - count * _OFFSET.size
+    first = start // frame_size
+    last = min((stop - 1) // frame_size, count - 1)
+    if start >= stop or first > last:
+        return
+
+    entries = read_stored(index_start + first * _OFFSET.size, index_start + (last + 1) * _OFFSET.size)
+    for number, (offset,) in enumerate(_OFFSET.iter_unpack(entries), first):
+        (length,) = _LENGTH.unpack(read_stored(offset, offset + _LENGTH.size))
+        data = _decompress_frame(codec, read_stored(offset + _LENGTH.size,
+                                                    offset + _LENGTH.size + length))
+        base = number * frame_size
+        yield data[max(start - base, 0):stop - base]
@@ -9,10 +9,63 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URI')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY')
+    ENCRYPTION_CHUNK_SIZE = 64 * 1024  # Plaintext bytes per encrypted segment
+    # Codec for text-like content before encryption: zlib, zstd (needs zstandard) or none
+    COMPRESSION_CODEC = os.environ.get('COMPRESSION_CODEC', 'zlib')
     
     # Upload configuration
     UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
-    MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50MB max file size
+    MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50MB max request size (single-request uploads and chunks)
+    UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Chunk size for resumable uploads
+    UPLOAD_SESSION_LIFETIME = 24 * 60 * 60  # Seconds before an unfinished resumable upload expires
+    UPLOAD_SESSIONS_MAX_BYTES = 20 * 1024 * 1024 * 1024  # Total size of one user's resumable uploads in progress
+    UNLINK_WORKERS = 4  # Threads removing deleted files from disk, 0 to remove them inline
+    SENDFILE_MODE = os.environ.get('SENDFILE_MODE')  # None, 'x-sendfile' (Apache/lighttpd) or 'x-accel-redirect' (nginx)
+    SENDFILE_ACCEL_PREFIX = os.environ.get('SENDFILE_ACCEL_PREFIX', '/protected-uploads/')  # nginx internal location aliasing UPLOAD_FOLDER
+    FILE_CACHE_MAX_AGE = {'image': 24 * 60 * 60, 'video': 24 * 60 * 60, 'pdf': 60 * 60}  # Private browser caching per preview type; others revalidate
+    
+    # Thumbnails and preview renditions (images need Pillow, PDFs pdftoppm, videos ffmpeg)
+    DERIVATIVE_SIZES = {'thumb': 256, 'preview': 1280}  # Rendition names and their maximum width and height
+    DERIVATIVE_CACHE_DIR = os.environ.get('DERIVATIVE_CACHE_DIR')  # Defaults to UPLOAD_FOLDER/.derived
+    DERIVATIVE_CACHE_MAX_BYTES = 512 * 1024 * 1024  # Least recently used renditions are removed beyond this
+    DERIVATIVE_CACHE_MAX_AGE = 7 * 24 * 60 * 60  # Browser caching of renditions, which never change
+    DERIVATIVE_MAX_IMAGE_BYTES = 64 * 1024 * 1024  # Larger encrypted images are not decoded in memory for renditions
+    PLAINTEXT_CACHE_MAX_BYTES = int(os.environ.get('PLAINTEXT_CACHE_MAX_BYTES', 0))  # Memory for decrypted hot files per process, 0 to disable
+    PLAINTEXT_CACHE_MAX_ENTRY_BYTES = 8 * 1024 * 1024  # Larger files are always streamed from storage
+    PLAINTEXT_CACHE_STATS_INTERVAL = 300  # Seconds between log lines with the cache's counters, 0 to disable
+    TEXT_PREVIEW_PAGE_BYTES = 64 * 1024  # Text sent per page of a text preview
+    TEXT_PREVIEW_LINE_INTERVAL = 1000  # Lines between the offsets kept in a text file's line index
+    
+    # Storage backends: 'local' is UPLOAD_FOLDER; add e.g. an S3-compatible bucket for cold data:
+    # {'cold': {'type': 's3', 'bucket': 'drive-cold', 'endpoint_url': 'http://minio:9000',
+    #           'access_key': '...', 'secret_key': '...'}}
+    STORAGE_BACKENDS = {}
+    STORAGE_DEFAULT = os.environ.get('STORAGE_DEFAULT', 'local')  # Backend new uploads are stored in
+    STORAGE_TIERING_RULES = []  # e.g. [{'from': 'local', 'to': 'cold', 'idle_days': 90}] for flask tier-storage
+    
+    # Listing configuration
+    FOLDER_PAGE_SIZE = 100  # Entries per page in folder listings and pickers
+    SEARCH_PAGE_SIZE = 50  # Search results per page
+    BULK_MAX_FILE_IDS = 1000  # Explicit ids per bulk request; folders and the trash can be selected whole
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'auto')  # auto (FTS5 where available) or trigram
+    CONTENT_INDEX_MAX_BYTES = 10 * 1024 * 1024  # Only the start of larger text files is indexed
+    
+    # Login cache configuration
+    USER_CACHE_SIZE = 1024  # Users whose row is kept in memory per process
+    USER_CACHE_TTL = 60  # Seconds before a cached user is loaded again
+    
+    # Background job configuration
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))  # In-process worker threads, 0 to disable
+    JOB_POLL_INTERVAL = 1.0  # Seconds between polls when the queue is idle
+    JOB_MAX_ATTEMPTS = 3
+    JOB_RETRY_DELAY = 30  # Seconds before the first retry, doubled on each attempt
+    JOB_TIMEOUT = 60 * 60  # Seconds a running job may go without a heartbeat before it is requeued
+    JOB_STALE_CHECK_INTERVAL = 60  # Seconds between checks for such jobs
+    
+    # Activity log configuration
+    ACTIVITY_BUFFER_SIZE = 100  # Buffered events that trigger a bulk insert
+    ACTIVITY_FLUSH_INTERVAL = 5.0  # Maximum seconds an event stays buffered
+    ACTIVITY_READ_SAMPLE_RATE = float(os.environ.get('ACTIVITY_READ_SAMPLE_RATE', 1.0))  # Share of downloads/previews logged individually; all are counted
     
     # Ensure upload directory exists
     @staticmethod
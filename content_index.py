@@ -0,0 +1,156 @@
+import re
+import hmac
+import codecs
+import hashlib
+
+from flask import current_app
+from sqlalchemy import func, select
+
+from encryption import master_key_bytes
+from models import db, File, ContentPosting
+
+# Words of letters, digits and underscores; shorter or longer tokens are not indexed
+TOKEN_PATTERN = re.compile(r'\w{2,64}')
+
+# Context shown around a content match, in plaintext bytes
+SNIPPET_BEFORE = 80
+SNIPPET_AFTER = 160
+
+
+def _index_key():
+    return hmac.new(master_key_bytes(current_app.config['ENCRYPTION_KEY']),
+                    b'flaskdrive content index', hashlib.sha256).digest()
+
+
+def token_keys(tokens):
+    """Map tokens to the keyed hashes stored in the index
+
+    Tokens are stored as HMACs keyed from the encryption key, so the index
+    does not expose the words of encrypted files in plaintext.
+    """
+    key = _index_key()
+    return {token: hmac.new(key, token.encode(), hashlib.sha256).hexdigest()[:32]
+            for token in tokens}
+
+
+def tokenize(chunks, max_bytes):
+    """Tokenize UTF-8 text read chunk by chunk
+
+    Args:
+        chunks: Iterable of plaintext byte strings
+        max_bytes: Stop after this many bytes
+
+    Returns:
+        Dict mapping each lowercase token to (frequency, byte offset of its first occurrence)
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    postings = {}
+    pending = ''
+    offset = 0  # Byte offset of the start of pending
+    read = 0
+
+    def scan(text, base, final):
+        # Keep a trailing partial word for the next chunk unless this is the end
+        end = len(text)
+        if not final:
+            match = re.search(r'\w*$', text)
+            end = match.start()
+        position, position_bytes = 0, base
+        for match in TOKEN_PATTERN.finditer(text, 0, end):
+            token = match.group().casefold()
+            if token in postings:
+                count, first = postings[token]
+                postings[token] = (count + 1, first)
+            else:
+                position_bytes += len(text[position:match.start()].encode())
+                position = match.start()
+                postings[token] = (1, position_bytes)
+        return text[end:], base + len(text[:end].encode())
+
+    for data in chunks:
+        data = data[:max_bytes - read]
+        read += len(data)
+        pending, offset = scan(pending + decoder.decode(data), offset, False)
+        if read >= max_bytes:
+            break
+    scan(pending + decoder.decode(b'', final=True), offset, True)
+    return postings
+
+
+def remove_postings(file_condition):
+    """Delete the postings of the files matching a condition on File.id"""
+    ContentPosting.query.filter(file_condition).delete(synchronize_session=False)
+
+
+def store_postings(file, postings):
+    """Replace a file's postings in the current session"""
+    remove_postings(ContentPosting.file_id == file.id)
+    keys = token_keys(postings)
+    rows = [{
+        'file_id': file.id,
+        'owner_id': file.owner_id,
+        'token': keys[token],
+        'frequency': count,
+        'first_offset': first
+    } for token, (count, first) in postings.items()]
+    for start in range(0, len(rows), 1000):
+        db.session.execute(ContentPosting.__table__.insert(), rows[start:start + 1000])
+
+
+def copy_postings(file):
+    """Reuse the postings of an indexed file with the same content
+
+    Returns:
+        True if postings were copied, False if no indexed copy exists
+    """
+    source_id = db.session.query(ContentPosting.file_id).join(
+        File, File.id == ContentPosting.file_id
+    ).filter(File.content_hash == file.content_hash, File.id != file.id).limit(1).scalar()
+    if source_id is None:
+        return False
+
+    remove_postings(ContentPosting.file_id == file.id)
+    posting = ContentPosting.__table__
+    db.session.execute(posting.insert().from_select(
+        ['file_id', 'owner_id', 'token', 'frequency', 'first_offset'],
+        select(db.literal(file.id), db.literal(file.owner_id), posting.c.token,
+               posting.c.frequency, posting.c.first_offset).where(posting.c.file_id == source_id)
+    ))
+    return True
+
+
+def search_content(owner_id, query, limit=20, offset=0):
+    """Find a user's files whose content contains every word of the query
+
+    Files are ranked by how often the words occur.
+
+    Returns:
+        Tuple of (list of (File, byte offset of the first query word), whether more results exist)
+    """
+    tokens = [token.casefold() for token in TOKEN_PATTERN.findall(query)]
+    if not tokens:
+        return [], False
+    keys = token_keys(tokens)
+    wanted = set(keys.values())
+
+    rows = db.session.query(
+        ContentPosting.file_id,
+        func.sum(ContentPosting.frequency).label('score'),
+        func.min(ContentPosting.first_offset)
+    ).join(File, File.id == ContentPosting.file_id).filter(
+        ContentPosting.owner_id == owner_id,
+        ContentPosting.token.in_(wanted),
+        File.is_trashed == False
+    ).group_by(ContentPosting.file_id).having(
+        func.count() == len(wanted)
+    ).order_by(func.sum(ContentPosting.frequency).desc(), ContentPosting.file_id).offset(
+        offset).limit(limit + 1).all()
+
+    # Point the snippet at the first query word
+    first_token = keys[tokens[0]]
+    offsets = dict(db.session.query(ContentPosting.file_id, ContentPosting.first_offset).filter(
+        ContentPosting.file_id.in_([row[0] for row in rows]),
+        ContentPosting.token == first_token))
+    files = {file.id: file for file in File.query.filter(File.id.in_([row[0] for row in rows[:limit]]))}
+    return ([(files[file_id], offsets.get(file_id, first)) for file_id, _, first in rows[:limit]
+             if file_id in files], len(rows) > limit)
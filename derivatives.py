@@ -0,0 +1,308 @@
+import io
+import os
+import functools
+import importlib.util
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from encryption import master_key_bytes, encrypt_chunks, decrypt_chunks
+
+# Preview types derivatives can be rendered for, with what rendering them needs
+RENDERERS = {'image': 'Pillow', 'pdf': 'pdftoppm', 'video': 'ffmpeg'}
+
+RENDER_TIMEOUT = 60  # Seconds an external renderer may take per rendition
+
+
+@functools.lru_cache(maxsize=None)
+def can_render(preview_type):
+    """Check whether derivatives of a preview type can be rendered here
+
+    Images need Pillow, PDFs poppler's pdftoppm and videos ffmpeg; without
+    them the originals are shown instead.
+    """
+    tool = RENDERERS.get(preview_type)
+    if tool is None:
+        return False
+    if tool == 'Pillow':
+        return importlib.util.find_spec('PIL') is not None
+    return shutil.which(tool) is not None
+
+
+class SourceReadError(Exception):
+    """Raised when the content being rendered cannot be read"""
+
+
+def _read(source):
+    """Iterate over the plaintext chunks of a streamed source"""
+    try:
+        yield from source()
+    except Exception as e:
+        raise SourceReadError(str(e)) from e
+
+
+def _run(args, source):
+    """Run an external renderer and get its standard output
+
+    A path source is passed on the command line. Otherwise '-' in args is
+    replaced by the renderer's own name for standard input and the content
+    is written to it, so no plaintext copy is made on disk.
+    """
+    if not callable(source):
+        args = [source if arg == '-' else arg for arg in args]
+        return subprocess.run(args, check=True, capture_output=True, timeout=RENDER_TIMEOUT).stdout
+
+    args = [('pipe:0' if args[0] == 'ffmpeg' else '-') if arg == '-' else arg for arg in args]
+    output = {}
+
+    def collect(name, pipe):
+        output[name] = pipe.read()
+
+    with subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE) as process:
+        readers = [threading.Thread(target=collect, args=(name, pipe), daemon=True)
+                   for name, pipe in (('stdout', process.stdout), ('stderr', process.stderr))]
+        for reader in readers:
+            reader.start()
+        timer = threading.Timer(RENDER_TIMEOUT, process.kill)
+        timer.start()
+        try:
+            try:
+                for data in _read(source):
+                    process.stdin.write(data)
+            except BrokenPipeError:
+                pass  # The renderer stopped reading; its exit status tells whether it succeeded
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+            for reader in readers:
+                reader.join()
+            process.wait()
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            timer.cancel()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args, output.get('stdout'),
+                                            output.get('stderr'))
+    return output['stdout']
+
+
+def _render_image(source, sizes):
+    from PIL import Image, ImageOps
+
+    if callable(source):
+        source = io.BytesIO(b''.join(_read(source)))
+
+    renditions = {}
+    with Image.open(source) as image:
+        # JPEGs are decoded at a reduced scale straight away
+        largest = max(sizes.values())
+        image.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        # Each smaller size is scaled down from the previous one
+        for name, size in sorted(sizes.items(), key=lambda item: -item[1]):
+            image.thumbnail((size, size))
+            output = io.BytesIO()
+            image.save(output, 'JPEG', quality=82, optimize=True)
+            renditions[name] = output.getvalue()
+    return renditions
+
+
+def _render_pdf(source, sizes):
+    # Without an output root pdftoppm writes the single page to stdout
+    return {name: _run(['pdftoppm', '-f', '1', '-l', '1', '-singlefile', '-jpeg',
+                        '-scale-to', str(size), '-'], source)
+            for name, size in sizes.items()}
+
+
+def _render_video(source, sizes):
+    renditions = {}
+    for name, size in sizes.items():
+        scale = f"scale='min(iw,{size})':'min(ih,{size})':force_original_aspect_ratio=decrease"
+        # A frame one second in avoids black opening frames; short clips use the first
+        for offset in ('1', '0'):
+            data = _run(['ffmpeg', '-v', 'error', '-ss', offset, '-i', '-', '-frames:v', '1',
+                         '-vf', scale, '-f', 'image2', '-c:v', 'mjpeg', 'pipe:1'], source)
+            if data:
+                renditions[name] = data
+                break
+    return renditions
+
+
+def render_derivatives(preview_type, source, sizes):
+    """Render downscaled JPEG renditions of an image, PDF or video
+
+    Content stored as is is read from its path. Encrypted or compressed
+    content is streamed: images are decoded from memory, and PDFs and
+    videos are piped to pdftoppm and ffmpeg, so no plaintext copy is ever
+    written to disk. Videos that can only be read with seeking (MP4 with
+    its index at the end) cannot be rendered from a pipe.
+
+    Args:
+        preview_type: 'image', 'pdf' or 'video'
+        source: Path of the plaintext content on the local file system, or
+            a callable returning an iterable of its plaintext chunks (it is
+            called once per renderer run)
+        sizes: Dict mapping rendition names to their maximum width and height
+
+    Returns:
+        Dict mapping rendition names to JPEG data
+
+    Raises:
+        SourceReadError: If a streamed source fails, as opposed to the renderer
+    """
+    renderer = {'image': _render_image, 'pdf': _render_pdf, 'video': _render_video}[preview_type]
+    return renderer(source, sizes)
+
+
+class DerivativeCache:
+    """Size-bounded on-disk cache of rendered derivatives, encrypted at rest
+
+    Entries are keyed by the content they were rendered from, so files with
+    the same content share them, and are written in the segmented
+    encryption format. Reading an entry touches its modification time;
+    when the cache grows past DERIVATIVE_CACHE_MAX_BYTES the least recently
+    used entries are removed. Entries of deleted content are left to age
+    out the same way.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._size = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('DERIVATIVE_CACHE_DIR', None)
+        app.config.setdefault('DERIVATIVE_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+        app.config.setdefault('DERIVATIVE_SIZES', {'thumb': 256, 'preview': 1280})
+        app.config.setdefault('DERIVATIVE_CACHE_MAX_AGE', 7 * 24 * 60 * 60)
+        app.config.setdefault('DERIVATIVE_MAX_IMAGE_BYTES', 64 * 1024 * 1024)
+
+    @property
+    def directory(self):
+        return (self.app.config['DERIVATIVE_CACHE_DIR'] or
+                os.path.join(self.app.config['UPLOAD_FOLDER'], '.derived'))
+
+    def _path(self, key, name):
+        return os.path.join(self.directory, key[:2], f'{key}.{name}')
+
+    def _master_key(self):
+        return master_key_bytes(self.app.config['ENCRYPTION_KEY'])
+
+    def has(self, key, name):
+        return os.path.exists(self._path(key, name))
+
+    def get(self, key, name):
+        """Read a cached derivative
+
+        Returns:
+            The plaintext data, b'' if rendering failed before, or None if
+            the derivative is not cached
+        """
+        path = self._path(key, name)
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b''
+                data = b''.join(decrypt_chunks(self._master_key(), f))
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key, name, data):
+        """Store a derivative; empty data marks content that cannot be rendered"""
+        path = self._path(key, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.write-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if data:
+                    for part in encrypt_chunks(self._master_key(), [data]):
+                        f.write(part)
+                written = f.tell()
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        with self._lock:
+            if self._size is not None:
+                self._size += written
+            over = self._size is None or self._size > self.app.config['DERIVATIVE_CACHE_MAX_BYTES']
+        if over:
+            self.evict()
+
+    def _entries(self):
+        entries = []
+        try:
+            shards = os.scandir(self.directory)
+        except FileNotFoundError:
+            return entries
+        with shards:
+            for shard in shards:
+                if not shard.is_dir(follow_symlinks=False):
+                    continue
+                with os.scandir(shard.path) as files:
+                    for entry in files:
+                        if entry.name.startswith('.'):
+                            continue
+                        try:
+                            stat = entry.stat(follow_symlinks=False)
+                        except FileNotFoundError:
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """Remove least recently used entries until the cache is within its bound
+
+        Eviction goes down to 90% of the bound, so it does not run on every
+        write once the cache is full.
+
+        Returns:
+            Number of entries removed
+        """
+        max_bytes = self.app.config['DERIVATIVE_CACHE_MAX_BYTES']
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        if total > max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+
+        with self._lock:
+            self._size = total
+        return removed
+
+    def clear(self):
+        """Remove every cached derivative"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        with self._lock:
+            self._size = 0
+
+
+derivative_cache = DerivativeCache()
@@ -0,0 +1,202 @@
+import os
+import struct
+import base64
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# Values stored in File.encryption_version
+LEGACY_FERNET = 1
+SEGMENTED_AES_GCM = 2
+
+# Header layout: magic, format version, plaintext chunk size, key salt, nonce prefix
+MAGIC = b'FDSE'
+HEADER = struct.Struct('>4sBI16s7s')
+TAG_SIZE = 16
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+class DecryptionError(Exception):
+    """Raised when an encrypted stream is malformed, truncated or tampered with"""
+
+
+def master_key_bytes(encryption_key):
+    """Decode the configured Fernet key (urlsafe base64) into raw key material"""
+    if isinstance(encryption_key, str):
+        encryption_key = encryption_key.encode()
+    return base64.urlsafe_b64decode(encryption_key)
+
+
+def _derive_key(master_key, salt):
+    """Derive the per-file AES-256 key from the master key and the header salt"""
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt,
+                info=b'flaskdrive segmented stream v2')
+    return AESGCM(hkdf.derive(master_key))
+
+
+def _nonce(prefix, index, last):
+    """Build the 12 byte nonce for a chunk: prefix, big-endian counter and last-chunk flag"""
+    return prefix + struct.pack('>IB', index, 1 if last else 0)
+
+
+def is_segmented(prefix):
+    """Check whether the leading bytes of a stored file carry the segmented header"""
+    return prefix[:len(MAGIC)] == MAGIC
+
+
+def encrypted_chunk_size(chunk_size):
+    """Size on disk of one full encrypted chunk"""
+    return chunk_size + TAG_SIZE
+
+
+def plaintext_size(ciphertext_size, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Compute the plaintext length of a segmented file from its size on disk"""
+    body = ciphertext_size - HEADER.size
+    if body < TAG_SIZE:
+        raise DecryptionError('Encrypted file is truncated')
+    segment = encrypted_chunk_size(chunk_size)
+    chunk_count = -(-body // segment)
+    return body - chunk_count * TAG_SIZE
+
+
+def read_header(fileobj):
+    """Read and validate the stream header
+
+    Returns:
+        Tuple of (raw header bytes, chunk size, salt, nonce prefix)
+    """
+    raw = fileobj.read(HEADER.size)
+    if len(raw) != HEADER.size:
+        raise DecryptionError('Encrypted file is truncated')
+    magic, version, chunk_size, salt, prefix = HEADER.unpack(raw)
+    if magic != MAGIC or version != SEGMENTED_AES_GCM or chunk_size <= 0:
+        raise DecryptionError('Unsupported encryption header')
+    return raw, chunk_size, salt, prefix
+
+
+class StreamEncryptor:
+    """Encrypt data into the segmented format as it is written
+
+    The push-style counterpart of encrypt_chunks() for data that arrives in
+    writes rather than from an iterable, such as a request body being
+    parsed. Only one chunk is buffered.
+
+    Args:
+        master_key: Raw master key bytes (see master_key_bytes)
+        chunk_size: Plaintext bytes per encrypted chunk
+    """
+
+    def __init__(self, master_key, chunk_size=DEFAULT_CHUNK_SIZE):
+        salt = os.urandom(16)
+        self._prefix = os.urandom(7)
+        self.header = HEADER.pack(MAGIC, SEGMENTED_AES_GCM, chunk_size, salt, self._prefix)
+        self._aead = _derive_key(master_key, salt)
+        self._chunk_size = chunk_size
+        self._index = 0
+        self._buffer = bytearray()
+
+    def update(self, data):
+        """Add plaintext and get the chunks that could be sealed, joined (possibly b'')"""
+        self._buffer += data
+        sealed = []
+        while len(self._buffer) > self._chunk_size:
+            block = bytes(self._buffer[:self._chunk_size])
+            del self._buffer[:self._chunk_size]
+            sealed.append(self._aead.encrypt(_nonce(self._prefix, self._index, False), block, self.header))
+            self._index += 1
+        return b''.join(sealed)
+
+    def finalize(self):
+        """Seal the final chunk, flagged so truncation is detected on decryption"""
+        # The last chunk may be empty (empty file) or exactly chunk_size bytes
+        return self._aead.encrypt(_nonce(self._prefix, self._index, True), bytes(self._buffer), self.header)
+
+
+def encrypt_chunks(master_key, chunks, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Encrypt an iterable of plaintext byte strings into the segmented format
+
+    The plaintext is re-blocked into fixed-size chunks, each sealed with
+    AES-GCM under its own nonce. The final chunk is flagged in its nonce so
+    truncation is detected on decryption. Only one chunk is held in memory.
+
+    Args:
+        master_key: Raw master key bytes (see master_key_bytes)
+        chunks: Iterable of plaintext byte strings of any size
+        chunk_size: Plaintext bytes per encrypted chunk
+
+    Yields:
+        The header followed by the encrypted chunks
+    """
+    encryptor = StreamEncryptor(master_key, chunk_size)
+    yield encryptor.header
+    for data in chunks:
+        sealed = encryptor.update(data)
+        if sealed:
+            yield sealed
+    yield encryptor.finalize()
+
+
+def decrypt_chunks(master_key, fileobj):
+    """Decrypt a segmented stream one chunk at a time
+
+    Args:
+        master_key: Raw master key bytes (see master_key_bytes)
+        fileobj: Binary file object positioned at the start of the header
+
+    Yields:
+        Plaintext chunks
+    """
+    header, chunk_size, salt, prefix = read_header(fileobj)
+    aead = _derive_key(master_key, salt)
+    segment = encrypted_chunk_size(chunk_size)
+
+    index = 0
+    current = fileobj.read(segment)
+    while True:
+        following = fileobj.read(segment) if len(current) == segment else b''
+        last = not following
+        try:
+            yield aead.decrypt(_nonce(prefix, index, last), current, header)
+        except InvalidTag:
+            raise DecryptionError(f'Authentication failed for chunk {index}')
+        if last:
+            return
+        current = following
+        index += 1
+
+
+def decrypt_range(master_key, fileobj, ciphertext_size, start, stop):
+    """Decrypt only the chunks overlapping a plaintext byte range
+
+    Args:
+        master_key: Raw master key bytes (see master_key_bytes)
+        fileobj: Seekable binary file object of the encrypted file
+        ciphertext_size: Size of the encrypted file on disk
+        start: First plaintext byte to return
+        stop: Plaintext offset to stop at (exclusive)
+
+    Yields:
+        Plaintext bytes in the requested range
+    """
+    fileobj.seek(0)
+    header, chunk_size, salt, prefix = read_header(fileobj)
+    aead = _derive_key(master_key, salt)
+    segment = encrypted_chunk_size(chunk_size)
+
+    index = start // chunk_size
+    position = index * chunk_size
+    fileobj.seek(HEADER.size + index * segment)
+    while position < stop:
+        offset = HEADER.size + index * segment
+        last = offset + segment >= ciphertext_size
+        try:
+            block = aead.decrypt(_nonce(prefix, index, last), fileobj.read(segment), header)
+        except InvalidTag:
+            raise DecryptionError(f'Authentication failed for chunk {index}')
+        yield block[max(start - position, 0):stop - position]
+        if last:
+            return
+        position += chunk_size
+        index += 1
@@ -0,0 +1,220 @@
+import json
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from models import db, Job
+
+
+class JobQueue:
+    """Database-backed job queue with an in-process worker pool
+
+    Jobs are rows in the ``job`` table, so they survive restarts and can be
+    processed by the web workers' threads or by a separate ``flask run-jobs``
+    process. Workers claim a job with a conditional UPDATE, so a job is only
+    ever run by one worker even when several processes poll the same table.
+    A job whose worker died is requeued once it has not been touched for
+    JOB_TIMEOUT seconds; long jobs call heartbeat() to stay claimed.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.handlers = {}
+        self.threads = []
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+        self._local = threading.local()
+        self._next_stale_check = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('JOB_WORKERS', 2)
+        app.config.setdefault('JOB_POLL_INTERVAL', 1.0)
+        app.config.setdefault('JOB_MAX_ATTEMPTS', 3)
+        app.config.setdefault('JOB_RETRY_DELAY', 30)
+        app.config.setdefault('JOB_TIMEOUT', 60 * 60)
+        app.config.setdefault('JOB_STALE_CHECK_INTERVAL', 60)
+
+    def task(self, kind, on_failure=None):
+        """Register a function as the handler for a job kind
+
+        Args:
+            kind: Name the job is enqueued under
+            on_failure: Optional callback run with the job's payload once
+                        the job has failed for the last time
+        """
+        def decorator(func):
+            self.handlers[kind] = (func, on_failure)
+            return func
+        return decorator
+
+    def enqueue(self, kind, max_attempts=None, delay=0, **payload):
+        """Add a job to the current database session
+
+        The job becomes visible to workers when the caller commits, so it is
+        only run if the surrounding transaction succeeds.
+
+        Returns:
+            The new Job
+        """
+        job = Job(
+            kind=kind,
+            payload=json.dumps(payload),
+            max_attempts=max_attempts or self.app.config['JOB_MAX_ATTEMPTS'],
+            run_after=datetime.utcnow() + timedelta(seconds=delay)
+        )
+        db.session.add(job)
+        self._wakeup.set()
+        return job
+
+    def enqueue_once(self, kind, **payload):
+        """Add a job unless the same job is still waiting or running
+
+        Returns:
+            The new Job, or None if an identical one is already queued
+        """
+        queued = Job.query.filter(Job.kind == kind, Job.payload == json.dumps(payload),
+                                  Job.status.in_(['pending', 'running'])).first()
+        if queued is not None:
+            return None
+        return self.enqueue(kind, **payload)
+
+    def start(self, workers=None):
+        """Start the worker threads if they are not running yet"""
+        with self._start_lock:
+            if self.threads:
+                return
+            workers = self.app.config['JOB_WORKERS'] if workers is None else workers
+            self._stopping.clear()
+            for number in range(workers):
+                thread = threading.Thread(target=self._work, name=f'job-worker-{number}',
+                                          daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        """Ask the worker threads to finish their current job and exit"""
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def run_pending(self, limit=None):
+        """Run due jobs in the calling thread
+
+        Returns:
+            Number of jobs run
+        """
+        count = 0
+        while limit is None or count < limit:
+            if not self._run_next():
+                break
+            count += 1
+        return count
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                ran = self._run_next()
+            except Exception:
+                traceback.print_exc()
+                ran = False
+            if not ran:
+                self._wakeup.wait(self.app.config['JOB_POLL_INTERVAL'])
+                self._wakeup.clear()
+
+    def heartbeat(self):
+        """Mark the job running in the calling thread as still alive
+
+        Jobs that may run longer than JOB_TIMEOUT call this regularly; it
+        writes at most a few times per JOB_TIMEOUT, through its own
+        connection so the job's session is not committed.
+        """
+        job_id = getattr(self._local, 'job_id', None)
+        if job_id is None:
+            return
+        now = time.monotonic()
+        if now - self._local.beat < self.app.config['JOB_TIMEOUT'] / 4:
+            return
+        self._local.beat = now
+        with db.engine.begin() as connection:
+            connection.execute(Job.__table__.update().where(Job.id == job_id).values(
+                updated_at=datetime.utcnow()))
+
+    def _requeue_stale(self):
+        """Requeue running jobs whose worker stopped touching them
+
+        Runs at most every JOB_STALE_CHECK_INTERVAL seconds and only writes
+        when a stale job is found, so idle polls stay read-only.
+        """
+        if time.monotonic() < self._next_stale_check:
+            return
+        self._next_stale_check = time.monotonic() + self.app.config['JOB_STALE_CHECK_INTERVAL']
+
+        stale = datetime.utcnow() - timedelta(seconds=self.app.config['JOB_TIMEOUT'])
+        condition = (Job.status == 'running', Job.updated_at < stale)
+        stale_ids = [job_id for (job_id,) in Job.query.with_entities(Job.id).filter(*condition)]
+        if stale_ids:
+            Job.query.filter(Job.id.in_(stale_ids), *condition).update(
+                {Job.status: 'pending'}, synchronize_session=False)
+            db.session.commit()
+
+    def _claim(self):
+        """Claim the oldest due job, requeueing jobs whose worker died"""
+        self._requeue_stale()
+
+        now = datetime.utcnow()
+        candidates = Job.query.with_entities(Job.id).filter(
+            Job.status == 'pending', Job.run_after <= now
+        ).order_by(Job.run_after, Job.id).limit(5).all()
+        for (job_id,) in candidates:
+            claimed = Job.query.filter(Job.id == job_id, Job.status == 'pending').update(
+                {Job.status: 'running', Job.attempts: Job.attempts + 1, Job.updated_at: now},
+                synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return Job.query.get(job_id)
+        return None
+
+    def _run_next(self):
+        with self.app.app_context():
+            job = self._claim()
+            if job is None:
+                return False
+
+            handler, on_failure = self.handlers.get(job.kind, (None, None))
+            payload = json.loads(job.payload or '{}')
+            self._local.job_id = job.id
+            self._local.beat = time.monotonic()
+            try:
+                if handler is None:
+                    raise LookupError(f'No handler registered for job kind {job.kind!r}')
+                handler(**payload)
+            except Exception as e:
+                db.session.rollback()
+                print(f"Job {job.id} ({job.kind}) failed: {e}")
+                job.last_error = traceback.format_exc()[-2000:]
+                if job.attempts < job.max_attempts:
+                    # Back off exponentially before the next attempt
+                    delay = self.app.config['JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1)
+                    job.status = 'pending'
+                    job.run_after = datetime.utcnow() + timedelta(seconds=delay)
+                else:
+                    job.status = 'failed'
+                    if on_failure is not None:
+                        on_failure(**payload)
+            else:
+                job.status = 'done'
+                job.last_error = None
+            finally:
+                self._local.job_id = None
+            db.session.commit()
+            return True
+
+
+job_queue = JobQueue()
@@ -1,12 +1,19 @@
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy.dialects import mysql
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
 import uuid
 
 db = SQLAlchemy()
 
+# Folder paths must compare byte by byte for Folder.path_startswith; SQLite
+# already does, PostgreSQL and MySQL need a binary collation on the column
+FOLDER_PATH_TYPE = db.String(1024).with_variant(
+    db.String(1024, collation='C'), 'postgresql').with_variant(
+    mysql.VARCHAR(1024, charset='ascii', collation='ascii_bin'), 'mysql')
+
 # Association table for file sharing
 shares = db.Table('shares',
     db.Column('file_id', db.Integer, db.ForeignKey('file.id'), primary_key=True),
@@ -15,6 +22,14 @@ shares = db.Table('shares',
     db.Column('shared_on', db.DateTime, default=datetime.utcnow)
 )
 
+# Association table for folder sharing; access is inherited by everything below the folder
+folder_shares = db.Table('folder_shares',
+    db.Column('folder_id', db.Integer, db.ForeignKey('folder.id'), primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True, index=True),
+    db.Column('permission', db.String(20), default='view'),  # view, edit
+    db.Column('shared_on', db.DateTime, default=datetime.utcnow)
+)
+
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), unique=True, nullable=False)
@@ -22,6 +37,12 @@ class User(db.Model, UserMixin):
     password_hash = db.Column(db.String(128))
     storage_used = db.Column(db.BigInteger, default=0)  # Storage used in bytes
     storage_limit = db.Column(db.BigInteger, default=1073741824)  # 1GB default
+    
+    # Cached counters, kept up to date by the routes that change them (see rebuild_user_counters)
+    file_count = db.Column(db.Integer, default=0)  # Owned files not in the trash
+    starred_count = db.Column(db.Integer, default=0)  # Starred files not in the trash
+    trashed_count = db.Column(db.Integer, default=0)  # Owned files in the trash
+    shared_count = db.Column(db.Integer, default=0)  # Files shared with this user, not in the trash
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -48,10 +69,16 @@ class User(db.Model, UserMixin):
 
 
 class Folder(db.Model):
+    __table_args__ = (
+        db.Index('ix_folder_parent_name', 'parent_id', 'name', 'id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), nullable=False)
     owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     parent_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=True)
+    # Materialized path of ancestor ids, e.g. '/1/5/' for a folder inside 5 inside 1
+    path = db.Column(FOLDER_PATH_TYPE, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -60,20 +87,88 @@ class Folder(db.Model):
     subfolders = db.relationship('Folder', backref=db.backref('parent', remote_side=[id]), 
                                lazy='dynamic')
     
+    @property
+    def ancestor_ids(self):
+        """IDs of the folders above this one, from the root down"""
+        return [int(part) for part in (self.path or '').split('/') if part]
+    
+    @property
+    def subtree_prefix(self):
+        """Path shared by every folder below this one"""
+        return f'{self.path}{self.id}/'
+    
+    def set_parent(self, parent):
+        """Place the folder under a parent (or at the root) and set its path
+        
+        Raises:
+            ValueError: If the parent has no materialized path yet (see ensure_folder_path)
+        """
+        if parent is not None and parent.path is None:
+            raise ValueError(f'Folder {parent.id} has no materialized path')
+        self.parent_id = parent.id if parent else None
+        self.path = parent.subtree_prefix if parent else '/'
+    
+    @staticmethod
+    def path_startswith(prefix):
+        """Condition matching folders whose path starts with a prefix
+        
+        Expressed as a range rather than LIKE so it can use the plain path
+        index. Paths only contain digits and '/', and '0' sorts directly
+        after '/' in byte order, which is why the column is declared with a
+        binary collation (FOLDER_PATH_TYPE).
+        """
+        return db.and_(Folder.path >= prefix, Folder.path < prefix[:-1] + '0')
+    
     def __repr__(self):
         return f'<Folder {self.name}>'
 
 
+class Blob(db.Model):
+    """Content-addressed stored data, shared by every File with the same content"""
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), unique=True, nullable=False)  # SHA-256 of the plaintext
+    file_path = db.Column(db.String(255), unique=True, nullable=False)
+    storage = db.Column(db.String(20), nullable=True)  # Storage backend name, None for 'local'
+    size = db.Column(db.BigInteger)  # Plaintext size in bytes
+    is_encrypted = db.Column(db.Boolean, default=False)
+    encryption_version = db.Column(db.Integer, nullable=True)
+    codec = db.Column(db.String(10), nullable=True)  # Compression applied before encryption, None if stored as is
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    files = db.relationship('File', backref='blob', lazy='dynamic')
+    
+    def __repr__(self):
+        return f'<Blob {self.sha256}>'
+
+
 class File(db.Model):
+    __table_args__ = (
+        db.Index('ix_file_owner_blob', 'owner_id', 'blob_id'),
+        db.Index('ix_file_blob', 'blob_id'),
+        db.Index('ix_file_folder_name', 'folder_id', 'is_trashed', 'original_filename', 'id'),
+        db.Index('ix_file_folder_updated', 'folder_id', 'is_trashed', 'updated_at', 'id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     original_filename = db.Column(db.String(255), nullable=False)
     file_type = db.Column(db.String(100))
     file_size = db.Column(db.BigInteger)  # Size in bytes
-    file_path = db.Column(db.String(255), unique=True, nullable=False)
+    file_path = db.Column(db.String(255), nullable=False)  # Shared by files with the same blob
+    storage = db.Column(db.String(20), nullable=True)  # Copied from the blob, None for 'local'
+    blob_id = db.Column(db.Integer, db.ForeignKey('blob.id'), nullable=True)
+    content_hash = db.Column(db.String(64), index=True)  # SHA-256 of the plaintext
     is_starred = db.Column(db.Boolean, default=False)
     is_trashed = db.Column(db.Boolean, default=False)
     is_encrypted = db.Column(db.Boolean, default=False)
+    encryption_version = db.Column(db.Integer, nullable=True)  # 1 = legacy Fernet, 2 = segmented AES-GCM
+    codec = db.Column(db.String(10), nullable=True)  # Copied from the blob: 'zlib', 'zstd' or None
+    status = db.Column(db.String(20), default='ready', nullable=False)  # processing, ready, failed
+    download_count = db.Column(db.Integer, default=0)
+    preview_count = db.Column(db.Integer, default=0)
+    last_accessed_at = db.Column(db.DateTime, nullable=True)
     owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -91,6 +186,97 @@ class File(db.Model):
         return f'<File {self.original_filename}>'
 
 
+class UploadSession(db.Model):
+    """A resumable upload whose chunks are received independently"""
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    content_type = db.Column(db.String(100))
+    total_size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=True)  # Optional, declared by the client
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id'), nullable=True)  # Set once completed
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    
+    @property
+    def chunk_count(self):
+        """Number of chunks the upload is split into (at least one)"""
+        return max(1, -(-self.total_size // self.chunk_size))
+    
+    def expected_chunk_size(self, index):
+        """Size in bytes that chunk number ``index`` must have"""
+        if index < self.chunk_count - 1:
+            return self.chunk_size
+        return self.total_size - self.chunk_size * (self.chunk_count - 1)
+    
+    def __repr__(self):
+        return f'<UploadSession {self.id} {self.filename}>'
+
+
+class Job(db.Model):
+    """Background work item processed by the job queue (see jobs.py)"""
+    __table_args__ = (
+        db.Index('ix_job_status_run_after', 'status', 'run_after'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text)  # JSON encoded keyword arguments
+    status = db.Column(db.String(20), default='pending', nullable=False)  # pending, running, done, failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    max_attempts = db.Column(db.Integer, default=3, nullable=False)
+    last_error = db.Column(db.Text)
+    run_after = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind} {self.status}>'
+
+
+class SearchTrigram(db.Model):
+    """Trigram index of file and folder names (see search_index.py)
+    
+    Used when the database has no SQLite FTS5 trigram tokenizer; on SQLite
+    with FTS5 the names are indexed in the search_fts virtual table instead.
+    """
+    __tablename__ = 'search_trigram'
+    __table_args__ = (
+        db.Index('ix_search_trigram_lookup', 'owner_id', 'kind', 'trigram'),
+    )
+    
+    kind = db.Column(db.String(10), primary_key=True)  # file, folder
+    item_id = db.Column(db.Integer, primary_key=True)
+    trigram = db.Column(db.String(3), primary_key=True)
+    owner_id = db.Column(db.Integer, nullable=False)
+    
+    def __repr__(self):
+        return f'<SearchTrigram {self.kind} {self.item_id} {self.trigram!r}>'
+
+
+class ContentPosting(db.Model):
+    """Inverted index of the words in text files (see content_index.py)
+    
+    Each row says that a word occurs in a file. Words are stored as keyed
+    hashes, so the index does not reveal the content of encrypted files.
+    """
+    __tablename__ = 'content_posting'
+    __table_args__ = (
+        db.Index('ix_content_posting_lookup', 'owner_id', 'token'),
+    )
+    
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id'), primary_key=True)
+    token = db.Column(db.String(32), primary_key=True)  # Truncated HMAC-SHA256 of the word
+    owner_id = db.Column(db.Integer, nullable=False)
+    frequency = db.Column(db.Integer, default=1, nullable=False)
+    first_offset = db.Column(db.BigInteger, default=0, nullable=False)  # Plaintext byte offset of the first occurrence
+    
+    def __repr__(self):
+        return f'<ContentPosting {self.file_id} {self.token}>'
+
+
 class Activity(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -0,0 +1,158 @@
+from flask import g
+from sqlalchemy import select, or_, literal
+
+from models import db, User, Folder, shares, folder_shares
+
+# Access levels, weakest first
+VIEW = 'view'
+EDIT = 'edit'
+OWNER = 'owner'
+LEVELS = {VIEW: 1, EDIT: 2, OWNER: 3}
+
+
+def get_share_permission(file_id, user_id):
+    """Look up the permission of a single share with a primary key lookup on shares
+
+    Returns:
+        'view', 'edit' or None if the file is not shared with the user
+    """
+    return db.session.execute(select(shares.c.permission).where(
+        shares.c.file_id == file_id, shares.c.user_id == user_id)).scalar()
+
+
+def strongest(permissions):
+    """Pick the highest access level from a list, or None if it is empty"""
+    return max(permissions, key=lambda permission: LEVELS.get(permission, 0), default=None)
+
+
+def get_inherited_permission(folder_id, user_id):
+    """Get the access a user has on a folder through shares of it or its ancestors
+
+    The ancestors are read from the folder's materialized path inside the
+    same query, so this is a single lookup however deep the folder is.
+
+    Returns:
+        'view', 'edit' or None
+    """
+    folder = db.aliased(Folder)
+    ancestor = literal('/') + db.cast(folder_shares.c.folder_id, db.String) + literal('/')
+    rows = db.session.execute(select(folder_shares.c.permission).join(
+        folder, folder.id == folder_id
+    ).where(
+        folder_shares.c.user_id == user_id,
+        or_(folder_shares.c.folder_id == folder.id, folder.path.contains(ancestor))
+    )).scalars().all()
+    return strongest(rows)
+
+
+def _folder_shares_above(user, folder):
+    """Get the user's shares on a folder and its ancestors as {folder id: permission}"""
+    memo = g.setdefault('folder_permissions', {})
+    key = (user.id, folder.id)
+    if key not in memo:
+        memo[key] = dict(db.session.execute(select(
+            folder_shares.c.folder_id, folder_shares.c.permission
+        ).where(
+            folder_shares.c.user_id == user.id,
+            folder_shares.c.folder_id.in_([folder.id] + folder.ancestor_ids)
+        )).all())
+    return memo[key]
+
+
+def get_folder_permission(user, folder):
+    """Get a user's access level on a folder, including access inherited from ancestors
+
+    Returns:
+        'owner', 'edit', 'view' or None if the user has no access
+    """
+    if folder.owner_id == user.id:
+        return OWNER
+    return strongest(_folder_shares_above(user, folder).values())
+
+
+def get_shared_root_id(user, folder):
+    """Get the id of the topmost folder shared with the user at or above a folder"""
+    shared = _folder_shares_above(user, folder)
+    return next((folder_id for folder_id in folder.ancestor_ids + [folder.id]
+                 if folder_id in shared), None)
+
+
+def get_file_permission(user, file):
+    """Get a user's access level on a file
+
+    A file is accessible when it is shared directly or lies anywhere below
+    a shared folder. Answers are memoized for the rest of the request, so
+    repeated checks of the same file cost two queries at most.
+
+    Args:
+        user: User (or current_user) asking for access
+        file: File being accessed
+
+    Returns:
+        'owner', 'edit', 'view' or None if the user has no access
+    """
+    if file.owner_id == user.id:
+        return OWNER
+
+    memo = g.setdefault('file_permissions', {})
+    key = (user.id, file.id)
+    if key not in memo:
+        permission = get_share_permission(file.id, user.id)
+        if permission is None and file.folder_id is not None:
+            permission = get_inherited_permission(file.folder_id, user.id)
+        memo[key] = permission
+    return memo[key]
+
+
+def has_file_permission(user, file, required=VIEW):
+    """Check whether a user has at least the required access level on a file"""
+    permission = get_file_permission(user, file)
+    return permission is not None and LEVELS.get(permission, 0) >= LEVELS[required]
+
+
+def forget_file_permissions(file_id):
+    """Drop memoized answers for a file after its shares changed in this request"""
+    memo = g.get('file_permissions')
+    if memo:
+        for key in [key for key in memo if key[1] == file_id]:
+            del memo[key]
+
+
+def forget_folder_permissions():
+    """Drop all memoized answers after folder shares changed in this request"""
+    g.pop('folder_permissions', None)
+    g.pop('file_permissions', None)
+
+
+def list_file_shares(file_id):
+    """Get everyone a file is shared with, in one query
+
+    Returns:
+        List of dicts with the user's id, username, email and permission
+    """
+    rows = db.session.query(User.id, User.username, User.email, shares.c.permission).join(
+        shares, shares.c.user_id == User.id
+    ).filter(shares.c.file_id == file_id).order_by(shares.c.shared_on, User.id).all()
+    return [{
+        'id': user_id,
+        'username': username,
+        'email': email,
+        'permission': permission or VIEW
+    } for user_id, username, email, permission in rows]
+
+
+def list_folder_shares(folder_id):
+    """Get everyone a folder is shared with directly, in one query
+
+    Returns:
+        List of dicts with the user's id, username, email and permission
+    """
+    rows = db.session.query(User.id, User.username, User.email, folder_shares.c.permission).join(
+        folder_shares, folder_shares.c.user_id == User.id
+    ).filter(folder_shares.c.folder_id == folder_id).order_by(folder_shares.c.shared_on, User.id).all()
+    return [{
+        'id': user_id,
+        'username': username,
+        'email': email,
+        'permission': permission or VIEW
+    } for user_id, username, email, permission in rows]
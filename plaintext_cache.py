@@ -0,0 +1,138 @@
+import threading
+from collections import OrderedDict
+
+
+class PlaintextCache:
+    """Byte-bounded LRU cache of decrypted file content, held in memory only
+
+    Serves repeated downloads and previews of small, popular encrypted files
+    without reading and decrypting them again. Entries are keyed by file id
+    and checked against the file's updated_at, so an entry is never served
+    for a renamed file; renames, trashing and permanent deletes also drop
+    entries explicitly. The cache is off unless PLAINTEXT_CACHE_MAX_BYTES is
+    set, files larger than PLAINTEXT_CACHE_MAX_ENTRY_BYTES are never cached,
+    and content is only ever kept in this process's memory. While enabled,
+    the counters are logged every PLAINTEXT_CACHE_STATS_INTERVAL seconds.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.thread = None
+        self._stopping = threading.Event()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'rejected': 0, 'invalidations': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('PLAINTEXT_CACHE_MAX_BYTES', 0)
+        app.config.setdefault('PLAINTEXT_CACHE_MAX_ENTRY_BYTES', 8 * 1024 * 1024)
+        app.config.setdefault('PLAINTEXT_CACHE_STATS_INTERVAL', 300)
+
+    def accepts(self, size):
+        """Check whether content of a given size would be cached"""
+        max_bytes = self.app.config['PLAINTEXT_CACHE_MAX_BYTES']
+        return bool(max_bytes) and size <= min(max_bytes, self.app.config['PLAINTEXT_CACHE_MAX_ENTRY_BYTES'])
+
+    def get(self, file_id, version):
+        """Get the cached content of a file
+
+        Args:
+            file_id: ID of the file
+            version: The file's updated_at; older entries are dropped
+
+        Returns:
+            The plaintext, or None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(file_id)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(file_id)
+                self._stats['hits'] += 1
+                return entry[1]
+            if entry is not None:
+                self._remove(file_id)
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, file_id, version, data):
+        """Cache a file's content, evicting the least recently used entries to make room"""
+        if not self.accepts(len(data)):
+            with self._lock:
+                self._stats['rejected'] += 1
+            return
+
+        max_bytes = self.app.config['PLAINTEXT_CACHE_MAX_BYTES']
+        with self._lock:
+            self._remove(file_id)
+            self._entries[file_id] = (version, data)
+            self._size += len(data)
+            while self._size > max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def _remove(self, file_id):
+        entry = self._entries.pop(file_id, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def invalidate(self, *file_ids):
+        """Drop the entries of files right away"""
+        with self._lock:
+            for file_id in file_ids:
+                if file_id in self._entries:
+                    self._remove(file_id)
+                    self._stats['invalidations'] += 1
+
+    def stats(self):
+        """Get the counters of the cache along with its current size
+
+        Returns:
+            Dict of hits, misses, evictions, rejected (too large to cache),
+            invalidations, entries and bytes
+        """
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._size)
+
+    def log_stats(self):
+        """Print the counters as one line"""
+        stats = self.stats()
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = stats['hits'] / lookups * 100 if lookups else 0
+        print(f"Plaintext cache: {stats['entries']} entries, {stats['bytes']} bytes, "
+              f"{stats['hits']} hits, {stats['misses']} misses ({hit_rate:.1f}% hit rate), "
+              f"{stats['evictions']} evictions, {stats['rejected']} rejected, "
+              f"{stats['invalidations']} invalidations")
+
+    def start(self):
+        """Start a thread that logs the counters periodically, if the cache and the log are enabled"""
+        config = self.app.config
+        if not config['PLAINTEXT_CACHE_MAX_BYTES'] or not config['PLAINTEXT_CACHE_STATS_INTERVAL']:
+            return
+        with self._lock:
+            if self.thread is not None:
+                return
+            self._stopping.clear()
+            self.thread = threading.Thread(target=self._work, name='plaintext-cache-stats', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _work(self):
+        while not self._stopping.wait(self.app.config['PLAINTEXT_CACHE_STATS_INTERVAL']):
+            self.log_stats()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+plaintext_cache = PlaintextCache()
@@ -0,0 +1,255 @@
+import unicodedata
+
+from flask import current_app
+from sqlalchemy import DDL, case, event, func, text
+
+from models import db, File, Folder, SearchTrigram
+
+# Rows in the FTS table are keyed by item id and kind: rowid = id * 2 + kind bit
+KINDS = {
+    'file': (File, File.original_filename, 0),
+    'folder': (Folder, Folder.name, 1)
+}
+
+# Names shorter than this have no trigrams and are matched with LIKE instead
+MIN_TERM_LENGTH = 3
+
+_fts_tables = {}
+
+
+def fts5_trigram_supported(connection):
+    """Check whether the database is SQLite with the FTS5 trigram tokenizer (3.34+)"""
+    if connection.dialect.name != 'sqlite':
+        return False
+    version = connection.exec_driver_sql('SELECT sqlite_version()').scalar()
+    options = {row[0] for row in connection.exec_driver_sql('PRAGMA compile_options')}
+    return tuple(int(part) for part in version.split('.')[:2]) >= (3, 34) and 'ENABLE_FTS5' in options
+
+
+# The owner is indexed as a token in its own column and matched along with
+# the name, so a search only walks the searching user's part of the index
+CREATE_FTS_TABLE = DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_fts "
+    "USING fts5(name, owner, tokenize='trigram')"
+)
+
+# Created next to the fallback table by db.create_all() where FTS5 is available
+event.listen(SearchTrigram.__table__, 'after_create', CREATE_FTS_TABLE.execute_if(
+    callable_=lambda ddl, target, bind, **kw: fts5_trigram_supported(bind)))
+
+
+def _fts_columns(connection):
+    return {row[1] for row in connection.exec_driver_sql('PRAGMA table_info(search_fts)')}
+
+
+def create_fts_table():
+    """Create the FTS5 table on an existing database if SQLite supports it
+
+    A table from before the owner column was indexed is dropped and created
+    again; rebuild_search_index() fills it.
+
+    Returns:
+        True if the FTS5 table exists afterwards
+    """
+    with db.engine.begin() as connection:
+        if not fts5_trigram_supported(connection):
+            return False
+        columns = _fts_columns(connection)
+        if columns and 'owner' not in columns:
+            connection.exec_driver_sql('DROP TABLE search_fts')
+        connection.execute(CREATE_FTS_TABLE)
+    _fts_tables.pop(str(db.engine.url), None)
+    return True
+
+
+def use_fts():
+    """Check whether searches go through the SQLite FTS5 table or the trigram table"""
+    if current_app.config.get('SEARCH_BACKEND', 'auto') == 'trigram':
+        return False
+    key = str(db.engine.url)
+    if key not in _fts_tables:
+        columns = set()
+        if db.engine.dialect.name == 'sqlite':
+            columns = _fts_columns(db.session.connection())
+        if columns and 'owner' not in columns:
+            print("Search index error: search_fts has an outdated layout, run 'flask reindex-search'")
+        _fts_tables[key] = 'owner' in columns
+    return _fts_tables[key]
+
+
+def normalize(name):
+    """Fold a name for case- and width-insensitive matching"""
+    return unicodedata.normalize('NFKC', name).casefold()
+
+
+def owner_token(owner_id):
+    """Get the text indexing an owner; the delimiters keep owner 4 from matching owner 42"""
+    return f'#{owner_id}#'
+
+
+def _phrase(term):
+    return '"{}"'.format(term.replace('"', '""'))
+
+
+def trigrams(name):
+    """Get the set of three-character substrings of a normalized name"""
+    name = normalize(name)
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+def index_item(kind, item_id, owner_id, name):
+    """Add or replace the index entry of a file or folder in the current session
+
+    Args:
+        kind: 'file' or 'folder'
+        item_id: ID of the file or folder (flush new objects first)
+        owner_id: ID of the owner
+        name: Name to index
+    """
+    unindex_items(kind, [item_id])
+    _insert_entry(kind, item_id, owner_id, name)
+
+
+def _insert_entry(kind, item_id, owner_id, name):
+    if use_fts():
+        db.session.execute(text(
+            'INSERT INTO search_fts (rowid, name, owner) VALUES (:rowid, :name, :owner)'),
+            {'rowid': item_id * 2 + KINDS[kind][2], 'name': name, 'owner': owner_token(owner_id)})
+        return
+
+    rows = [{'kind': kind, 'item_id': item_id, 'owner_id': owner_id, 'trigram': trigram}
+            for trigram in trigrams(name)]
+    if rows:
+        db.session.execute(SearchTrigram.__table__.insert(), rows)
+
+
+def unindex_items(kind, item_ids):
+    """Remove files or folders from the index in the current session"""
+    item_ids = list(item_ids)
+    for start in range(0, len(item_ids), 500):
+        batch = item_ids[start:start + 500]
+        if use_fts():
+            rowids = ', '.join(str(int(item_id) * 2 + KINDS[kind][2]) for item_id in batch)
+            db.session.execute(text(f'DELETE FROM search_fts WHERE rowid IN ({rowids})'))
+        else:
+            SearchTrigram.query.filter(SearchTrigram.kind == kind,
+                                       SearchTrigram.item_id.in_(batch)).delete(
+                synchronize_session=False)
+
+
+def index_file(file):
+    """Index a file's name"""
+    index_item('file', file.id, file.owner_id, file.original_filename)
+
+
+def index_files(rows):
+    """Index many file names at once
+
+    Args:
+        rows: List of (file id, owner id, name) tuples
+    """
+    unindex_items('file', [file_id for file_id, _, _ in rows])
+    for file_id, owner_id, name in rows:
+        _insert_entry('file', file_id, owner_id, name)
+
+
+def index_folder(folder):
+    """Index a folder's name"""
+    index_item('folder', folder.id, folder.owner_id, folder.name)
+
+
+def _searchable(kind, owner_id):
+    model, column, _ = KINDS[kind]
+    query = model.query.filter(model.owner_id == owner_id)
+    if model is File:
+        query = query.filter(File.is_trashed == False)
+    return query
+
+
+def search(kind, owner_id, query, limit=50, offset=0):
+    """Search the names of a user's files or folders
+
+    Every whitespace-separated term has to occur in the name. Results are
+    ranked with exact, prefix and shorter names first. The index only
+    narrows the names down to candidates; ranking them does not need
+    statistics over the whole index, so the cost of a search follows the
+    number of the user's own matches.
+
+    Args:
+        kind: 'file' or 'folder'
+        owner_id: ID of the user whose items are searched
+        query: Search string
+        limit: Maximum number of results
+        offset: Number of results to skip
+
+    Returns:
+        Tuple of (matching files or folders, whether more results exist)
+    """
+    model, column, kind_bit = KINDS[kind]
+    terms = [normalize(term) for term in query.split()]
+    if not terms:
+        return [], False
+
+    results = _searchable(kind, owner_id)
+    if all(len(term) >= MIN_TERM_LENGTH for term in terms) and use_fts():
+        # The owner token confines the match to the user's own entries
+        match = ' AND '.join([f'owner : {_phrase(owner_token(owner_id))}'] +
+                             [f'name : {_phrase(term)}' for term in terms])
+        candidates = text(
+            'SELECT rowid / 2 FROM search_fts WHERE search_fts MATCH :match AND rowid % 2 = :kind_bit'
+        ).bindparams(match=match, kind_bit=kind_bit).columns(id=db.Integer)
+        results = results.filter(model.id.in_(candidates))
+    else:
+        grams = set().union(*(trigrams(term) for term in terms))
+        if grams and all(len(term) >= MIN_TERM_LENGTH for term in terms):
+            # Only names containing every trigram of the query can match
+            candidates = db.session.query(SearchTrigram.item_id).filter(
+                SearchTrigram.owner_id == owner_id,
+                SearchTrigram.kind == kind,
+                SearchTrigram.trigram.in_(grams)
+            ).group_by(SearchTrigram.item_id).having(func.count() == len(grams))
+            results = results.filter(model.id.in_(candidates))
+
+        for term in terms:
+            results = results.filter(column.ilike(f'%{term}%'))
+
+    phrase = ' '.join(terms)
+    results = results.order_by(
+        case((func.lower(column) == phrase, 0),
+             (func.lower(column).like(f'{phrase}%'), 1), else_=2),
+        func.length(column),
+        column,
+        model.id
+    ).offset(offset).limit(limit + 1).all()
+    return results[:limit], len(results) > limit
+
+
+def rebuild_search_index():
+    """Rebuild the name index of all files and folders from scratch
+
+    Returns:
+        Number of items indexed
+    """
+    if use_fts():
+        db.session.execute(text('DELETE FROM search_fts'))
+    else:
+        SearchTrigram.query.delete(synchronize_session=False)
+
+    count = 0
+    for kind, (model, column, _) in KINDS.items():
+        query = db.session.query(model.id, model.owner_id, column)
+        if model is File:
+            query = query.filter(File.is_trashed == False)
+
+        # Walk the table in id order, one batch at a time
+        last_id = 0
+        while True:
+            batch = query.filter(model.id > last_id).order_by(model.id).limit(1000).all()
+            if not batch:
+                break
+            for item_id, owner_id, name in batch:
+                _insert_entry(kind, item_id, owner_id, name)
+            db.session.commit()
+            count += len(batch)
+            last_id = batch[-1][0]
+    return count
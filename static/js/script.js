@@ -4,6 +4,12 @@ document.addEventListener('DOMContentLoaded', function() {
     // Initialize the file preview modal functionality
     initFilePreviewModal();
     
+    // Load long text previews page by page
+    initTextPaging(document);
+    
+    // Send large files through the resumable upload API
+    initResumableUpload();
+    
     // Initialize tooltips
     var tooltipTriggerList = [].slice.call(document.querySelectorAll('[data-bs-toggle="tooltip"]'));
     tooltipTriggerList.map(function (tooltipTriggerEl) {
@@ -128,31 +134,35 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
-    // Set up file preview buttons
-    document.querySelectorAll('.file-item').forEach(function(fileItem) {
-        const fileId = fileItem.dataset.fileId;
-        if (fileId) {
-            // Make the entire file item clickable for preview
-            fileItem.addEventListener('click', function(e) {
-                // Don't trigger for clicks on buttons or links within the file item
-                if (e.target.closest('a, button, .dropdown')) return;
-                e.preventDefault();
-                previewFile(fileId);
-            });
-        }
-    });
-    
-    // Handle dedicated preview buttons click events
-    document.querySelectorAll('.preview-file-btn').forEach(function(button) {
-        button.addEventListener('click', function(e) {
+    // Set up file preview (delegated so rows loaded later are covered too)
+    document.addEventListener('click', function(e) {
+        // Handle dedicated preview buttons click events
+        const button = e.target.closest('.preview-file-btn');
+        if (button) {
             e.preventDefault();
             e.stopPropagation(); // Stop event bubbling
-            const fileId = this.getAttribute('data-file-id');
+            const fileId = button.getAttribute('data-file-id');
             if (fileId) {
                 previewFile(fileId);
             }
-        });
+            return;
+        }
+        
+        // Make the entire file item clickable for preview
+        const fileItem = e.target.closest('.file-item');
+        if (fileItem && fileItem.dataset.fileId) {
+            // Don't trigger for clicks on buttons or links within the file item
+            if (e.target.closest('a, button, .dropdown')) return;
+            e.preventDefault();
+            previewFile(fileItem.dataset.fileId);
+        }
     });
+    
+    // Load further pages of long folder listings
+    initInfiniteScroll();
+    
+    // Searchable, paged destination folder picker
+    initFolderPicker();
 });
 
 // File Preview Modal Functions
@@ -203,7 +213,8 @@ function previewFile(fileId) {
             if (data.file_type === 'image') {
                 window.previewModal.body.innerHTML = `
                     <div class="preview-container">
-                        <img src="/preview/${fileId}?inline=1" alt="${data.filename}">
+                        <img src="${data.has_preview ? `/thumbnail/${fileId}?size=preview` : `/preview/${fileId}?inline=1`}" alt="${data.filename}"
+                             onerror="this.onerror = null; this.src = '/preview/${fileId}?inline=1';">
                     </div>
                 `;
             } else if (data.file_type === 'pdf') {
@@ -215,7 +226,7 @@ function previewFile(fileId) {
             } else if (data.file_type === 'video') {
                 window.previewModal.body.innerHTML = `
                     <div class="preview-container">
-                        <video controls preload="metadata">
+                        <video controls preload="metadata" ${data.has_preview ? `poster="/thumbnail/${fileId}?size=preview"` : ''}>
                             <source src="/preview/${fileId}?inline=1" type="video/${data.extension}">
                             Your browser does not support the video tag.
                         </video>
@@ -224,9 +235,15 @@ function previewFile(fileId) {
             } else if (data.file_type === 'text') {
                 window.previewModal.body.innerHTML = `
                     <div class="preview-container">
-                        <pre class="preview-text">${data.content}</pre>
+                        <pre class="preview-text" data-file-id="${fileId}"></pre>
                     </div>
                 `;
+                const pre = window.previewModal.body.querySelector('.preview-text');
+                pre.textContent = data.content;
+                if (data.next_offset !== null) {
+                    pre.dataset.nextOffset = data.next_offset;
+                    initTextPaging(window.previewModal.body);
+                }
             } else {
                 window.previewModal.body.innerHTML = `
                     <div class="text-center py-3">
@@ -246,3 +263,259 @@ function previewFile(fileId) {
             `;
         });
 }
+
+// Text Preview Functions
+function initTextPaging(container) {
+    container.querySelectorAll('.preview-text[data-next-offset]').forEach(function(pre) {
+        let loading = false;
+        
+        function loadNextPage() {
+            if (loading || !pre.dataset.nextOffset) return;
+            loading = true;
+            
+            fetch(`/api/files/${pre.dataset.fileId}/text?offset=${pre.dataset.nextOffset}`)
+                .then(response => {
+                    if (!response.ok) throw new Error('Error loading text');
+                    return response.json();
+                })
+                .then(data => {
+                    pre.appendChild(document.createTextNode(data.content));
+                    if (data.next_offset !== null) {
+                        pre.dataset.nextOffset = data.next_offset;
+                    } else {
+                        delete pre.dataset.nextOffset;
+                    }
+                })
+                .catch(error => console.error('Text preview error:', error))
+                .finally(() => {
+                    loading = false;
+                });
+        }
+        
+        // Load the next page when the reader gets near the end of the loaded text
+        pre.addEventListener('scroll', function() {
+            if (pre.scrollTop + pre.clientHeight >= pre.scrollHeight - 200) loadNextPage();
+        });
+    });
+}
+
+// Resumable Upload Functions
+function initResumableUpload() {
+    const form = document.querySelector('form[data-resumable-upload]');
+    if (!form) return;
+    
+    form.addEventListener('submit', function(e) {
+        const fileInput = form.querySelector('input[type="file"]');
+        const file = fileInput && fileInput.files[0];
+        const chunkSize = parseInt(form.dataset.chunkSize, 10);
+        
+        // Small files keep using the regular single-request upload
+        if (!file || !chunkSize || file.size <= chunkSize) return;
+        e.preventDefault();
+        
+        const folderId = parseInt(form.querySelector('[name="folder_id"]').value, 10);
+        const submitButton = form.querySelector('[type="submit"]');
+        const submitLabel = submitButton.value;
+        submitButton.disabled = true;
+        
+        resumableUpload(file, folderId, function(done, total) {
+            submitButton.value = `Uploading ${Math.floor(done * 100 / total)}%`;
+        })
+            .then(() => {
+                window.location.href = `/folder/${folderId}`;
+            })
+            .catch(error => {
+                console.error('Upload error:', error);
+                alert(`Upload failed: ${error.message}`);
+                submitButton.disabled = false;
+                submitButton.value = submitLabel;
+            });
+    });
+}
+
+async function resumableUpload(file, folderId, onProgress) {
+    // Remember the session so an interrupted upload resumes where it stopped
+    const storageKey = `upload:${folderId}:${file.name}:${file.size}:${file.lastModified}`;
+    let session = null;
+    
+    const savedId = localStorage.getItem(storageKey);
+    if (savedId) {
+        const response = await fetch(`/api/uploads/${savedId}`);
+        if (response.ok) {
+            session = await response.json();
+        }
+    }
+    
+    if (!session) {
+        const response = await fetch('/api/uploads', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({
+                filename: file.name,
+                size: file.size,
+                folder_id: folderId,
+                content_type: file.type || null
+            })
+        });
+        const data = await response.json();
+        if (!response.ok) throw new Error(data.error || 'Could not start upload');
+        if (data.complete) return data;
+        
+        session = Object.assign({received: []}, data);
+        localStorage.setItem(storageKey, session.session_id);
+    }
+    
+    // Work out which chunks still need to be sent
+    const received = new Set();
+    session.received.forEach(([first, last]) => {
+        for (let index = first; index <= last; index++) received.add(index);
+    });
+    const pending = [];
+    for (let index = 0; index < session.chunk_count; index++) {
+        if (!received.has(index)) pending.push(index);
+    }
+    
+    let uploaded = received.size;
+    onProgress(uploaded, session.chunk_count);
+    
+    async function sendChunks() {
+        while (pending.length) {
+            const index = pending.shift();
+            const chunk = file.slice(index * session.chunk_size, (index + 1) * session.chunk_size);
+            
+            for (let attempt = 1; ; attempt++) {
+                let response = null;
+                try {
+                    response = await fetch(`/api/uploads/${session.session_id}/chunks/${index}`, {
+                        method: 'PUT',
+                        body: chunk
+                    });
+                } catch (error) {
+                    // Network error, retry below
+                }
+                if (response && response.ok) break;
+                if (response && response.status < 500) throw new Error(`Chunk ${index} was rejected`);
+                if (attempt >= 5) throw new Error(`Chunk ${index} could not be uploaded`);
+                await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
+            }
+            
+            uploaded++;
+            onProgress(uploaded, session.chunk_count);
+        }
+    }
+    
+    // Send chunks over a few parallel connections
+    await Promise.all([sendChunks(), sendChunks(), sendChunks()]);
+    
+    const response = await fetch(`/api/uploads/${session.session_id}/complete`, {method: 'POST'});
+    const data = await response.json();
+    if (!response.ok) throw new Error(data.error || 'Could not complete upload');
+    
+    localStorage.removeItem(storageKey);
+    return data;
+}
+
+// Paged Listing Functions
+function initInfiniteScroll() {
+    document.querySelectorAll('.load-more').forEach(function(loader) {
+        let loading = false;
+        
+        function loadNextPage() {
+            if (loading || !loader.dataset.cursor) return;
+            loading = true;
+            
+            const url = new URL(loader.dataset.url, window.location.origin);
+            url.searchParams.set('cursor', loader.dataset.cursor);
+            fetch(url)
+                .then(response => {
+                    if (!response.ok) throw new Error('Error loading more entries');
+                    return response.json();
+                })
+                .then(data => {
+                    document.getElementById(loader.dataset.target)
+                        .insertAdjacentHTML('beforeend', data.html);
+                    if (data.next_cursor) {
+                        loader.dataset.cursor = data.next_cursor;
+                    } else {
+                        loader.remove();
+                    }
+                })
+                .catch(error => console.error('Listing error:', error))
+                .finally(() => {
+                    loading = false;
+                });
+        }
+        
+        loader.querySelector('button').addEventListener('click', loadNextPage);
+        
+        // Load the next page automatically when the end of the list scrolls into view
+        if ('IntersectionObserver' in window) {
+            new IntersectionObserver(function(entries) {
+                if (entries.some(entry => entry.isIntersecting)) loadNextPage();
+            }).observe(loader);
+        }
+    });
+}
+
+function initFolderPicker() {
+    document.querySelectorAll('[data-folder-picker]').forEach(function(input) {
+        const select = document.getElementById(input.dataset.folderPicker);
+        if (!select) return;
+        
+        const initialOptions = select.innerHTML;
+        let debounce = null;
+        let nextCursor = null;
+        
+        function loadFolders(append) {
+            const url = new URL(input.dataset.url, window.location.origin);
+            url.searchParams.set('q', input.value.trim());
+            if (append && nextCursor) url.searchParams.set('cursor', nextCursor);
+            
+            fetch(url)
+                .then(response => response.json())
+                .then(data => {
+                    const moreOption = select.querySelector('option[data-more]');
+                    if (moreOption) moreOption.remove();
+                    if (!append) select.innerHTML = '';
+                    
+                    data.items.forEach(function(folder) {
+                        const option = document.createElement('option');
+                        option.value = folder.id;
+                        option.textContent = folder.path;
+                        select.appendChild(option);
+                    });
+                    
+                    nextCursor = data.next_cursor;
+                    if (nextCursor) {
+                        const option = document.createElement('option');
+                        option.textContent = 'More folders…';
+                        option.value = '';
+                        option.dataset.more = '1';
+                        select.appendChild(option);
+                    }
+                })
+                .catch(error => console.error('Folder picker error:', error));
+        }
+        
+        input.addEventListener('input', function() {
+            clearTimeout(debounce);
+            if (!input.value.trim()) {
+                select.innerHTML = initialOptions;
+                return;
+            }
+            debounce = setTimeout(() => loadFolders(false), 250);
+        });
+        
+        input.addEventListener('focus', function() {
+            if (!input.value.trim() && select.options.length <= 1) loadFolders(false);
+        }, {once: true});
+        
+        select.addEventListener('change', function() {
+            const selected = select.options[select.selectedIndex];
+            if (selected && selected.dataset.more) {
+                select.selectedIndex = 0;
+                loadFolders(true);
+            }
+        });
+    });
+}
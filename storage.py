@@ -0,0 +1,292 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+
+# Name of the backend holding UPLOAD_FOLDER; rows without a storage name live there
+LOCAL = 'local'
+
+
+class StorageBackend:
+    """Where the bytes of stored files live
+
+    Paths are the relative names kept in Blob.file_path and File.file_path.
+    Backends are shared between threads and must not need an application
+    context, so deletions can run on a background pool.
+    """
+
+    def open(self, path):
+        """Open a stored file for reading
+
+        Returns:
+            Seekable binary file object; seeking to an offset reads only
+            from there, which ranged reads and decryption rely on
+        """
+        raise NotImplementedError
+
+    def size(self, path):
+        """Get the size of a stored file in bytes"""
+        raise NotImplementedError
+
+    def store(self, path, local_path):
+        """Move a finished local file into the backend under a path"""
+        raise NotImplementedError
+
+    def write(self, path, fileobj):
+        """Write the content of a readable binary stream under a path"""
+        raise NotImplementedError
+
+    def delete(self, path):
+        """Delete a stored file; missing files are ignored"""
+        raise NotImplementedError
+
+    def exists(self, path):
+        raise NotImplementedError
+
+    def local_path(self, path):
+        """Get a path on the local file system for a stored file, or None if it is remote"""
+        return None
+
+    def iter_range(self, path, start=0, stop=None, chunk_size=64 * 1024):
+        """Yield the bytes [start, stop) of a stored file chunk by chunk"""
+        with self.open(path) as f:
+            f.seek(start)
+            remaining = None if stop is None else stop - start
+            while remaining is None or remaining > 0:
+                data = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not data:
+                    break
+                if remaining is not None:
+                    remaining -= len(data)
+                yield data
+
+
+class LocalStorage(StorageBackend):
+    """Files in a directory on the local file system"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def local_path(self, path):
+        return os.path.join(self.root, path)
+
+    def open(self, path):
+        return open(self.local_path(path), 'rb')
+
+    def size(self, path):
+        return os.path.getsize(self.local_path(path))
+
+    def store(self, path, local_path):
+        target = self.local_path(path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(local_path, target)
+
+    def write(self, path, fileobj):
+        target = self.local_path(path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.write-')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                shutil.copyfileobj(fileobj, out, 1024 * 1024)
+            os.replace(temp_path, target)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def delete(self, path):
+        try:
+            os.remove(self.local_path(path))
+        except OSError:
+            pass  # File might not exist on disk
+
+    def exists(self, path):
+        return os.path.exists(self.local_path(path))
+
+
+class _S3ObjectReader(io.RawIOBase):
+    """Seekable reader over an S3 object
+
+    Sequential reads come from one streaming GET; a seek starts a new ranged
+    GET at the new offset on the next read.
+    """
+
+    def __init__(self, client, bucket, key, size):
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._size = size
+        self._position = 0
+        self._body = None
+        self._body_position = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(offset, 0)
+        return self._position
+
+    def readinto(self, buffer):
+        if self._position >= self._size:
+            return 0
+        if self._body is None or self._body_position != self._position:
+            self._close_body()
+            response = self._client.get_object(Bucket=self._bucket, Key=self._key,
+                                               Range=f'bytes={self._position}-')
+            self._body = response['Body']
+            self._body_position = self._position
+        data = self._body.read(len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        self._body_position += len(data)
+        return len(data)
+
+    def _close_body(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+    def close(self):
+        self._close_body()
+        super().close()
+
+
+class S3Storage(StorageBackend):
+    """Files in a bucket of S3 or an S3-compatible store (MinIO, Ceph, ...)
+
+    One client with a pool of HTTP connections is shared by all threads.
+    Large files are uploaded in parts by boto3's transfer manager.
+
+    Args:
+        bucket: Bucket name
+        prefix: Optional key prefix for everything this backend stores
+        endpoint_url: Endpoint of an S3-compatible store; None for AWS
+        region: Region name
+        access_key, secret_key: Credentials; None to use boto3's default chain
+        max_connections: Size of the HTTP connection pool
+        multipart_threshold: Files at least this large are uploaded in parts
+        multipart_chunksize: Size of each uploaded part
+        read_buffer_size: Bytes fetched per read from a streaming GET
+    """
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, access_key=None,
+                 secret_key=None, max_connections=20, multipart_threshold=16 * 1024 * 1024,
+                 multipart_chunksize=16 * 1024 * 1024, read_buffer_size=1024 * 1024):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config as BotoConfig
+        except ImportError:
+            raise RuntimeError('The S3 storage backend requires boto3 (pip install boto3).')
+
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.read_buffer_size = read_buffer_size
+        self.client = boto3.session.Session().client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            config=BotoConfig(max_pool_connections=max_connections,
+                              retries={'max_attempts': 5, 'mode': 'standard'})
+        )
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                              multipart_chunksize=multipart_chunksize,
+                                              max_concurrency=max(max_connections // 2, 1))
+
+    def _key(self, path):
+        return self.prefix + path
+
+    def open(self, path):
+        reader = _S3ObjectReader(self.client, self.bucket, self._key(path), self.size(path))
+        return io.BufferedReader(reader, buffer_size=self.read_buffer_size)
+
+    def size(self, path):
+        return self.client.head_object(Bucket=self.bucket, Key=self._key(path))['ContentLength']
+
+    def store(self, path, local_path):
+        self.client.upload_file(local_path, self.bucket, self._key(path), Config=self.transfer_config)
+        os.unlink(local_path)
+
+    def write(self, path, fileobj):
+        self.client.upload_fileobj(fileobj, self.bucket, self._key(path), Config=self.transfer_config)
+
+    def delete(self, path):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(path))
+
+    def exists(self, path):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(path))
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+
+BACKEND_TYPES = {'local': LocalStorage, 's3': S3Storage}
+
+
+class Storage:
+    """Registry of the configured storage backends
+
+    STORAGE_BACKENDS maps backend names to their settings, e.g.
+    ``{'cold': {'type': 's3', 'bucket': 'drive-archive'}}``; the remaining
+    keys are passed to the backend class. The 'local' backend is
+    UPLOAD_FOLDER unless configured otherwise. New files go to
+    STORAGE_DEFAULT.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._backends = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('STORAGE_BACKENDS', {})
+        app.config.setdefault('STORAGE_DEFAULT', LOCAL)
+        app.config.setdefault('STORAGE_TIERING_RULES', [])
+
+    @property
+    def default_name(self):
+        return self.app.config['STORAGE_DEFAULT']
+
+    def get(self, name=None):
+        """Get a backend by name; None is the local backend"""
+        name = name or LOCAL
+        with self._lock:
+            if name not in self._backends:
+                self._backends[name] = self._create(name)
+            return self._backends[name]
+
+    def _create(self, name):
+        settings = dict(self.app.config['STORAGE_BACKENDS'].get(name) or {})
+        if not settings and name == LOCAL:
+            settings = {'type': 'local', 'root': self.app.config['UPLOAD_FOLDER']}
+        if not settings:
+            raise KeyError(f'Unknown storage backend: {name}')
+        return BACKEND_TYPES[settings.pop('type')](**settings)
+
+    def reset(self):
+        """Forget created backends, e.g. after the configuration changed"""
+        with self._lock:
+            self._backends.clear()
+
+
+storage = Storage()
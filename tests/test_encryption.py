@@ -0,0 +1,119 @@
+import io
+import os
+
+import pytest
+
+from encryption import (HEADER, DecryptionError, encrypt_chunks, decrypt_chunks, decrypt_range,
+                        encrypted_chunk_size, plaintext_size)
+
+CHUNK_SIZE = 16
+MASTER_KEY = os.urandom(32)
+
+
+def encrypt(data, chunk_size=CHUNK_SIZE, key=MASTER_KEY):
+    # Feed the plaintext in pieces that do not line up with the chunks
+    pieces = [data[offset:offset + 7] for offset in range(0, len(data), 7)]
+    return b''.join(encrypt_chunks(key, pieces, chunk_size))
+
+
+def decrypt(ciphertext, key=MASTER_KEY):
+    return b''.join(decrypt_chunks(key, io.BytesIO(ciphertext)))
+
+
+def chunk_offset(index):
+    return HEADER.size + index * encrypted_chunk_size(CHUNK_SIZE)
+
+
+@pytest.mark.parametrize('size', [0, 1, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 1,
+                                  3 * CHUNK_SIZE, 3 * CHUNK_SIZE + 5])
+def test_round_trip(size):
+    data = os.urandom(size)
+    ciphertext = encrypt(data)
+    assert decrypt(ciphertext) == data
+    assert plaintext_size(len(ciphertext), CHUNK_SIZE) == size
+
+
+def test_empty_input_has_one_sealed_chunk():
+    ciphertext = encrypt(b'')
+    assert len(ciphertext) == HEADER.size + encrypted_chunk_size(0)
+    assert decrypt(ciphertext) == b''
+
+
+def test_exact_multiple_ends_with_full_chunk():
+    ciphertext = encrypt(os.urandom(2 * CHUNK_SIZE))
+    assert len(ciphertext) == chunk_offset(2)
+
+
+def test_same_plaintext_encrypts_differently():
+    data = os.urandom(40)
+    assert encrypt(data) != encrypt(data)
+
+
+def test_wrong_key_fails():
+    with pytest.raises(DecryptionError):
+        decrypt(encrypt(b'secret'), key=os.urandom(32))
+
+
+def test_flipped_bit_fails():
+    ciphertext = bytearray(encrypt(os.urandom(3 * CHUNK_SIZE)))
+    ciphertext[chunk_offset(1) + 3] ^= 1
+    with pytest.raises(DecryptionError):
+        decrypt(bytes(ciphertext))
+
+
+def test_modified_header_fails():
+    ciphertext = bytearray(encrypt(os.urandom(20)))
+    ciphertext[HEADER.size - 1] ^= 1  # Last byte of the nonce prefix
+    with pytest.raises(DecryptionError):
+        decrypt(bytes(ciphertext))
+
+
+def test_reordered_chunks_fail():
+    ciphertext = encrypt(os.urandom(3 * CHUNK_SIZE + 4))
+    first, second = ciphertext[chunk_offset(0):chunk_offset(1)], ciphertext[chunk_offset(1):chunk_offset(2)]
+    swapped = ciphertext[:chunk_offset(0)] + second + first + ciphertext[chunk_offset(2):]
+    with pytest.raises(DecryptionError):
+        decrypt(swapped)
+
+
+def test_dropped_final_chunk_fails():
+    ciphertext = encrypt(os.urandom(3 * CHUNK_SIZE + 4))
+    with pytest.raises(DecryptionError):
+        decrypt(ciphertext[:chunk_offset(3)])
+
+
+def test_truncated_final_chunk_fails():
+    ciphertext = encrypt(os.urandom(3 * CHUNK_SIZE + 4))
+    with pytest.raises(DecryptionError):
+        decrypt(ciphertext[:-1])
+
+
+def test_truncated_header_fails():
+    with pytest.raises(DecryptionError):
+        decrypt(encrypt(b'data')[:HEADER.size - 1])
+
+
+@pytest.mark.parametrize('start, stop', [
+    (0, 1), (0, CHUNK_SIZE), (CHUNK_SIZE - 1, CHUNK_SIZE + 1), (CHUNK_SIZE, 2 * CHUNK_SIZE),
+    (2 * CHUNK_SIZE - 1, 2 * CHUNK_SIZE), (5, 3 * CHUNK_SIZE + 5), (3 * CHUNK_SIZE, 3 * CHUNK_SIZE + 5),
+    (3 * CHUNK_SIZE + 4, 3 * CHUNK_SIZE + 5)
+])
+def test_decrypt_range_at_chunk_edges(start, stop):
+    data = os.urandom(3 * CHUNK_SIZE + 5)
+    ciphertext = encrypt(data)
+    chunks = decrypt_range(MASTER_KEY, io.BytesIO(ciphertext), len(ciphertext), start, stop)
+    assert b''.join(chunks) == data[start:stop]
+
+
+def test_decrypt_range_of_exact_multiple():
+    data = os.urandom(2 * CHUNK_SIZE)
+    ciphertext = encrypt(data)
+    chunks = decrypt_range(MASTER_KEY, io.BytesIO(ciphertext), len(ciphertext), CHUNK_SIZE, 2 * CHUNK_SIZE)
+    assert b''.join(chunks) == data[CHUNK_SIZE:]
+
+
+def test_decrypt_range_detects_truncation():
+    data = os.urandom(3 * CHUNK_SIZE + 5)
+    ciphertext = encrypt(data)[:chunk_offset(2)]
+    with pytest.raises(DecryptionError):
+        b''.join(decrypt_range(MASTER_KEY, io.BytesIO(ciphertext), len(ciphertext), 0, CHUNK_SIZE * 2))
@@ -0,0 +1,150 @@
+import struct
+from array import array
+
+# Header of a packed line index: interval, line count, size of the text
+_HEADER = struct.Struct('>IQQ')
+
+
+class LineIndex:
+    """Sparse index of the byte offsets of lines in a text
+
+    Only every interval-th line's offset is kept, so the index of a file
+    with millions of lines stays small; finding any other line means
+    reading forward at most interval lines from the nearest indexed one.
+
+    Args:
+        interval: Number of lines between indexed offsets
+        offsets: Byte offset of line 0, interval, 2 * interval, ...
+        line_count: Number of lines in the text
+        size: Size of the text in bytes
+    """
+
+    def __init__(self, interval, offsets, line_count, size):
+        self.interval = interval
+        self.offsets = offsets
+        self.line_count = line_count
+        self.size = size
+
+    def locate(self, line):
+        """Find where to start reading for a line
+
+        Returns:
+            Tuple of (byte offset of the nearest indexed line at or before
+            it, number of lines to skip from there)
+        """
+        line = min(max(line, 0), max(self.line_count - 1, 0))
+        slot = min(line // self.interval, len(self.offsets) - 1)
+        return self.offsets[slot], line - slot * self.interval
+
+    def pack(self):
+        offsets = array('Q', self.offsets)
+        if offsets.itemsize != 8:
+            raise RuntimeError('Unsupported platform for line indexes')
+        return _HEADER.pack(self.interval, self.line_count, self.size) + offsets.tobytes()
+
+    @classmethod
+    def unpack(cls, data):
+        interval, line_count, size = _HEADER.unpack_from(data)
+        offsets = array('Q')
+        offsets.frombytes(data[_HEADER.size:])
+        return cls(interval, list(offsets), line_count, size)
+
+
+def build_line_index(chunks, interval=1000):
+    """Index the lines of a text in one pass over its chunks
+
+    Args:
+        chunks: Iterable of the text's byte strings
+        interval: Number of lines between indexed offsets
+
+    Returns:
+        LineIndex
+    """
+    offsets = [0]
+    newlines = 0
+    position = 0
+    last = b''
+    for data in chunks:
+        start = 0
+        while True:
+            found = data.find(b'\n', start)
+            if found < 0:
+                break
+            newlines += 1
+            if newlines % interval == 0:
+                offsets.append(position + found + 1)
+            start = found + 1
+        position += len(data)
+        if data:
+            last = data[-1:]
+
+    # A final line without a newline still counts; an empty text has no lines
+    line_count = newlines + (1 if position and last != b'\n' else 0)
+    if offsets[-1] >= position and len(offsets) > 1:
+        offsets.pop()
+    return LineIndex(interval, offsets, line_count, position)
+
+
+def skip_lines(read_range, offset, count, window=64 * 1024):
+    """Find the offset of the line count lines after the one starting at offset
+
+    Args:
+        read_range: Callable returning the bytes [start, stop) of the text
+        offset: Byte offset of a line start
+        count: Number of lines to skip
+        window: Bytes read at a time
+
+    Returns:
+        Byte offset of the line, or None if the text ends first
+    """
+    while count > 0:
+        data = read_range(offset, offset + window)
+        if not data:
+            return None
+        start = 0
+        while count > 0:
+            found = data.find(b'\n', start)
+            if found < 0:
+                break
+            count -= 1
+            start = found + 1
+        offset += start if count == 0 else len(data)
+    return offset
+
+
+def _utf8_boundary(data):
+    """Get the length of data without a multi-byte character cut off at its end"""
+    for back in range(1, min(4, len(data)) + 1):
+        byte = data[-back]
+        if byte < 0x80:
+            return len(data)
+        if byte >= 0xC0:
+            # Lead byte: keep the character only if all its bytes are there
+            needed = 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+            return len(data) if back >= needed else len(data) - back
+    return len(data)
+
+
+def read_page(read_range, offset, max_bytes):
+    """Read a page of text starting at a byte offset
+
+    Pages end after the last complete line that fits. A single line longer
+    than the page is split, on a character boundary.
+
+    Args:
+        read_range: Callable returning the bytes [start, stop) of the text
+        offset: Byte offset to start at
+        max_bytes: Maximum size of the page
+
+    Returns:
+        Tuple of (page bytes, offset of the next page or None at the end)
+    """
+    data = read_range(offset, offset + max_bytes + 1)
+    if len(data) <= max_bytes:
+        return data, None
+
+    data = data[:max_bytes]
+    end = data.rfind(b'\n') + 1
+    if end == 0:
+        end = _utf8_boundary(data) or len(data)
+    return data[:end], offset + end
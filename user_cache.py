@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask_login import UserMixin
+from sqlalchemy import event
+
+from models import db, User
+
+# Columns kept in the cache: what authentication, page chrome and quota checks read
+CACHED_FIELDS = ('id', 'username', 'email', 'storage_limit',
+                 'file_count', 'starred_count', 'trashed_count', 'shared_count')
+
+
+class CachedUser(UserMixin):
+    """Logged-in user principal backed by a cached snapshot of the User row
+
+    Cached fields are answered from the snapshot. Anything else (relations,
+    storage_used, password checks) and every assignment goes to the User
+    row, which is loaded from the database on first use in the request.
+    Assigning a cached field invalidates the cache entry once the session
+    commits.
+    """
+
+    def __init__(self, values, user=None):
+        object.__setattr__(self, '_values', values)
+        object.__setattr__(self, '_user', user)
+
+    @property
+    def user(self):
+        """The User row this principal stands for"""
+        if self._user is None:
+            object.__setattr__(self, '_user', User.query.get(self._values['id']))
+        return self._user
+
+    def __getattr__(self, name):
+        values = object.__getattribute__(self, '_values')
+        if name in values:
+            return values[name]
+        return getattr(self.user, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.user, name, value)
+        if name in self._values:
+            object.__setattr__(self, '_values', {**self._values, name: value})
+            user_cache.invalidate_on_commit(self._values['id'])
+
+    def __repr__(self):
+        return f'<CachedUser {self._values["username"]}>'
+
+
+class UserCache:
+    """Bounded LRU cache of user snapshots with a time to live
+
+    Keeps Flask-Login's user loader from querying the user on every
+    request. Entries expire after USER_CACHE_TTL seconds, so changes made
+    by other processes show up within that time; changes made in this
+    process invalidate their entries when they are committed.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('USER_CACHE_SIZE', 1024)
+        app.config.setdefault('USER_CACHE_TTL', 60)
+
+    def load(self, user_id):
+        """Get the principal for a user id, querying the database only on a miss
+
+        Returns:
+            CachedUser, or None if the user does not exist
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                return CachedUser(entry[1])
+
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        values = {field: getattr(user, field) for field in CACHED_FIELDS}
+
+        with self._lock:
+            self._entries[user_id] = (now + self.app.config['USER_CACHE_TTL'], values)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.app.config['USER_CACHE_SIZE']:
+                self._entries.popitem(last=False)
+        return CachedUser(values, user)
+
+    def invalidate(self, *user_ids):
+        """Drop cache entries right away"""
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def invalidate_on_commit(self, *user_ids):
+        """Drop cache entries once the current session commits or rolls back
+
+        Invalidating after the commit keeps a concurrent request from caching
+        the old row again in between.
+        """
+        db.session.info.setdefault('stale_users', set()).update(user_ids)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_cache = UserCache()
+
+
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_soft_rollback')
+def _drop_stale_users(session, *args):
+    stale = session.info.pop('stale_users', None)
+    if stale:
+        user_cache.invalidate(*stale)